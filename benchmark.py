@@ -0,0 +1,536 @@
+#!/usr/bin/env python
+"""
+Offline benchmarks of the RoomFinder engines, run on generated rooms and
+against a local fake SpareRoom API so they never touch SpareRoom.
+
+python benchmark.py scoring --rooms 10000 50000
+python benchmark.py records --rooms 100000
+python benchmark.py snapshot --rooms 10000 100000 --storage json
+python benchmark.py query --rooms 100000
+python benchmark.py federation --rooms 1000 --latency 0.01
+python benchmark.py hybrid --rooms 1000 10000 --max-results 20
+python benchmark.py chunked --rooms 10000 50000 100000 --chunk-size 1000
+python benchmark.py crawl --rooms 1000 10000 100000 --latency 0.01 --output results.json
+"""
+from datetime import datetime, timedelta
+from time import time
+import multiprocessing
+import argparse
+import random
+import shutil
+import tempfile
+import json
+import os
+
+try:
+    import resource
+except ImportError:
+    resource = None
+
+try:
+    import tracemalloc
+except ImportError:
+    tracemalloc = None
+
+import rooms
+from rooms import settings
+from fakeapi import FakeSpareRoom, generate_adverts, AREAS, START
+
+STATIONS = AREAS + ['Balham', 'Tooting Bec', 'Putney']
+
+def configure(*argv):
+    """Fills rooms.settings as the command line would, for an offline run."""
+
+    defaults = ['--areas'] + AREAS + ['--date', '2017-06-16', '--min-date', '2017-06-01', '--rent', '800', '--sleep', '0', '--no-cache', '--storage', 'json']
+    rooms.configure(rooms.parse_arguments(defaults + list(argv)))
+
+def generate_room(room_id, rnd):
+    """Returns a room like the ones SpareRoom.get_room_info stores."""
+
+    available = datetime(2017, 5, 1) + timedelta(days=rnd.randint(0, 90), hours=rnd.randint(0, 23), microseconds=rnd.choice([0, rnd.randint(1, 999999)]))
+    housemates = rnd.choice([-1, 1, 2, 3, 4, 5])
+    return {
+        'id': room_id,
+        'search': rnd.choice(AREAS),
+        'images': ['http://localhost/{id}/{n}.jpg'.format(id=room_id, n=n) for n in range(rnd.randint(0, 8))],
+        'station': rnd.choice(STATIONS),
+        'prices': [rnd.randint(400, 1400) for _ in range(rnd.randint(1, 3))],
+        'available': available.strftime('%d %b %Y'),
+        'timestamp': str(available),
+        'deposits': [rnd.randint(0, 1500) for _ in range(rnd.randint(0, 2))],
+        'bills': rnd.random() < 0.4,
+        'rooms': rnd.randint(1, 7),
+        'housemates': housemates,
+        'females': rnd.randint(0, max(0, housemates)),
+        'males': rnd.randint(0, 3),
+        'phone': False,
+        'new': True,
+    }
+
+def generate_rooms(count, seed=0):
+    """Returns count generated rooms keyed by id like SearchEngine.rooms."""
+
+    rnd = random.Random(seed)
+    return rooms.Rooms((str(room_id), generate_room(str(room_id), rnd)) for room_id in range(1000000, 1000000 + count))
+
+def make_directory(directory, name):
+    path = os.path.join(directory, name)
+    os.makedirs(path)
+    return path
+
+def make_engine(directory, count=0, seed=0):
+    """Creates a SpareRoom engine storing its rooms in directory."""
+
+    engine = rooms.SpareRoom(rooms.get_spareroom_preferences(), settings.AREAS, file_name=os.path.join(directory, 'spareroom.json'))
+    if count:
+        engine.rooms = generate_rooms(count, seed)
+    return engine
+
+def peak_memory():
+    """Returns the peak resident memory of the process in MB."""
+
+    if resource is None:
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+def percentiles(values, points=(50, 90, 99)):
+    """Returns the percentiles of values, keyed p50, p90, ..."""
+
+    values = sorted(values)
+    if not values:
+        return dict(('p{point}'.format(point=point), None) for point in points)
+    return dict(('p{point}'.format(point=point), values[min(len(values) - 1, int(len(values) * point / 100.0))]) for point in points)
+
+def measure(name, function, latencies=None):
+    """
+    Runs function and returns its timings and request latencies. The peak
+    memory of the process only goes up, so it is not given for one function:
+    see bench_chunked for runs in their own process.
+    """
+
+    if latencies is not None:
+        del latencies[:]
+
+    start = time()
+    function()
+    elapsed = time() - start
+
+    result = {'seconds': elapsed}
+    if latencies is not None:
+        result['requests'] = len(latencies)
+        result['latency'] = percentiles(latencies)
+    print('  {name}: {seconds:.2f}s'.format(name=name, seconds=elapsed))
+    return result
+
+def allocated(function):
+    """
+    Returns what function returns, the seconds it took and the memory still
+    allocated by it when it returns (None without tracemalloc). The function
+    is called a second time to trace its memory, tracing slows it down.
+    """
+
+    start = time()
+    value = function()
+    elapsed = time() - start
+
+    if tracemalloc is None:
+        return value, elapsed, None
+
+    del value
+    tracemalloc.start()
+    value = function()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return value, elapsed, memory
+
+def bench_crawl(args, directory):
+    """
+    Crawls, re-rates, updates and reports count rooms served by a local fake
+    SpareRoom API.
+    """
+
+    results = []
+    for count in args.rooms:
+        api = FakeSpareRoom(count, latency=args.latency, error_rate=args.error_rate, overlap=args.overlap)
+        api.start()
+
+        pages = count // len(AREAS) // 100 + 1
+        configure('--max-rooms', '100', '--max-pages', str(pages), '--workers', str(args.workers), '--retries', '5', '--storage', args.storage)
+
+        engine = make_engine(make_directory(directory, 'crawl-{count}'.format(count=count)))
+        engine.api_location = api.url
+
+        # latency of every response received by the engine
+        latencies = []
+        engine.session.hooks['response'].append(lambda response, *a, **kw: latencies.append(response.elapsed.total_seconds()))
+
+        print('{rooms} rooms, {pages} pages per area'.format(rooms=count, pages=pages))
+        result = {'rooms': count, 'workers': args.workers, 'latency': args.latency, 'error_rate': args.error_rate, 'overlap': args.overlap}
+        result['crawl'] = measure('get_new_rooms', engine.get_new_rooms, latencies)
+        result['crawl']['rooms_per_second'] = len(engine.rooms) / result['crawl']['seconds']
+        result['crawl'].update(engine.crawl_stats)
+        result['crawled'] = len(engine.rooms)
+
+        # forget the ratings so rate() scores every room
+        for room in engine.rooms.values():
+            room.pop('rated_with', None)
+        result['rate'] = measure('rate', engine.rate)
+        result['rate']['rooms_per_second'] = len(engine.rooms) / result['rate']['seconds']
+        result['rate_unchanged'] = measure('rate (unchanged)', engine.rate)
+
+        result['update'] = measure('update', engine.update, latencies)
+        result['update']['rooms_per_second'] = len(engine.rooms) / result['update']['seconds']
+
+        result['report'] = measure('generate_report', lambda: engine.generate_report(fields=settings.FIELDS, max_range=settings.MAX_RESULTS))
+        result['report_all'] = measure('generate_report (all rooms)', lambda: engine.generate_report(fields=settings.FIELDS, max_range=-1))
+
+        result['server'] = {'requests': api.requests, 'errors': api.errors}
+
+        # the stages share the process, this is the peak of all of them
+        result['peak_memory_mb'] = peak_memory()
+        engine.store.close()
+        api.stop()
+        results.append(result)
+
+    return results
+
+def bench_federation(args, directory):
+    """
+    Crawls a fake SpareRoom API and a fake fixtures site one engine after the
+    other and as a Federation running both at the same time.
+    """
+
+    results = []
+    for count in args.rooms:
+        spareroom_api = FakeSpareRoom(count, latency=args.latency, overlap=args.overlap)
+        fixtures_api = FakeSpareRoom(count, latency=args.latency, overlap=args.overlap, seed=1)
+        spareroom_api.start()
+        fixtures_api.start()
+
+        pages = count // len(AREAS) // 100 + 1
+        configure('--max-rooms', '100', '--max-pages', str(pages), '--workers', str(args.workers), '--storage', args.storage)
+
+        def create_engines(path):
+            spareroom = rooms.SpareRoom(rooms.get_spareroom_preferences(), settings.AREAS, file_name=os.path.join(path, 'spareroom.json'))
+            spareroom.api_location = spareroom_api.url
+            fixtures = rooms.FixtureRooms(rooms.get_spareroom_preferences(), settings.AREAS, file_name=os.path.join(path, 'fixtures.json'))
+            fixtures.api_location = fixtures_api.url
+            return [spareroom, fixtures]
+
+        print('{rooms} rooms on each site'.format(rooms=count))
+        result = {'rooms': count, 'latency': args.latency}
+
+        engines = create_engines(make_directory(directory, 'sequential-{count}'.format(count=count)))
+        result['sequential'] = measure('one engine after the other', lambda: [engine.get_new_rooms() for engine in engines])
+        result['sequential']['found'] = sum(len(engine.rooms) for engine in engines)
+
+        path = make_directory(directory, 'federation-{count}'.format(count=count))
+        federation = rooms.Federation(create_engines(path), rooms.get_spareroom_preferences(), settings.AREAS, file_name=os.path.join(path, 'rooms.json'))
+        result['federation'] = measure('federation', federation.get_new_rooms)
+        result['federation']['found'] = len(federation.rooms)
+
+        for engine in engines + federation.engines + [federation]:
+            engine.store.close()
+        spareroom_api.stop()
+        fixtures_api.stop()
+        results.append(result)
+
+    return results
+
+def bench_hybrid(args, directory):
+    """
+    Compares the requests and the reported rooms of a full crawl and of a
+    hybrid crawl, which only gets the details of the rooms that could make
+    the report. The adverts are available in 2017 and, like in a real
+    search, from a minimum date later than today.
+    """
+
+    later = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=180)
+    scenarios = [
+        ('2017', START, []),
+        ('later', later, ['--min-date', later.strftime('%Y-%m-%d'), '--date', (later + timedelta(days=30)).strftime('%Y-%m-%d')]),
+    ]
+
+    results = []
+    for count in args.rooms:
+        for dates, start, argv in scenarios:
+            api = FakeSpareRoom(count, latency=args.latency, overlap=args.overlap, start=start)
+            api.start()
+
+            pages = count // len(AREAS) // 100 + 1
+            print('{rooms} rooms available from {start}, {results} rooms reported'.format(rooms=count, start=start.strftime('%Y-%m-%d'), results=args.max_results))
+            result = {'rooms': count, 'dates': dates, 'max_results': args.max_results}
+            reported = {}
+            for mode in ('full', 'hybrid'):
+                configure('--max-rooms', '100', '--max-pages', str(pages), '--workers', str(args.workers), '--max-results', str(args.max_results), '--storage', args.storage, *(argv + (['--hybrid'] if mode == 'hybrid' else [])))
+                engine = make_engine(make_directory(directory, '{mode}-{dates}-{count}'.format(mode=mode, dates=dates, count=count)))
+                engine.api_location = api.url
+
+                requests = api.requests
+                result[mode] = measure(mode, engine.get_new_rooms)
+                result[mode]['requests'] = api.requests - requests
+                reported[mode] = [room['id'] for room in engine.top_rooms(args.max_results, engine.get_report_filters())]
+                result[mode]['reported'] = len(reported[mode])
+
+            result['same_rooms'] = len(set(reported['full']) & set(reported['hybrid'])) / float(max(1, len(reported['full'])))
+            result['same_order'] = reported['full'] == reported['hybrid']
+            print('  requests: {full} full, {hybrid} hybrid, {same:.0%} of the {reported} reported rooms found'.format(full=result['full']['requests'], hybrid=result['hybrid']['requests'], same=result['same_rooms'], reported=result['full']['reported']))
+
+            api.stop()
+            results.append(result)
+
+    return results
+
+def bench_query(args, directory):
+    """
+    Times building the room indexes and a query (rent range, availability
+    range and stations, top 20) answered with them and by scanning the rooms.
+    """
+
+    price = (800, 1001)
+    available = (datetime(2017, 5, 10), datetime(2017, 6, 20))
+    stations = ['Brixton', 'Balham']
+
+    def scan(engine):
+        low, high = [rooms.to_epoch(when) for when in available]
+        names = set(station.lower() for station in stations)
+        matches = (room for room in engine.rooms.values() if len(room.prices) and price[0] <= min(room.prices) < price[1] and low <= room.timestamp < high and room.station.lower() in names)
+        return rooms.heapq.nlargest(20, matches, key=lambda room: room['score'])
+
+    results = []
+    for count in args.rooms:
+        engine = make_engine(directory, count)
+        engine.rate_rooms()
+
+        start = time()
+        engine.rooms.get_index()
+        build = time() - start
+
+        start = time()
+        for _ in range(10):
+            found = engine.query(20, price=price, available=available, stations=stations)
+        query = (time() - start) / 10
+
+        start = time()
+        for _ in range(10):
+            expected = scan(engine)
+        scanned = (time() - start) / 10
+
+        result = {
+            'rooms': count,
+            'index_seconds': build,
+            'query_ms': query * 1000,
+            'scan_ms': scanned * 1000,
+            'same_rooms': [room['id'] for room in found] == [room['id'] for room in expected],
+        }
+        results.append(result)
+        print('{rooms} rooms: indexed in {index_seconds:.2f}s, query {query_ms:.1f}ms, scan {scan_ms:.1f}ms'.format(**result))
+
+    return results
+
+def bench_scoring(args, directory):
+    """Compares rate_room called for every room with the batch rate_rooms."""
+
+    results = []
+    for count in args.rooms:
+        engine = make_engine(directory, count)
+
+        start = time()
+        for key in engine.rooms:
+            engine.rate_room(key)
+        serial = time() - start
+        expected = dict((key, room['score']) for key, room in engine.rooms.items())
+
+        start = time()
+        engine.rate_rooms()
+        batch = time() - start
+        difference = max(abs(expected[key] - room['score']) for key, room in engine.rooms.items())
+
+        results.append({
+            'rooms': count,
+            'rate_room': serial,
+            'rate_rooms': batch,
+            'speedup': serial / batch if batch else None,
+            'max_difference': difference,
+            'numpy': rooms.numpy is not None,
+        })
+        print('{rooms} rooms: rate_room {rate_room:.3f}s, rate_rooms {rate_rooms:.3f}s, max difference {max_difference:.2e}'.format(**results[-1]))
+
+    return results
+
+def bench_records(args, directory):
+    """
+    Compares the memory and load time of rooms kept as the dictionaries of
+    the json database with the Room records, and times parse_room_info.
+    """
+
+    results = []
+    for count in args.rooms:
+        engine = make_engine(directory)
+        rnd = random.Random(0)
+        text = json.dumps(dict((str(room_id), generate_room(str(room_id), rnd)) for room_id in range(1000000, 1000000 + count)))
+
+        file_name = os.path.join(directory, 'records-{count}.json'.format(count=count))
+        with open(file_name, 'w') as f:
+            f.write(text)
+
+        def load_dicts():
+            with open(file_name, 'r') as f:
+                return json.loads(f.read())
+
+        # records are loaded like the json database is
+        dicts, dicts_seconds, dicts_memory = allocated(load_dicts)
+        del dicts
+        records, records_seconds, records_memory = allocated(rooms.JSONRoomStore(file_name).load)
+        del records
+
+        responses = [json.dumps({'advert_summary': advert}) for advert in generate_adverts(count)]
+        start = time()
+        for advert_id, response in enumerate(responses):
+            engine.parse_room_info(advert_id, 'Brixton', response)
+        parse_seconds = time() - start
+
+        result = {
+            'rooms': count,
+            'dict_bytes_per_room': dicts_memory / float(count) if dicts_memory is not None else None,
+            'record_bytes_per_room': records_memory / float(count) if records_memory is not None else None,
+            'dict_load_seconds': dicts_seconds,
+            'record_load_seconds': records_seconds,
+            'parse_seconds': parse_seconds,
+        }
+        results.append(result)
+        print('{rooms} rooms: load {dict_load_seconds:.2f}s as dicts, {record_load_seconds:.2f}s as records, parse_room_info {parse_seconds:.2f}s'.format(**result))
+        if tracemalloc is not None:
+            print('  bytes per room: {dict_bytes_per_room:.0f} as dicts, {record_bytes_per_room:.0f} as records'.format(**result))
+
+    return results
+
+def bench_snapshot(args, directory):
+    """
+    Times starting, re-rating and reporting an unchanged database of count
+    rooms loading all the rooms and reading the binary snapshot instead.
+    """
+
+    results = []
+    for count in args.rooms:
+        path = make_directory(directory, 'snapshot-{count}'.format(count=count))
+        configure('--storage', args.storage, '--snapshot')
+        engine = make_engine(path, count)
+        engine.rate_rooms()
+        engine.update_snapshot()
+        engine.store.close()
+
+        def rate_and_report():
+            engine = make_engine(path)
+            engine.rate()
+            engine.generate_report(fields=settings.FIELDS, max_range=settings.MAX_RESULTS)
+            engine.store.close()
+
+        print('{rooms} rooms'.format(rooms=count))
+        result = {'rooms': count, 'storage': args.storage}
+        configure('--storage', args.storage)
+        result['load'] = measure('rate and report', rate_and_report)
+        configure('--storage', args.storage, '--snapshot')
+        result['snapshot'] = measure('rate and report (snapshot)', rate_and_report)
+        results.append(result)
+
+    return results
+
+def make_database(path, count):
+    """Saves count rated rooms in a sqlite database in path."""
+
+    configure('--storage', 'sqlite')
+    engine = make_engine(path, count)
+    engine.rate_rooms()
+    engine.save_rooms()
+    engine.store.close()
+
+def rate_and_report_in(path, argv):
+    """
+    Re-rates and reports the database in path with the settings of argv,
+    returns the seconds it took and the peak memory of the process.
+    """
+
+    configure(*argv)
+    start = time()
+    engine = make_engine(path)
+    engine.rate()
+    engine.generate_report(fields=settings.FIELDS, max_range=settings.MAX_RESULTS, output_format='jsonl')
+    engine.store.close()
+    return time() - start, peak_memory()
+
+def bench_chunked(args, directory):
+    """
+    Compares the peak memory of re-rating and reporting a sqlite database of
+    count rooms loaded at once and read in batches of --chunk-size rooms.
+    Each step is a new process, the peak memory of a process is kept across
+    exec so the rooms are not generated in this one either.
+    """
+
+    context = multiprocessing.get_context('spawn')
+    results = []
+    for count in args.rooms:
+        path = make_directory(directory, 'chunked-{count}'.format(count=count))
+        with context.Pool(1) as pool:
+            pool.apply(make_database, (path, count))
+
+        result = {'rooms': count, 'chunk_size': args.chunk_size}
+        for name, chunk_size in (('load', 0), ('chunked', args.chunk_size)):
+            run_path = make_directory(directory, 'chunked-{count}-{name}'.format(count=count, name=name))
+            shutil.copy(os.path.join(path, 'spareroom.db'), run_path)
+            argv = ['--storage', 'sqlite', '--rent', '900', '--chunk-size', str(chunk_size)]
+            with context.Pool(1) as pool:
+                seconds, memory = pool.apply(rate_and_report_in, (run_path, argv))
+            with open(os.path.join(run_path, 'spareroom.jsonl'), 'r') as f:
+                report = [json.loads(line)['score'] for line in f]
+            result[name] = {'seconds': seconds, 'peak_memory_mb': memory, 'report': report}
+
+        # rooms with the same score may be reported in another order
+        result['same_scores'] = result['load'].pop('report') == result['chunked'].pop('report')
+        results.append(result)
+        print('{rooms} rooms: peak memory {load:.0f}MB loaded, {chunked:.0f}MB in batches of {chunk_size} ({load_seconds:.2f}s and {chunked_seconds:.2f}s)'.format(rooms=count, chunk_size=args.chunk_size, load=result['load']['peak_memory_mb'] or 0, chunked=result['chunked']['peak_memory_mb'] or 0, load_seconds=result['load']['seconds'], chunked_seconds=result['chunked']['seconds']))
+
+    return results
+
+BENCHMARKS = {
+    'chunked': bench_chunked,
+    'crawl': bench_crawl,
+    'federation': bench_federation,
+    'hybrid': bench_hybrid,
+    'query': bench_query,
+    'records': bench_records,
+    'snapshot': bench_snapshot,
+    'scoring': bench_scoring,
+}
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', help='Benchmarks to run (default: all)', nargs='*', choices=[[]] + sorted(BENCHMARKS), default=[])
+    parser.add_argument('-n', '--rooms', help='Number of generated rooms (default: 10000)', type=int, nargs='+', default=[10000])
+    parser.add_argument('-l', '--latency', help='Seconds the fake API takes to answer (default: 0)', type=float, default=0.0)
+    parser.add_argument('-e', '--error-rate', help='Ratio of fake API requests failing with 503 (default: 0)', type=float, default=0.0)
+    parser.add_argument('-v', '--overlap', help='Ratio of fake adverts also listed in the next area (default: 0)', type=float, default=0.0)
+    parser.add_argument('-s', '--storage', help='Room database backend of the crawl benchmark (default: sqlite)', choices=['sqlite', 'json'], default='sqlite')
+    parser.add_argument('-k', '--max-results', help='Rooms in the report of the hybrid benchmark (default: 20)', type=int, default=20)
+    parser.add_argument('-c', '--chunk-size', help='Rooms in each batch of the chunked benchmark (default: 1000)', type=int, default=1000)
+    parser.add_argument('-w', '--workers', help='Threads fetching room details (default: 8)', type=int, default=8)
+    parser.add_argument('-o', '--output', help='Write the results to this json file', type=str, default=None)
+    args = parser.parse_args()
+
+    configure()
+
+    results = {'version': rooms.VERSION, 'date': str(datetime.now())}
+    directory = tempfile.mkdtemp(prefix='roomfinder-')
+    try:
+        for name in args.benchmarks or sorted(BENCHMARKS):
+            print('Running {name} benchmark'.format(name=name))
+            results[name] = BENCHMARKS[name](args, directory)
+    finally:
+        shutil.rmtree(directory)
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            f.write(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
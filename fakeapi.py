@@ -0,0 +1,312 @@
+#!/usr/bin/env python
+"""
+Local stand-in for the SpareRoom iPhone API, serving the flatshares search and
+flatshares/{id}?format=json details endpoints from generated or recorded
+adverts. Used by the benchmarks so they never touch SpareRoom.
+
+The same adverts are served as stored rooms by the rooms?area=... search and
+rooms/{id} endpoints, the site of the FixtureRooms engine, and their photos
+as grey images by the images/ endpoint. Responses carry an ETag and are
+answered with a 304 when the client already has them.
+
+python fakeapi.py --rooms 1000 --latency 0.05 --port 8000
+"""
+from datetime import datetime, timedelta
+from time import sleep
+import argparse
+import hashlib
+import struct
+import zlib
+import threading
+import random
+import json
+
+try:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
+    from urlparse import urlparse, parse_qs
+
+AREAS = ["Earl's Court", 'Wimbledon', 'Wimbledon Park', 'Brixton', 'Clapham']
+
+# first availability date of the generated adverts
+START = datetime(2017, 5, 1)
+
+def generate_advert(advert_id, area, rnd, start=START):
+    """Returns the advert_summary of a details response, available within 90 days of start."""
+
+    price = rnd.randint(400, 1400)
+    occupants = rnd.randint(1, 6)
+    available = start + timedelta(days=rnd.randint(0, 90))
+    return {
+        'advert_id': str(advert_id),
+        'area': area,
+        'bills_inc': rnd.choice(['Yes', 'No']),
+        'nearest_station': {'station_name': rnd.choice(AREAS + ['Balham', 'Putney'])},
+        'photos': [{'large_url': 'http://localhost/{id}/{n}.jpg'.format(id=advert_id, n=n)} for n in range(rnd.randint(0, 8))],
+        'available': 'Now' if rnd.random() < 0.1 else available.strftime('%d %b %Y'),
+        'number_of_females': rnd.randint(0, occupants),
+        'number_of_males': rnd.randint(0, occupants),
+        'rooms_in_property': rnd.randint(1, 7),
+        'occupants': occupants,
+        'days_of_wk_available': '7 days a week' if rnd.random() < 0.95 else 'Mon to Fri only',
+        'rooms': [{
+            'security_deposit': str(price + rnd.randint(0, 300)),
+            'room_price': str(price),
+            'room_per': 'pcm',
+        }],
+    }
+
+def generate_adverts(count, areas=AREAS, seed=0, start=START):
+    """Returns count adverts spread evenly over the areas."""
+
+    rnd = random.Random(seed)
+    return [generate_advert(2000000 + n, areas[n % len(areas)], rnd, start) for n in range(count)]
+
+def get_listing(advert):
+    """Returns the search results entry of an advert."""
+
+    listing = {
+        'advert_id': advert['advert_id'],
+        'min_rent': '{price}.00'.format(price=advert['rooms'][0]['room_price']),
+        'max_rent': '{price}.00'.format(price=advert['rooms'][0]['room_price']),
+        'per': 'pcm',
+        'bills_inc': advert['bills_inc'],
+        'rooms_in_property': advert['rooms_in_property'],
+        'station_name': advert['nearest_station']['station_name'],
+        'days_of_wk_available': advert['days_of_wk_available'],
+    }
+    if advert['photos']:
+        listing['main_image_square_url'] = advert['photos'][0]['large_url']
+    return listing
+
+def make_png(width, height, shade):
+    """Returns a grey PNG image, served as the photos of the adverts."""
+
+    def chunk(kind, data):
+        return struct.pack('>I', len(data)) + kind + data + struct.pack('>I', zlib.crc32(kind + data) & 0xffffffff)
+
+    rows = b''.join(b'\x00' + bytes(bytearray([shade % 256] * width)) for _ in range(height))
+    return b'\x89PNG\r\n\x1a\n' + chunk(b'IHDR', struct.pack('>IIBBBBB', width, height, 8, 0, 0, 0, 0)) + chunk(b'IDAT', zlib.compress(rows)) + chunk(b'IEND', b'')
+
+def get_room(advert):
+    """Returns an advert as the rooms endpoints serve it, with the fields of a stored room."""
+
+    available = datetime.now() if advert['available'] == 'Now' else datetime.strptime(advert['available'], '%d %b %Y')
+    return {
+        'id': advert['advert_id'],
+        'images': [photo['large_url'] for photo in advert['photos']],
+        'station': advert['nearest_station']['station_name'],
+        'prices': [int(room['room_price']) for room in advert['rooms']],
+        'available': advert['available'],
+        'timestamp': str(available),
+        'deposits': [int(room['security_deposit']) for room in advert['rooms']],
+        'bills': advert['bills_inc'] == 'Yes',
+        'rooms': advert['rooms_in_property'],
+        'housemates': advert['occupants'],
+        'females': advert['number_of_females'],
+        'males': advert['number_of_males'],
+        'phone': False,
+    }
+
+class FakeSpareRoom(object):
+    """
+    Threaded HTTP server answering like the SpareRoom API. Every request
+    waits latency seconds and fails with a 503 with error_rate probability.
+    """
+
+    def __init__(self, rooms=1000, areas=AREAS, latency=0.0, error_rate=0.0, fixtures=None, seed=0, port=0, overlap=0.0, start=START):
+        """
+        Create a FakeSpareRoom object.
+
+        rooms -- number of generated adverts
+        areas -- areas the generated adverts are spread over
+        latency -- seconds added to every response
+        error_rate -- ratio of requests answered with 503
+        fixtures -- json file with a list of recorded advert_summary objects
+                    (with an extra area key), used instead of generated ones
+        seed -- seed of the generated adverts and errors
+        port -- port to listen on (default: any free port)
+        overlap -- ratio of adverts also listed in the next area, like
+                   neighbouring areas sharing adverts
+        start -- first availability date of the generated adverts
+        """
+
+        if fixtures:
+            with open(fixtures, 'r') as f:
+                adverts = json.loads(f.read())
+        else:
+            adverts = generate_adverts(rooms, areas, seed, start)
+
+        self.latency = latency
+        self.error_rate = error_rate
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.requests = 0
+        self.errors = 0
+        self.not_modified = 0
+
+        self.adverts = dict((advert['advert_id'], advert) for advert in adverts)
+        self.areas = {}
+        for advert in adverts:
+            self.areas.setdefault(advert['area'].lower(), []).append(advert)
+
+        names = sorted(self.areas)
+        for advert in adverts:
+            if overlap and self.random.random() < overlap:
+                self.areas[names[(names.index(advert['area'].lower()) + 1) % len(names)]].append(advert)
+
+        # newest first, like the incremental crawls ask for
+        for area_adverts in self.areas.values():
+            area_adverts.reverse()
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', port), FakeSpareRoomHandler)
+        self.server.api = self
+        self.thread = None
+
+        # the generated photos are served by the fake API too
+        for advert in adverts:
+            for photo in advert.get('photos', []):
+                if photo['large_url'].startswith('http://localhost/'):
+                    photo['large_url'] = photo['large_url'].replace('http://localhost/', self.url + '/images/', 1)
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:{port}'.format(port=self.server.server_address[1])
+
+    def start(self):
+        """Serves requests in a background thread, returns the server url."""
+
+        self.thread = threading.Thread(target=self.server.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self.url
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def respond(self, path):
+        """Returns the status and the json body answering a request path, the image bytes for images."""
+
+        with self.lock:
+            self.requests += 1
+            failed = self.random.random() < self.error_rate
+            if failed:
+                self.errors += 1
+
+        if self.latency:
+            sleep(self.latency)
+        if failed:
+            return 503, {'error': 'Service unavailable'}
+
+        url = urlparse(path)
+        query = parse_qs(url.query)
+        parts = url.path.strip('/').split('/')
+
+        if parts[0] == 'images':
+            return 200, make_png(640, 480, sum(bytearray(url.path.encode('utf-8'))))
+
+        if parts[0] == 'rooms':
+            return self.respond_rooms(parts, query)
+
+        if len(parts) == 2:
+            advert = self.adverts.get(parts[1])
+            if advert is None:
+                return 404, {'error': 'Advert not found'}
+            return 200, {'advert_summary': advert}
+
+        adverts = self.areas.get(query.get('where', [''])[0], [])
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('max_per_page', ['10'])[0])
+        pages = max(1, (len(adverts) + per_page - 1) // per_page)
+        return 200, {
+            'page': page,
+            'pages': pages,
+            'count': len(adverts),
+            'results': [get_listing(advert) for advert in adverts[(page - 1) * per_page:page * per_page]],
+        }
+
+    def respond_rooms(self, parts, query):
+        """Answers the rooms endpoints, the adverts given as stored rooms."""
+
+        if len(parts) == 2:
+            advert = self.adverts.get(parts[1])
+            if advert is None:
+                return 404, {'error': 'Room not found'}
+            return 200, get_room(advert)
+
+        adverts = self.areas.get(query.get('area', [''])[0].lower(), [])
+        page = int(query.get('page', ['1'])[0])
+        per_page = int(query.get('per_page', ['10'])[0])
+        pages = max(1, (len(adverts) + per_page - 1) // per_page)
+        return 200, {
+            'page': page,
+            'pages': pages,
+            'count': len(adverts),
+            'rooms': [get_room(advert) for advert in adverts[(page - 1) * per_page:page * per_page]],
+        }
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FakeSpareRoomHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    # headers and body are written separately, without this every keep-alive
+    # response waits for a delayed ack
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        status, body = self.server.api.respond(self.path)
+        if isinstance(body, bytes):
+            data, content_type = body, 'image/png'
+        else:
+            data, content_type = json.dumps(body).encode('utf-8'), 'application/json'
+
+        etag = '"{hash}"'.format(hash=hashlib.sha1(data).hexdigest())
+        if status == 200 and self.headers.get('If-None-Match') == etag:
+            with self.server.api.lock:
+                self.server.api.not_modified += 1
+            self.send_response(304)
+            self.send_header('ETag', etag)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+
+        self.send_response(status)
+        if status == 200:
+            self.send_header('ETag', etag)
+        self.send_header('Content-Type', content_type)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        pass
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('-n', '--rooms',      help='Number of generated adverts (default: 1000)',       default=1000, type=int)
+    parser.add_argument('-l', '--latency',    help='Seconds added to every response (default: 0)',      default=0.0,  type=float)
+    parser.add_argument('-e', '--error-rate', help='Ratio of requests failing with 503 (default: 0)',   default=0.0,  type=float)
+    parser.add_argument('-x', '--fixtures',   help='Json file with recorded adverts',                   default=None, type=str)
+    parser.add_argument('-o', '--overlap',    help='Ratio of adverts also listed in the next area',     default=0.0,  type=float)
+    parser.add_argument('-s', '--seed',       help='Seed of the generated adverts (default: 0)',        default=0,    type=int)
+    parser.add_argument('-p', '--port',       help='Port to listen on (default: 8000)',                 default=8000, type=int)
+    parser.add_argument('-d', '--start',      help='First availability date (default: 2017-05-01)',     default=None, type=str)
+    args = parser.parse_args()
+
+    start = datetime.strptime(args.start, '%Y-%m-%d') if args.start else START
+    api = FakeSpareRoom(args.rooms, latency=args.latency, error_rate=args.error_rate, fixtures=args.fixtures, seed=args.seed, port=args.port, overlap=args.overlap, start=start)
+    print('Serving {count} adverts on {url}'.format(count=len(api.adverts), url=api.url))
+    try:
+        api.server.serve_forever()
+    except KeyboardInterrupt:
+        api.stop()
+
+if __name__ == "__main__":
+    main()
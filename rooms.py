@@ -1,11 +1,57 @@
 #!/usr/bin/env python
-from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+import multiprocessing
+from datetime import datetime, timedelta
 from pprint import pprint
-from sys import argv, exit
-from time import sleep
+from contextlib import contextmanager
+from sys import byteorder
+import sys
+from time import sleep, time
+import threading
+import functools
+import cProfile
 import requests
+import hashlib
 import logging
+import heapq
+import gc
+import sqlite3
+import struct
+import mmap
 import json
+import tempfile
+import shutil
+import csv
+import io
+import os
+
+from array import array
+from bisect import bisect_left, insort
+
+# numpy speeds up batch scoring but is optional
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Pillow makes the report thumbnails small but is optional
+try:
+    from PIL import Image
+except ImportError:
+    Image = None
+
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    from urllib.parse import urlparse
+except ImportError:
+    from urlparse import urlparse
+
+try:
+    from queue import Queue
+except ImportError:
+    from Queue import Queue
 
 # argparser
 import argparse
@@ -14,154 +60,2574 @@ import traceback
 
 # local settings
 from types import ModuleType
+
+try:
+    from sys import intern
+except ImportError:
+    pass
 settings = ModuleType("settings")
 
-VERSION = "0.2.0"
+VERSION = "0.2.0"
+
+# reference for the availability timestamps turned into seconds
+EPOCH = datetime(1970, 1, 1)
+
+def parse_timestamp(timestamp):
+    """Parses the str(datetime) timestamps stored in the rooms."""
+
+    # fromisoformat (python 3.7+) is much faster than strptime
+    if hasattr(datetime, 'fromisoformat'):
+        return datetime.fromisoformat(timestamp)
+    return datetime.strptime(timestamp, "%Y-%m-%d %H:%M:%S.%f" if '.' in timestamp else "%Y-%m-%d %H:%M:%S")
+
+# parsed availability dates, few distinct dates are shared by many rooms
+available_dates = {}
+
+def parse_available(available):
+    """Parses the availability date of a room (Format: 01 Jun 2017)."""
+
+    if available not in available_dates:
+        if len(available_dates) > 10000:
+            available_dates.clear()
+        available_dates[available] = datetime.strptime(available, "%d %b %Y")
+    return available_dates[available]
+
+def to_epoch(timestamp):
+    """Returns the whole seconds since EPOCH of a datetime or str(datetime) timestamp."""
+
+    if isinstance(timestamp, datetime):
+        return int((timestamp - EPOCH).total_seconds())
+    if isinstance(timestamp, (int, float)):
+        return int(timestamp)
+    return int((parse_timestamp(timestamp) - EPOCH).total_seconds())
+
+def from_epoch(seconds):
+    """Returns the datetime of a number of seconds since EPOCH."""
+
+    return EPOCH + timedelta(seconds=seconds)
+
+@contextmanager
+def gc_paused():
+    """
+    Pauses the cyclic garbage collector while the rooms are loaded. None of
+    the objects created is garbage, but every collection would go through
+    all the rooms loaded so far.
+    """
+
+    enabled = gc.isenabled()
+    gc.disable()
+    try:
+        yield
+    finally:
+        if enabled:
+            gc.enable()
+
+def to_amounts(values):
+    """Returns prices or deposits as an array of whole pounds, leaving out missing values."""
+
+    # whole pounds already, the common case
+    try:
+        return array('i', values or [])
+    except (TypeError, OverflowError):
+        pass
+
+    amounts = array('i')
+    for value in values:
+        try:
+            amounts.append(int(float(value)))
+        except (TypeError, ValueError):
+            continue
+    return amounts
+
+class NotFound(IOError):
+    """Raised when the server answers that a resource does not exist any more (404 or 410)."""
+
+class Unreachable(IOError):
+    """
+    Raised when a request gets no answer from the server: the network
+    failed, the request budget ran out or only cached responses are used.
+    """
+
+class ServerError(IOError):
+    """Raised when the server still answers with an error status (4xx or 5xx) after the retries."""
+
+class RateLimiter(object):
+    """
+    Token bucket used to space the requests made to a host. A single limiter
+    is shared by all the threads fetching from that host.
+    """
+
+    def __init__(self, rate=1.0, burst=1):
+        """
+        Create a RateLimiter object.
+
+        rate -- requests per second allowed (0 disables the limiter)
+        burst -- number of requests that can be made without waiting
+        """
+
+        self.rate = float(rate)
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time()
+        self.lock = threading.Lock()
+
+    def wait(self):
+        """Blocks until the caller is allowed to make a request."""
+
+        if self.rate <= 0:
+            return
+
+        # reserve a token while holding the lock and sleep outside of it, so
+        # waiting threads queue up in the order they asked
+        with self.lock:
+            now = time()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= 1
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+
+        if delay > 0:
+            if settings.DEBUG:
+                print('Sleeping for {secs:.2f} seconds'.format(secs=delay))
+            sleep(delay)
+
+class SharedRateLimiter(RateLimiter):
+    """
+    RateLimiter whose bucket is kept in shared memory, so the threads of
+    several processes together keep to the rate of a single limiter.
+    """
+
+    def __init__(self, bucket, rate=1.0, burst=1):
+        """
+        Create a SharedRateLimiter object.
+
+        bucket -- multiprocessing.Array('d', [tokens, updated]) shared by the
+                  processes, created with SharedRateLimiter.create_bucket
+        rate -- requests per second allowed (0 disables the limiter)
+        burst -- number of requests that can be made without waiting
+        """
+
+        self.rate = float(rate)
+        self.burst = burst
+        self.bucket = bucket
+        self.lock = bucket.get_lock()
+
+    @staticmethod
+    def create_bucket(burst=1):
+        """Returns a full bucket to share between processes."""
+
+        return multiprocessing.Array('d', [float(burst), time()])
+
+    @property
+    def tokens(self):
+        return self.bucket[0]
+
+    @tokens.setter
+    def tokens(self, tokens):
+        self.bucket[0] = tokens
+
+    @property
+    def updated(self):
+        return self.bucket[1]
+
+    @updated.setter
+    def updated(self, updated):
+        self.bucket[1] = updated
+
+class Metrics(object):
+    """
+    Timers and counters of a SearchEngine run, shared by all its threads.
+    Timers are inclusive: the time of get_room_info includes the time of the
+    make_get_request it calls.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time()
+
+        # name -> [calls, seconds, slowest call]
+        self.timers = {}
+        self.counters = {}
+
+    @contextmanager
+    def timer(self, name):
+        """Times the code run inside the with block."""
+
+        start = time()
+        try:
+            yield
+        finally:
+            self.add_time(name, time() - start)
+
+    def add_time(self, name, seconds, calls=1):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0, 0.0])
+            timer[0] += calls
+            timer[1] += seconds
+            timer[2] = max(timer[2], seconds / calls if calls else 0.0)
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def merge(self, summary):
+        """Adds the timers and counters of another run summary, e.g. a crawl worker's."""
+
+        for name, timer in summary['timers'].items():
+            with self.lock:
+                current = self.timers.setdefault(name, [0, 0.0, 0.0])
+                current[0] += timer['calls']
+                current[1] += timer['seconds']
+                current[2] = max(current[2], timer['max'])
+        for name, value in summary['counters'].items():
+            self.count(name, value)
+
+    def summary(self):
+        """Returns the timers and counters as a dictionary that can be dumped to json."""
+
+        with self.lock:
+            timers = dict((name, {
+                'calls': calls,
+                'seconds': seconds,
+                'mean': seconds / calls if calls else 0.0,
+                'max': slowest,
+            }) for name, (calls, seconds, slowest) in self.timers.items())
+            counters = dict(self.counters)
+
+        return {'elapsed': time() - self.started, 'timers': timers, 'counters': counters}
+
+    def write_file(self, file_name, text):
+        """Replaces file_name with text atomically."""
+
+        tmp = '{name}.tmp'.format(name=file_name)
+        with open(tmp, 'w') as f:
+            f.write(text)
+        os.rename(tmp, file_name)
+
+    def write_json(self, file_name, **extra):
+        """Writes the summary, updated with extra, to a json file."""
+
+        summary = self.summary()
+        summary.update(extra)
+        self.write_file(file_name, json.dumps(summary, indent=2, sort_keys=True))
+
+    def write_prometheus(self, file_name, labels=None):
+        """
+        Writes the metrics in the Prometheus text format. The file is replaced
+        atomically so the node exporter textfile collector never reads half of it.
+
+        labels -- labels added to every sample, e.g. {'engine': 'SpareRoom'}
+        """
+
+        def sample(name, value, **extra):
+            values = dict(labels or {}, **extra)
+            label = ','.join('{key}="{value}"'.format(key=key, value=str(values[key]).replace('\\', '\\\\').replace('"', '\\"')) for key in sorted(values))
+            return '{name}{{{label}}} {value}'.format(name=name, label=label, value=value if isinstance(value, int) else repr(float(value)))
+
+        summary = self.summary()
+        lines = [
+            '# HELP roomfinder_run_seconds Duration of the run.',
+            '# TYPE roomfinder_run_seconds gauge',
+            sample('roomfinder_run_seconds', summary['elapsed']),
+            '# HELP roomfinder_stage_seconds Time spent in each stage of the run.',
+            '# TYPE roomfinder_stage_seconds summary',
+        ]
+        for name in sorted(summary['timers']):
+            lines.append(sample('roomfinder_stage_seconds_sum', summary['timers'][name]['seconds'], stage=name))
+            lines.append(sample('roomfinder_stage_seconds_count', summary['timers'][name]['calls'], stage=name))
+        lines += [
+            '# HELP roomfinder_events_total Requests, cache hits, errors and rooms skipped in the run.',
+            '# TYPE roomfinder_events_total counter',
+        ]
+        for name in sorted(summary['counters']):
+            lines.append(sample('roomfinder_events_total', summary['counters'][name], event=name))
+
+        self.write_file(file_name, '\n'.join(lines) + '\n')
+
+def timed(name):
+    """Decorates a SearchEngine method so its calls are timed in self.metrics."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.timer(name):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+class Stage(object):
+    """
+    Step of a Pipeline: worker threads taking items from a bounded queue and
+    passing on whatever function returns (None drops the item). A full queue
+    blocks the previous stage, so no stage can run too far ahead.
+    """
+
+    def __init__(self, name, function, workers=1, size=100, flush=None):
+        """
+        Create a Stage object.
+
+        name -- name shown in the statistics
+        function -- called with every item, returns the item for the next stage
+        workers -- number of threads running function
+        size -- maximum number of items waiting in the queue
+        flush -- called once all the items have been processed
+        """
+
+        self.name = name
+        self.function = function
+        self.workers = workers
+        self.flush = flush
+        self.queue = Queue(size)
+        self.next = None
+
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.busy = 0.0
+        self.max_depth = 0
+
+    def put(self, item):
+        self.queue.put(item)
+        depth = self.queue.qsize()
+        if depth > self.max_depth:
+            self.max_depth = depth
+
+    def work(self):
+        while True:
+            item = self.queue.get()
+            if item is Pipeline.STOP:
+                return
+
+            start = time()
+            try:
+                result = self.function(item)
+            except Exception as e:
+                logging.error('{stage} failed: {message}'.format(stage=self.name, message=e), extra={'engine': 'Pipeline', 'function': self.name})
+                result = None
+
+            with self.lock:
+                self.processed += 1
+                self.busy += time() - start
+
+            if result is not None and self.next is not None:
+                self.next.put(result)
+
+class Pipeline(object):
+    """Stages connected by bounded queues, each one running in its own threads."""
+
+    STOP = object()
+
+    def __init__(self, stages):
+        self.stages = stages
+        for stage, next_stage in zip(stages, stages[1:]):
+            stage.next = next_stage
+        self.elapsed = 0.0
+
+    def run(self, items):
+        """Feeds the items to the first stage and waits for all of them to go through."""
+
+        start = time()
+        threads = []
+        for stage in self.stages:
+            threads.append([threading.Thread(target=stage.work) for _ in range(stage.workers)])
+            for thread in threads[-1]:
+                thread.daemon = True
+                thread.start()
+
+        for item in items:
+            self.stages[0].put(item)
+
+        # stop the stages in order, once a stage is done the next one has all its items
+        for stage, workers in zip(self.stages, threads):
+            for _ in workers:
+                stage.queue.put(Pipeline.STOP)
+            for thread in workers:
+                thread.join()
+            if stage.flush is not None:
+                stage.flush()
+
+        self.elapsed = time() - start
+
+    def stats(self):
+        """Returns the items processed, throughput and queue depth of every stage."""
+
+        return [{
+            'stage': stage.name,
+            'processed': stage.processed,
+            'per_second': stage.processed / self.elapsed if self.elapsed else 0,
+            'busy': stage.busy,
+            'max_depth': stage.max_depth,
+            'depth': stage.queue.qsize(),
+        } for stage in self.stages]
+
+class AreaScheduler(object):
+    """
+    Decides when each area is searched again in watch mode. Areas that had
+    new adverts in their recent searches are searched more often and quiet
+    ones less: an area is searched every 2 * interval / (1 + recent) seconds,
+    recent being the decaying average of the new adverts found per search,
+    but never more often than interval * min_ratio or less than interval *
+    max_ratio.
+    """
+
+    min_ratio = 0.125
+    max_ratio = 4.0
+
+    # weight of the older searches in the recent average
+    decay = 0.5
+
+    def __init__(self, areas, interval=900, state=None):
+        """
+        Create an AreaScheduler object, every area due now.
+
+        areas -- areas to search
+        interval -- seconds between the searches of an area with one new
+                    advert per search
+        state -- dictionary the recent averages are kept in, e.g. to save
+                 them with the crawl state
+        """
+
+        self.interval = float(interval)
+        self.state = state if state is not None else {}
+        self.due = dict((area, time()) for area in areas)
+        self.areas = list(areas)
+
+    def get_interval(self, area):
+        recent = self.state.get(area, {}).get('recent', 1.0)
+        interval = 2 * self.interval / (1 + recent)
+        return min(max(interval, self.interval * self.min_ratio), self.interval * self.max_ratio)
+
+    def next(self):
+        """Returns the area due first and the seconds left until it is due."""
+
+        area = min(self.areas, key=lambda area: self.due[area])
+        return area, max(0, self.due[area] - time())
+
+    def record(self, area, new):
+        """Records the new adverts found searching an area, returns the seconds until its next search."""
+
+        recent = self.state.get(area, {}).get('recent', 1.0)
+        self.state[area] = {'recent': self.decay * recent + (1 - self.decay) * new}
+
+        interval = self.get_interval(area)
+        self.state[area]['interval'] = interval
+        self.due[area] = time() + interval
+        return interval
+
+class ResponseCache(object):
+    """
+    On-disk cache of response bodies keyed by url. Every entry is a json file
+    named after the url hash, its modification time is bumped on every hit so
+    the least recently used entries are evicted once the cache grows over
+    max_size bytes.
+    """
+
+    extension = '.json'
+
+    def __init__(self, directory='.cache', max_size=100 * 1024 * 1024):
+        """
+        Create a ResponseCache object.
+
+        directory -- directory to store the cached responses in
+        max_size -- maximum size of the cache in bytes
+        """
+
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+
+        self.hits = 0
+        self.misses = 0
+        self.revalidated = 0
+
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+        self.size = sum(os.path.getsize(path) for path in self.entries())
+
+    def entries(self):
+        """Returns the paths of all the cached entries."""
+
+        return [os.path.join(self.directory, name) for name in os.listdir(self.directory) if name.endswith(self.extension)]
+
+    def path(self, url):
+        return os.path.join(self.directory, hashlib.sha1(url.encode('utf-8')).hexdigest() + self.extension)
+
+    def get(self, url):
+        """Returns the cached entry of the url or None if it is not cached."""
+
+        path = self.path(url)
+        try:
+            with open(path, 'r') as f:
+                entry = json.loads(f.read())
+            os.utime(path, None)
+        except (IOError, OSError, ValueError):
+            return None
+
+        return entry if entry.get('url') == url else None
+
+    def put(self, url, body, etag=None, last_modified=None):
+        """Caches a response body and evicts old entries if needed."""
+
+        path = self.path(url)
+        data = json.dumps({
+            'url': url,
+            'body': body,
+            'etag': etag,
+            'last_modified': last_modified,
+            'fetched': time(),
+        })
+        self.write(path, data)
+
+    def write(self, path, data):
+        """Writes an entry, text or bytes, and evicts old entries if needed."""
+
+        with self.lock:
+            previous = os.path.getsize(path) if os.path.exists(path) else 0
+
+            # write to a temporary file first so readers never see half an entry
+            tmp = '{path}.{pid}.{thread}.tmp'.format(path=path, pid=os.getpid(), thread=threading.current_thread().ident)
+            with open(tmp, 'wb' if isinstance(data, bytes) else 'w') as f:
+                f.write(data)
+            os.rename(tmp, path)
+
+            self.size += os.path.getsize(path) - previous
+            if self.size > self.max_size:
+                self.evict()
+
+    def evict(self):
+        """Removes the least recently used entries until the cache fits in 90% of max_size."""
+
+        entries = []
+        for path in self.entries():
+            try:
+                entries.append((os.path.getmtime(path), os.path.getsize(path), path))
+            except OSError:
+                continue
+
+        self.size = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if self.size <= self.max_size * 0.9:
+                break
+            try:
+                os.remove(path)
+                self.size -= size
+            except OSError:
+                continue
+
+class ImageCache(ResponseCache):
+    """
+    On-disk cache of the room images shown in the reports, a thumbnail per
+    image named after the hash of its url, so an image shown by several
+    rooms or reports is only downloaded once. Without Pillow the images are
+    kept as they are downloaded.
+    """
+
+    extension = '.jpg'
+
+    # largest side of the thumbnails in pixels
+    thumbnail_size = 200
+
+    def get(self, url):
+        """Returns the path of the thumbnail of the url or None if it is not cached."""
+
+        path = self.path(url)
+        try:
+            os.utime(path, None)
+        except OSError:
+            return None
+        return path
+
+    def put(self, url, data):
+        """Caches the thumbnail of a downloaded image, returns its path."""
+
+        path = self.path(url)
+        self.write(path, self.make_thumbnail(data))
+        return path
+
+    def make_thumbnail(self, data):
+        """Returns the image data scaled down to thumbnail_size as a jpeg."""
+
+        if Image is None:
+            return data
+
+        try:
+            image = Image.open(io.BytesIO(data))
+            image.thumbnail((self.thumbnail_size, self.thumbnail_size))
+            if image.mode != 'RGB':
+                image = image.convert('RGB')
+            thumbnail = io.BytesIO()
+            image.save(thumbnail, 'JPEG', quality=80)
+            return thumbnail.getvalue()
+        except (IOError, ValueError):
+            return data
+
+class Room(object):
+    """
+    A room found by a SearchEngine. Fields are slots instead of the keys of a
+    dictionary, the availability time is kept in seconds since EPOCH and the
+    prices and deposits in arrays.
+
+    A Room is still read and written like the rooms of the json database:
+    room['timestamp'] is a str(datetime), room['prices'] a list and keys the
+    engines do not know about are kept aside. The attributes give the compact
+    values, room.timestamp is an int.
+    """
+
+    __slots__ = ('id', 'search', 'areas', 'images', 'station', 'prices', 'available', 'timestamp', 'deposits', 'bills', 'rooms', 'housemates', 'females', 'males', 'phone', 'new', 'score', 'bound', 'fetched', 'errors', 'source', 'rated_with', 'rated_fields', 'extra')
+
+    # fields stored in slots, extra holds any other key
+    FIELDS = __slots__[:-1]
+    FIELD_SET = frozenset(FIELDS)
+
+    # conversions from the json database values
+    CONVERTERS = {'timestamp': to_epoch, 'prices': to_amounts, 'deposits': to_amounts}
+
+    # few distinct values shared by many rooms
+    INTERNED = frozenset(('search', 'station', 'available'))
+
+    # fields stored as they are given
+    PLAIN = FIELD_SET - frozenset(CONVERTERS) - INTERNED
+
+    def __init__(self, **fields):
+        self.extra = None
+        self.update(fields)
+
+    @classmethod
+    def cast(cls, room):
+        """Returns room as a Room, converting the dictionaries of the json database."""
+
+        if isinstance(room, cls):
+            return room
+
+        # every room of the database goes through here when it is loaded:
+        # the plain fields are set directly and only the timestamp, prices
+        # and deposits are converted, without __setitem__
+        record = cls.__new__(cls)
+        record.extra = None
+        plain = cls.PLAIN
+        for key, value in room.items():
+            if key in plain:
+                setattr(record, key, value)
+            elif key == 'timestamp':
+                record.timestamp = to_epoch(value)
+            elif key == 'prices':
+                record.prices = to_amounts(value)
+            elif key == 'deposits':
+                record.deposits = to_amounts(value)
+            else:
+                record[key] = value
+        return record
+
+    def to_dict(self):
+        """Returns the room as stored in the json database."""
+
+        return dict((key, self[key]) for key in self.keys())
+
+    def update(self, fields):
+        for key, value in fields.items():
+            if key in self.PLAIN:
+                setattr(self, key, value)
+            else:
+                self[key] = value
+
+    def keys(self):
+        keys = [key for key in self.FIELDS if hasattr(self, key)]
+        return keys + list(self.extra) if self.extra else keys
+
+    def items(self):
+        return [(key, self[key]) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __contains__(self, key):
+        if key in self.FIELD_SET:
+            return hasattr(self, key)
+        return self.extra is not None and key in self.extra
+
+    def __getitem__(self, key):
+        if key not in self.FIELD_SET:
+            if self.extra is None or key not in self.extra:
+                raise KeyError(key)
+            return self.extra[key]
+
+        try:
+            value = getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+        if key == 'timestamp':
+            return str(from_epoch(value))
+        if key == 'prices' or key == 'deposits':
+            return value.tolist()
+        return value
+
+    def __setitem__(self, key, value):
+        if key not in self.FIELD_SET:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+            return
+
+        if key in self.CONVERTERS:
+            value = self.CONVERTERS[key](value)
+        elif key in self.INTERNED and type(value) is str:
+            value = intern(value)
+        setattr(self, key, value)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        if key in self.FIELD_SET:
+            delattr(self, key)
+        else:
+            del self.extra[key]
+
+    def get(self, key, default=None):
+        return self[key] if key in self else default
+
+    def pop(self, key, *default):
+        if key not in self and default:
+            return default[0]
+        value = self[key]
+        del self[key]
+        return value
+
+    def copy(self):
+        """Returns a copy of the room that can be changed without changing it."""
+
+        record = Room()
+        for key in self.FIELDS:
+            if hasattr(self, key):
+                value = getattr(self, key)
+                setattr(record, key, value[:] if isinstance(value, (list, array)) else value)
+        record.extra = dict(self.extra) if self.extra else None
+        return record
+
+    def get_areas(self):
+        """Returns all the areas the room was found in, the first one is room['search']."""
+
+        return getattr(self, 'areas', None) or [self.search]
+
+    def add_area(self, area):
+        """Records another area the room was found in, returns False if it was known."""
+
+        areas = self.get_areas()
+        if area in areas:
+            return False
+        self.areas = areas + [area]
+        return True
+
+    def __eq__(self, other):
+        return isinstance(other, Room) and self.to_dict() == other.to_dict()
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return 'Room({fields})'.format(fields=self.to_dict())
+
+class Rooms(dict):
+    """
+    Dictionary of rooms that remembers which rooms changed since the last time
+    they were saved. Changes made inside a room must be flagged with touch().
+    Rooms given as dictionaries are stored as Room records.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(Rooms, self).__init__()
+        for key, room in dict(*args, **kwargs).items():
+            super(Rooms, self).__setitem__(key, Room.cast(room))
+        self.dirty = set()
+        self.deleted = set()
+
+        # secondary indexes, built the first time they are asked for
+        self.index = None
+
+    def __setitem__(self, key, room):
+        room = Room.cast(room)
+        super(Rooms, self).__setitem__(key, room)
+        self.dirty.add(key)
+        self.deleted.discard(key)
+        if self.index is not None:
+            self.index.update(key, room)
+
+    def __delitem__(self, key):
+        super(Rooms, self).__delitem__(key)
+        self.dirty.discard(key)
+        self.deleted.add(key)
+        if self.index is not None:
+            self.index.remove(key)
+
+    def touch(self, key):
+        """Flags a room changed in place."""
+
+        if key in self:
+            self.dirty.add(key)
+            if self.index is not None:
+                self.index.update(key, self[key])
+
+    def clean(self):
+        """Forgets the changes, called once they are saved."""
+
+        self.dirty.clear()
+        self.deleted.clear()
+
+    def get_index(self):
+        """Returns the RoomIndex of the rooms, kept up to date from then on."""
+
+        if self.index is None:
+            self.index = RoomIndex(self)
+        return self.index
+
+class RoomIndex(object):
+    """
+    Secondary indexes of a Rooms dictionary: the rooms sorted by price (the
+    cheapest of their rooms) and by availability time for range queries, and
+    the rooms of each station and area. Station and area names are compared
+    in lower case.
+    """
+
+    def __init__(self, rooms=None):
+        # key -> (price, available, station, areas) the room is indexed by
+        self.entries = {}
+
+        # sorted (value, key) lists
+        self.sorted = {'price': [], 'available': []}
+
+        # name -> keys of the rooms
+        self.hashed = {'station': {}, 'area': {}}
+
+        if rooms:
+            for key, room in rooms.items():
+                entry = self.entries[key] = self.get_entry(room)
+                self.hash(key, entry)
+            for i, name in enumerate(('price', 'available')):
+                self.sorted[name] = sorted((entry[i], key) for key, entry in self.entries.items() if entry[i] is not None)
+
+    @staticmethod
+    def get_entry(room):
+        """Returns the values a room is indexed by."""
+
+        return (
+            min(room.prices) if 'prices' in room and len(room.prices) else None,
+            room.timestamp if 'timestamp' in room else None,
+            room.station.lower() if 'station' in room else None,
+            tuple(area.lower() for area in room.get_areas()),
+        )
+
+    def hash(self, key, entry):
+        if entry[2] is not None:
+            self.hashed['station'].setdefault(entry[2], set()).add(key)
+        for area in entry[3]:
+            self.hashed['area'].setdefault(area, set()).add(key)
+
+    def update(self, key, room):
+        """Indexes a room added or changed, unless its indexed values are the same."""
+
+        entry = self.get_entry(room)
+        if self.entries.get(key) == entry:
+            return
+
+        self.remove(key)
+        self.entries[key] = entry
+        self.hash(key, entry)
+        for i, name in enumerate(('price', 'available')):
+            if entry[i] is not None:
+                insort(self.sorted[name], (entry[i], key))
+
+    def remove(self, key):
+        entry = self.entries.pop(key, None)
+        if entry is None:
+            return
+
+        for i, name in enumerate(('price', 'available')):
+            values = self.sorted[name]
+            position = bisect_left(values, (entry[i], key)) if entry[i] is not None else len(values)
+            if position < len(values) and values[position] == (entry[i], key):
+                del values[position]
+
+        keys = [self.hashed['station'].get(entry[2])] + [self.hashed['area'].get(area) for area in entry[3]]
+        for names in keys:
+            if names is not None:
+                names.discard(key)
+
+    def query(self, price=None, available=None, stations=None, areas=None):
+        """
+        Returns the keys of the rooms matching all the conditions given,
+        looking up the most selective conditions in their indexes.
+
+        price -- (low, high) range of the cheapest room price
+        available -- (low, high) range of the availability time in seconds
+                     since EPOCH. Ranges include low and exclude high, None
+                     leaves an end open
+        stations -- names of the stations the room may be near
+        areas -- names of the areas the room may have been found in
+        """
+
+        # (number of rooms, rooms finder, room check) of each condition
+        conditions = []
+        for i, name, bounds in ((0, 'price', price), (1, 'available', available)):
+            if bounds is None:
+                continue
+
+            low, high = bounds
+            values = self.sorted[name]
+            start = bisect_left(values, (low,)) if low is not None else 0
+            end = bisect_left(values, (high,)) if high is not None else len(values)
+            conditions.append((
+                max(0, end - start),
+                lambda values=values, start=start, end=end: set(key for _, key in values[start:end]),
+                lambda entry, i=i, low=low, high=high: entry[i] is not None and (low is None or entry[i] >= low) and (high is None or entry[i] < high),
+            ))
+
+        for i, name, names in ((2, 'station', stations), (3, 'area', areas)):
+            if names is None:
+                continue
+
+            names = set(value.lower() for value in names)
+            found = [self.hashed[name].get(value, ()) for value in names]
+            check = (lambda entry, names=names: entry[2] in names) if i == 2 else (lambda entry, names=names: not names.isdisjoint(entry[3]))
+            conditions.append((sum(len(keys) for keys in found), lambda found=found: set().union(*found), check))
+
+        if not conditions:
+            return list(self.entries)
+
+        # most selective first, the rooms left are intersected with the next
+        # condition rooms until checking them one by one is cheaper
+        conditions.sort(key=lambda condition: condition[0])
+        keys = conditions[0][1]()
+        for position, (count, find, check) in enumerate(conditions[1:], 1):
+            if len(keys) * 4 < count:
+                checks = [condition[2] for condition in conditions[position:]]
+                return [key for key in keys if all(check(self.entries[key]) for check in checks)]
+            keys &= find()
+        return list(keys)
+
+class RoomStore(object):
+    """Storage backend of the rooms found by a SearchEngine."""
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    def load(self):
+        """Returns all the stored rooms as a Rooms dictionary."""
+        raise NotImplementedError
+
+    def save(self, rooms):
+        """Saves the rooms changed since the last save."""
+        raise NotImplementedError
+
+    def iter_batches(self, size):
+        """
+        Yields all the stored rooms as Rooms dictionaries of at most size
+        rooms. Stores that cannot be read in parts load them all first.
+        """
+
+        rooms = self.load()
+        keys = list(rooms)
+        for start in range(0, len(keys), size):
+            yield Rooms((key, rooms[key]) for key in keys[start:start + size])
+
+    def count(self):
+        """Returns the number of stored rooms."""
+
+        return len(self.load())
+
+    def load_state(self):
+        """Returns the crawl state saved with the rooms (e.g. high-water marks)."""
+        raise NotImplementedError
+
+    def save_state(self, state):
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+    def modified(self):
+        """Returns the time the store was last written, 0 if it does not exist."""
+
+        try:
+            return os.path.getmtime(self.file_name)
+        except OSError:
+            return 0
+
+class JSONRoomStore(RoomStore):
+    """Stores all the rooms in a single json file, rewritten on every save."""
+
+    def load(self):
+        with open(self.file_name, 'r') as f:
+            text = f.read()
+        with gc_paused():
+            return Rooms(json.loads(text))
+
+    def save(self, rooms):
+        if not rooms.dirty and not rooms.deleted and os.path.exists(self.file_name):
+            return
+
+        # write to a temporary file first so a crash never corrupts the database
+        tmp = '{name}.tmp'.format(name=self.file_name)
+        with open(tmp, 'w') as f:
+            f.write(json.dumps(rooms, default=Room.to_dict))
+        os.rename(tmp, self.file_name)
+        rooms.clean()
+
+    def load_state(self):
+        try:
+            with open(self.file_name.replace('.json', '.state.json'), 'r') as f:
+                return json.loads(f.read())
+        except (IOError, ValueError):
+            return {}
+
+    def save_state(self, state):
+        with open(self.file_name.replace('.json', '.state.json'), 'w') as f:
+            f.write(json.dumps(state))
+
+class SQLiteRoomStore(RoomStore):
+    """
+    Stores every room in its own row of a SQLite database. Only the rooms
+    changed since the last save are written, in a single transaction.
+    """
+
+    schema = [
+        'CREATE TABLE IF NOT EXISTS rooms (id TEXT PRIMARY KEY, score REAL, search TEXT, station TEXT, timestamp TEXT, data TEXT NOT NULL)',
+        'CREATE INDEX IF NOT EXISTS rooms_score ON rooms (score)',
+        'CREATE INDEX IF NOT EXISTS rooms_search ON rooms (search)',
+        'CREATE INDEX IF NOT EXISTS rooms_station ON rooms (station)',
+        'CREATE INDEX IF NOT EXISTS rooms_timestamp ON rooms (timestamp)',
+        'CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT NOT NULL)',
+    ]
+
+    def __init__(self, file_name):
+        super(SQLiteRoomStore, self).__init__(file_name)
+        # saves can come from a pipeline thread, always under the engine lock
+        self.db = sqlite3.connect(file_name, check_same_thread=False)
+        with self.db:
+            for statement in self.schema:
+                self.db.execute(statement)
+
+    def load(self):
+        with gc_paused():
+            return Rooms((key, json.loads(data)) for key, data in self.db.execute('SELECT id, data FROM rooms'))
+
+    def iter_batches(self, size):
+        """
+        Reads the rooms in id order, size rows at a time, so only one batch is
+        in memory. Each batch starts after the last id of the previous one,
+        batches saved in between are not read twice.
+        """
+
+        last = ''
+        while True:
+            rows = self.db.execute('SELECT id, data FROM rooms WHERE id > ? ORDER BY id LIMIT ?', (last, size)).fetchall()
+            if not rows:
+                return
+            last = rows[-1][0]
+            with gc_paused():
+                batch = Rooms((key, json.loads(data)) for key, data in rows)
+            yield batch
+
+    def save(self, rooms):
+        rows = []
+        for key in rooms.dirty:
+            room = rooms[key]
+            rows.append((str(key), room.get('score'), room.get('search'), room.get('station'), room.get('timestamp'), json.dumps(room.to_dict())))
+
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO rooms (id, score, search, station, timestamp, data) VALUES (?, ?, ?, ?, ?, ?)', rows)
+            self.db.executemany('DELETE FROM rooms WHERE id = ?', [(str(key),) for key in rooms.deleted])
+        rooms.clean()
+
+    def load_state(self):
+        return dict((key, json.loads(value)) for key, value in self.db.execute('SELECT key, value FROM state'))
+
+    def save_state(self, state):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)', [(key, json.dumps(value)) for key, value in state.items()])
+
+    def count(self):
+        return self.db.execute('SELECT COUNT(*) FROM rooms').fetchone()[0]
+
+    def is_empty(self):
+        return self.count() == 0
+
+    def migrate(self, json_file):
+        """
+        Imports all the rooms of a json database into an empty store. Done
+        only once, recorded in the state table, so a store emptied later does
+        not import the stale json file again. A json file that cannot be read
+        is logged and left to import on the next start.
+        """
+
+        if self.db.execute('SELECT 1 FROM state WHERE key = ?', ('migrated_from',)).fetchone() is not None:
+            return 0
+
+        rooms = Rooms()
+        if self.is_empty() and os.path.exists(json_file):
+            try:
+                rooms = JSONRoomStore(json_file).load()
+            except (IOError, ValueError) as e:
+                logging.warning('Could not import {name}: {message}'.format(name=json_file, message=e), extra={'engine': self.__class__.__name__, 'function': 'migrate'})
+                return 0
+            rooms.dirty.update(rooms.keys())
+            self.save(rooms)
+        self.save_state({'migrated_from': json_file})
+        return len(rooms)
+
+    def close(self):
+        self.db.close()
+
+class Snapshot(object):
+    """
+    Columnar binary copy of the room database, read through mmap so opening
+    it does not depend on the number of rooms and a column is only paged in
+    when it is used. Ranking and the rating checks read the fixed-width
+    columns, a room is only decoded from its json when it is returned.
+
+    Layout: magic, header length (uint32), json header, then the columns,
+    each 8-byte aligned. Fixed-width columns are native arrays of count
+    values, text columns (areas, rated_with) hold indexes into lists kept in
+    the header and blob columns (id, data) an offsets column of count + 1
+    values followed by the bytes.
+    """
+
+    magic = b'RFSNAP02'
+
+    # name -> array typecode, 'blob' for variable length values
+    COLUMNS = (
+        ('score', 'd'),
+        ('new', 'b'),
+        ('timestamp', 'q'),
+        ('areas', 'i'),
+        ('rated_with', 'i'),
+        ('rated_fields', 'b'),
+        ('id', 'blob'),
+        ('data', 'blob'),
+    )
+
+    def __init__(self, file_name):
+        """
+        Opens a Snapshot, raises ValueError if the file is not a snapshot
+        written by this machine.
+
+        file_name -- snapshot file name
+        """
+
+        self.file_name = file_name
+        with open(file_name, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        if self.map[:len(self.magic)] != self.magic:
+            raise ValueError('{name} is not a room snapshot'.format(name=file_name))
+
+        length = struct.unpack('<I', self.map[8:12])[0]
+        self.header = json.loads(self.map[12:12 + length].decode('utf-8'))
+        if self.header['byteorder'] != byteorder:
+            raise ValueError('{name} was written with another byte order'.format(name=file_name))
+
+        self.start = self.align(12 + length)
+        self.count = self.header['count']
+        self.view = memoryview(self.map)
+        self.columns = {}
+
+    @staticmethod
+    def align(offset):
+        return (offset + 7) // 8 * 8
+
+    @classmethod
+    def write(cls, file_name, rooms, fields_fingerprint):
+        """
+        Writes a snapshot of the rooms, replacing file_name atomically.
+
+        rooms -- Rooms dictionary
+        fields_fingerprint -- function returning the fields hash of a room,
+                              compared with the one it was rated with
+        """
+
+        columns = dict((name, array('q' if code == 'blob' else code)) for name, code in cls.COLUMNS)
+        blobs = {'id': [], 'data': []}
+        texts = {'areas': [], 'rated_with': []}
+        codes = {'areas': {}, 'rated_with': {}}
+
+        for name in blobs:
+            columns[name].append(0)
+
+        for key, room in rooms.items():
+            columns['score'].append(room.score if 'score' in room else float('nan'))
+            columns['new'].append(1 if room.get('new') else 0)
+            columns['timestamp'].append(room.timestamp if 'timestamp' in room else 0)
+            columns['rated_fields'].append(1 if room.get('rated_fields') == fields_fingerprint(room) else 0)
+
+            for name, value in (('areas', tuple(room.get_areas())), ('rated_with', room.get('rated_with'))):
+                if value not in codes[name]:
+                    codes[name][value] = len(texts[name])
+                    texts[name].append(value)
+                columns[name].append(codes[name][value])
+
+            for name, value in (('id', str(key)), ('data', json.dumps(room.to_dict()))):
+                value = value.encode('utf-8')
+                blobs[name].append(value)
+                columns[name].append(columns[name][-1] + len(value))
+
+        # lay the columns out one after the other, offsets from the first one
+        layout, offset = {}, 0
+        for name, code in cls.COLUMNS:
+            data = columns[name].tobytes()
+            layout[name] = [columns[name].typecode, offset, len(data)]
+            offset = cls.align(offset + len(data))
+            if code == 'blob':
+                data = b''.join(blobs[name])
+                layout[name + '.bytes'] = ['B', offset, len(data)]
+                offset = cls.align(offset + len(data))
+
+        header = json.dumps({'count': len(rooms), 'byteorder': byteorder, 'columns': layout, 'texts': texts}).encode('utf-8')
+        start = cls.align(12 + len(header))
+
+        tmp = '{name}.tmp'.format(name=file_name)
+        with open(tmp, 'wb') as f:
+            f.write(cls.magic + struct.pack('<I', len(header)) + header)
+            for name, code in cls.COLUMNS:
+                f.seek(start + layout[name][1])
+                f.write(columns[name].tobytes())
+                if code == 'blob':
+                    f.seek(start + layout[name + '.bytes'][1])
+                    f.write(b''.join(blobs[name]))
+            f.truncate(start + offset)
+        os.rename(tmp, file_name)
+
+    def column(self, name):
+        """Returns a column as a typed memoryview of the mapped file."""
+
+        if name not in self.columns:
+            code, offset, length = self.header['columns'][name]
+            self.columns[name] = self.view[self.start + offset:self.start + offset + length].cast(code)
+        return self.columns[name]
+
+    def blob(self, name, index):
+        offsets, data = self.column(name), self.column(name + '.bytes')
+        return data[offsets[index]:offsets[index + 1]].tobytes().decode('utf-8')
+
+    def key(self, index):
+        return self.blob('id', index)
+
+    def room(self, index):
+        """Decodes the room stored at index."""
+
+        return Room.cast(json.loads(self.blob('data', index)))
+
+    def needs_rating(self, fingerprint):
+        """Returns the ids of the rooms SearchEngine.needs_rating would rate again."""
+
+        texts = self.header['texts']['rated_with']
+        current = texts.index(fingerprint) if fingerprint in texts else -1
+        score, rated_with, rated_fields = self.column('score'), self.column('rated_with'), self.column('rated_fields')
+        return [self.key(i) for i in range(self.count) if score[i] != score[i] or rated_with[i] != current or not rated_fields[i]]
+
+    def top_rooms(self, k=-1, filters=None):
+        """Same as SearchEngine.top_rooms, decoding only the rooms returned."""
+
+        filters = filters or {}
+        indexes = range(self.count)
+
+        if filters.get('when'):
+            when, timestamp = to_epoch(filters['when']), self.column('timestamp')
+            indexes = (i for i in indexes if timestamp[i] >= when)
+
+        if filters.get('new'):
+            pref_ids, new = set(filters.get('pref_ids') or []), self.column('new')
+            indexes = (i for i in indexes if new[i] or (pref_ids and self.key(i) in pref_ids))
+
+        if filters.get('areas') is not None:
+            areas, codes = set(filters['areas']), self.column('areas')
+            areas = set(code for code, room_areas in enumerate(self.header['texts']['areas']) if not areas.isdisjoint(room_areas))
+            indexes = (i for i in indexes if codes[i] in areas)
+
+        # unrated rooms are stored with a nan score
+        scores = self.column('score')
+        score = lambda i: scores[i] if scores[i] == scores[i] else 0
+        if k < 0:
+            indexes = sorted(indexes, key=score, reverse=True)
+        else:
+            indexes = heapq.nlargest(k, indexes, key=score)
+        return [self.room(i) for i in indexes]
+
+    def close(self):
+        for column in self.columns.values():
+            column.release()
+        self.columns = {}
+        self.view.release()
+        self.map.close()
+
+class ReportWriter(object):
+    """
+    Writes the rows of a report to a file as they are produced, so the report
+    never has to be held in memory.
+    """
+
+    extension = '.txt'
+
+    def __init__(self, engine, file_name, fields):
+        """
+        Create a ReportWriter object.
+
+        engine -- SearchEngine the rooms come from
+        file_name -- report file name without extension
+        fields -- room fields written in each row (settings.FIELDS)
+        """
+
+        self.engine = engine
+        self.file_name = file_name
+        self.fields = fields
+        self.rows = 0
+
+    def open(self):
+        self.f = io.open(self.file_name + self.extension, 'w', encoding='utf-8')
+
+    def write_row(self, room, css):
+        """Writes a room, css tells if it is new, preferred or old."""
+        raise NotImplementedError
+
+    def close(self):
+        self.f.close()
+
+class HTMLReportWriter(ReportWriter):
+    extension = '.html'
+
+    # images shown for each room
+    images_per_row = 5
+
+    def open(self):
+        super(HTMLReportWriter, self).open()
+        self.write_header(self.f)
+
+    def write_header(self, f):
+        name = str(self.engine.__class__.__name__).split(' ')[0]
+        f.write(u'<html><head><title>{name} Classified Ads</title><link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.1/css/bootstrap.min.css"></head><body>'.format(name=name))
+
+    def write_table_header(self, f):
+        f.write(u'<table class="table"><thead><tr>')
+        for field in self.fields:
+            f.write(u'<th>{field}</th>'.format(field=field.replace('_', ' ').capitalize()))
+        f.write(u'</tr></thead><tbody>')
+
+    def write_footer(self, f):
+        f.write(u'<script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.1/js/bootstrap.min.js"></script></body></html>')
+
+    def write_row(self, room, css):
+        if self.rows == 0:
+            self.write_table_header(self.f)
+        self.f.write(self.format_row(room, css))
+        self.rows += 1
+
+    def format_row(self, room, css):
+        html = u'<tr class="{css}">'.format(css=css)
+        for field in self.fields:
+            if field == 'id':
+                html += u'<td><a target="_blank" href="{url}">{field}</td>'.format(url=self.engine.get_room_url(room['id']), field=room[field])
+            elif field == 'images':
+                pics = [u'<a href="{url}"><img src="{src}" height="100" width="100"></a>'.format(url=img, src=self.get_image_src(img)) for img in room['images'][:self.images_per_row]]
+                html += u'<td>{images}</td>'.format(images=''.join(pics))
+            else:
+                html += u'<td>{value}</td>'.format(value=room[field])
+        return html + u'</tr>'
+
+    def get_image_src(self, url):
+        """Returns the cached thumbnail of an image relative to the report, or its url."""
+
+        path = self.engine.images.get(url) if self.engine.images is not None else None
+        if path is None:
+            return url
+        return os.path.relpath(path, os.path.dirname(os.path.abspath(self.file_name))).replace(os.sep, '/')
+
+    def close(self):
+        if self.rows > 0:
+            self.f.write(u'<tbody></table>')
+        self.write_footer(self.f)
+        super(HTMLReportWriter, self).close()
+
+class PaginatedHTMLReportWriter(HTMLReportWriter):
+    """
+    Splits an HTML report in pages of page_size rows (name-1.html,
+    name-2.html, ...) linked from an index page (name.html).
+    """
+
+    def __init__(self, engine, file_name, fields, page_size=100):
+        super(PaginatedHTMLReportWriter, self).__init__(engine, file_name, fields)
+        self.page_size = page_size
+        self.pages = []
+
+    def open(self):
+        self.f = None
+
+    def open_page(self):
+        self.pages.append({'rows': 0, 'first': self.rows + 1, 'scores': []})
+        self.f = io.open('{name}-{page}{ext}'.format(name=self.file_name, page=len(self.pages), ext=self.extension), 'w', encoding='utf-8')
+        self.write_header(self.f)
+        self.write_table_header(self.f)
+
+    def close_page(self, has_next=False):
+        name = os.path.basename(self.file_name)
+        page = len(self.pages)
+
+        self.f.write(u'<tbody></table><ul class="pager">')
+        if page > 1:
+            self.f.write(u'<li><a href="{name}-{page}{ext}">Previous</a></li>'.format(name=name, page=page - 1, ext=self.extension))
+        self.f.write(u'<li><a href="{name}{ext}">Index</a></li>'.format(name=name, ext=self.extension))
+        if has_next:
+            self.f.write(u'<li><a href="{name}-{page}{ext}">Next</a></li>'.format(name=name, page=page + 1, ext=self.extension))
+        self.f.write(u'</ul>')
+        self.write_footer(self.f)
+        self.f.close()
+        self.f = None
+
+    def write_row(self, room, css):
+        # a full page is only closed once there is a row for the next one
+        if self.f is not None and self.pages[-1]['rows'] == self.page_size:
+            self.close_page(has_next=True)
+        if self.f is None:
+            self.open_page()
+
+        self.f.write(self.format_row(room, css))
+        page = self.pages[-1]
+        page['rows'] += 1
+        page['scores'].append(room.get('score', 0))
+        self.rows += 1
+
+    def close(self):
+        if self.f is not None:
+            self.close_page()
+
+        with io.open(self.file_name + self.extension, 'w', encoding='utf-8') as f:
+            self.write_header(f)
+            f.write(u'<table class="table"><thead><tr><th>Page</th><th>Rooms</th><th>Scores</th></tr></thead><tbody>')
+            for number, page in enumerate(self.pages, 1):
+                f.write(u'<tr><td><a href="{name}-{number}{ext}">{number}</a></td><td>{first} - {last}</td><td>{best:.2f} - {worst:.2f}</td></tr>'.format(
+                    name=os.path.basename(self.file_name), number=number, ext=self.extension,
+                    first=page['first'], last=page['first'] + page['rows'] - 1, best=max(page['scores']), worst=min(page['scores'])))
+            f.write(u'<tbody></table>')
+            self.write_footer(f)
+
+class CSVReportWriter(ReportWriter):
+    extension = '.csv'
+
+    def open(self):
+        self.f = io.open(self.file_name + self.extension, 'w', encoding='utf-8', newline='')
+        self.writer = csv.writer(self.f)
+        self.writer.writerow(self.fields + ['url', 'status'])
+
+    def write_row(self, room, css):
+        row = []
+        for field in self.fields:
+            if isinstance(room[field], list):
+                row.append(' '.join(str(value) for value in room[field]))
+            else:
+                row.append(room[field])
+        self.writer.writerow(row + [self.engine.get_room_url(room['id']), css])
+        self.rows += 1
+
+class JSONLinesReportWriter(ReportWriter):
+    extension = '.jsonl'
+
+    def write_row(self, room, css):
+        row = dict((field, room[field]) for field in self.fields)
+        row['url'] = self.engine.get_room_url(room['id'])
+        row['status'] = css
+        self.f.write(u'{row}\n'.format(row=json.dumps(row)))
+        self.rows += 1
+
+REPORT_WRITERS = {
+    'html': HTMLReportWriter,
+    'csv': CSVReportWriter,
+    'jsonl': JSONLinesReportWriter,
+}
+
+class SearchEngine(object):
+
+    # name of the engine in the command line and in federated room keys
+    name = 'rooms'
+
+    # file to store the rooms in
+    file_name = 'rooms.json'
+
+    # requests per second to each host, None for settings.REQUEST_RATE
+    request_rate = None
+
+    # headers sent with every request
+    headers = {}
+
+    # web site the rooms are shown in, used in the reports
+    location = ''
+    details_endpoint = ''
+
+    # responses retried with exponential backoff (backoff * 2 ** retry seconds)
+    retry_statuses = (429, 500, 502, 503, 504)
+    retry_backoff = 0.5
+
+    # seconds a cached response is used without asking the server again
+    cache_ttl = 0
+
+    # failed refreshes in a row after which a room is retired
+    retire_errors = 3
+
+    # weight of each field in the score, in the order of settings.PREFERENCES
+    SCORES = [0.25, 0.20, 0.20, 0.15, 0.10, 0.05, 0.05]
+
+    # fields of a room used to score it
+    SCORED_FIELDS = ('station', 'prices', 'deposits', 'bills', 'rooms', 'housemates', 'females', 'images', 'timestamp')
+
+    # columns extracted from the rooms by the batch scorer
+    SCORING_COLUMNS = ('rank', 'price', 'deposit', 'bills', 'rooms', 'has_housemates', 'housemates', 'females', 'images', 'available')
+
+    # preferences used to make queries to the web application
+    preferences = {}
+
+    def __init__(self, preferences=None, areas=None, cookies=None, file_name=None):
+        """
+        Create a SearchEngine object.
+
+        preferences -- preferences to be merged with the default preferences
+        areas -- areas to search rooms in
+        cookies -- cookies to be used when making requests to the server
+        file_name -- file to store the rooms in (default: the class file_name)
+        """
+
+        self.AREAS = areas or []
+        self.cookies = cookies or {}
+        self.file_name = file_name or self.file_name
+        self.request_rate = settings.ENGINE_RATES.get(self.name, self.request_rate)
+
+        # merges the preferences from the settings file
+        if preferences:
+            for key in preferences:
+                self.preferences[key] = preferences[key]
+
+        # will hold all the rooms found in self engine, loaded when first used
+        self._rooms = None
+        self.store = self.create_store()
+
+        # binary copy of the rooms read instead of them until they are loaded
+        self.snapshot = None
+
+        # crawl state saved with the rooms, e.g. the newest advert of each area
+        self.state = {}
+
+        # statistics and adverts listed so far in the last crawl
+        self.start_crawl()
+
+        # crawl workers leave the scoring to the process merging their rooms
+        self.scoring = True
+
+        # requests left to all the crawling processes, None for no limit
+        self.budget = None
+
+        # advert id -> area it was first listed in by any crawling process
+        self.claimed = None
+
+        # ids of the rooms of the main database, in a crawl worker process
+        self.known = frozenset()
+
+        # token bucket all the crawling processes share, None for their own limiters
+        self.bucket = None
+
+        # guards self.rooms when several threads change it
+        self.lock = threading.RLock()
+
+        # one rate limiter per host, shared by all the fetching threads
+        self.limiters = {}
+        self.limiters_lock = threading.Lock()
+
+        # timers and counters of the run
+        self.metrics = Metrics()
+
+        # keep-alive connections reused by every request
+        self.session = self.create_session()
+
+        # responses cached on disk between runs
+        self.cache = ResponseCache(settings.CACHE_DIR, settings.CACHE_SIZE) if settings.CACHE else None
+
+        # thumbnails of the images shown in the reports
+        self.images = ImageCache(settings.IMAGE_DIR, settings.IMAGE_CACHE_SIZE) if settings.THUMBNAILS else None
+
+        # loads rooms from file, only the crawl state if the snapshot is up to
+        # date or the rooms are read in batches
+        if settings.CHUNK_SIZE or self.open_snapshot() is not None:
+            self.load_state()
+        else:
+            self.load_rooms()
+
+    @property
+    def rooms(self):
+        if self._rooms is None:
+            self.load_rooms(state=False)
+        return self._rooms
+
+    @rooms.setter
+    def rooms(self, rooms):
+        self._rooms = rooms
+
+    @property
+    def chunked(self):
+        """Checks if the rooms are read in batches, they were not loaded so far."""
+
+        return settings.CHUNK_SIZE > 0 and self._rooms is None
+
+    def iter_batches(self):
+        """
+        Yields the stored rooms settings.CHUNK_SIZE at a time. Each batch is
+        self.rooms while it is processed and its changes are saved before the
+        next one is read, so memory does not grow with the database.
+        """
+
+        try:
+            for batch in self.store.iter_batches(settings.CHUNK_SIZE):
+                self.rooms = batch
+                yield batch
+                self.save_rooms()
+        finally:
+            self._rooms = None
+
+    def count_rooms(self):
+        """Returns the number of rooms, without loading them if they were not needed so far."""
+
+        if self._rooms is None and self.snapshot is not None:
+            return self.snapshot.count
+        if self.chunked:
+            return self.store.count()
+        return len(self.rooms)
+
+    def get_limiter(self, url):
+        """Returns the rate limiter of the host the url points to."""
+
+        host = urlparse(url).netloc
+        with self.limiters_lock:
+            if host not in self.limiters:
+                rate = self.request_rate if self.request_rate is not None else settings.REQUEST_RATE
+                self.limiters[host] = RateLimiter(rate) if self.bucket is None else SharedRateLimiter(self.bucket, rate)
+            return self.limiters[host]
+
+    def create_session(self):
+        """
+        Creates the HTTP session used for every request: pooled keep-alive
+        connections, gzip compression and retries with exponential backoff on
+        connection errors and on the retry_statuses responses.
+        """
+
+        retries = Retry(total=settings.RETRIES, backoff_factor=self.retry_backoff, status_forcelist=self.retry_statuses, raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=max(10, settings.WORKERS), max_retries=retries)
+
+        session = requests.Session()
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update(self.headers)
+        session.headers['Accept-Encoding'] = 'gzip, deflate'
+        session.cookies.update(self.cookies)
+        return session
+
+    def connection_stats(self):
+        """
+        Returns the number of requests sent, connections opened and
+        connections reused by the session.
+        """
+
+        sent = opened = 0
+        for adapter in set(self.session.adapters.values()):
+            pools = adapter.poolmanager.pools
+            for key in list(pools.keys()):
+                pool = pools.get(key)
+                if pool is not None:
+                    sent += pool.num_requests
+                    opened += pool.num_connections
+
+        return {'requests': sent, 'opened': opened, 'reused': max(0, sent - opened)}
+
+    def get_cache_ttl(self, url):
+        """Returns the seconds a cached response of url stays fresh."""
+
+        return self.cache_ttl
+
+    def write_metrics(self, json_file=None, prometheus_file=None):
+        """
+        Exports the metrics of the run, with the connection and crawl
+        statistics, as a json summary and in the Prometheus text format.
+
+        json_file -- json summary file (default: named after the database file)
+        prometheus_file -- Prometheus text file, not written if None
+        """
+
+        json_file = json_file or self.file_name.replace('.json', '.metrics.json')
+        try:
+            self.metrics.write_json(json_file, engine=self.__class__.__name__, connections=self.connection_stats(), crawl=self.crawl_stats, rooms=self.count_rooms())
+            if prometheus_file:
+                self.metrics.write_prometheus(prometheus_file, {'engine': self.__class__.__name__})
+        except (IOError, OSError) as e:
+            logging.error(str(e), extra={'engine': self.__class__.__name__, 'function': 'write_metrics'})
+
+    @timed('make_get_request')
+    def make_get_request(self, url=None, headers=None, cookies=None, proxies=None, revalidate=False):
+        """
+        Returns the body of the response to url, from the response cache if
+        it is fresh there. Raises NotFound on 404 and 410, ServerError on
+        any other error status left once the retries are spent.
+
+        revalidate -- asks the server even if the cached response is fresh,
+                      Unreachable is raised if only cached responses are used
+        """
+
+        entry = self.cache.get(url) if self.cache else None
+        if revalidate and settings.CACHE_ONLY:
+            raise Unreachable('{url} has to be asked to the server'.format(url=url))
+
+        if entry is not None:
+            if settings.CACHE_ONLY or (not revalidate and time() - entry['fetched'] < self.get_cache_ttl(url)):
+                self.cache.hits += 1
+                self.metrics.count('cache_hits')
+                return entry['body']
+
+            # stale entry, ask the server if it changed
+            headers = dict(headers or {})
+            if entry['etag']:
+                headers['If-None-Match'] = entry['etag']
+            if entry['last_modified']:
+                headers['If-Modified-Since'] = entry['last_modified']
+        elif settings.CACHE_ONLY:
+            raise Unreachable('{url} is not cached'.format(url=url))
+
+        if self.budget is not None:
+            with self.budget.get_lock():
+                if self.budget.value <= 0:
+                    raise Unreachable('Request budget exhausted, not getting {url}'.format(url=url))
+                self.budget.value -= 1
+
+        self.get_limiter(url).wait()
+        self.metrics.count('requests')
+        try:
+            response = self.session.get(url, headers=headers, cookies=cookies, proxies=proxies, timeout=settings.TIMEOUT)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            self.metrics.count('request_errors')
+            raise Unreachable('{url}: {message}'.format(url=url, message=e))
+        except requests.RequestException:
+            self.metrics.count('request_errors')
+            raise
+
+        if response.status_code >= 400:
+            self.metrics.count('request_errors')
+            if response.status_code in (404, 410):
+                raise NotFound('{url} not found'.format(url=url))
+            raise ServerError('{url} answered {status}'.format(url=url, status=response.status_code))
+
+        if self.cache:
+            if entry is not None and response.status_code == 304:
+                self.cache.revalidated += 1
+                self.metrics.count('cache_revalidated')
+                self.cache.put(url, entry['body'], entry['etag'], entry['last_modified'])
+                return entry['body']
+
+            self.cache.misses += 1
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            if response.status_code == 200 and (self.get_cache_ttl(url) > 0 or etag or last_modified):
+                self.cache.put(url, response.text, etag, last_modified)
+
+        return response.text
+
+    def create_store(self, file_name=None):
+        """
+        Creates the storage backend selected in settings.STORAGE. The SQLite
+        database lives next to the json file and imports it the first time.
 
-class SearchEngine(object):
+        file_name -- json file name of the database (default: self.file_name)
+        """
 
-    # file to store the rooms in
-    file_name = 'rooms.json'
+        file_name = file_name or self.file_name
+        if settings.STORAGE == 'json':
+            return JSONRoomStore(file_name)
 
-    # preferences used to make queries to the web application
-    preferences = {}
+        store = SQLiteRoomStore(file_name.replace('.json', '.db'))
+        migrated = store.migrate(file_name)
+        if migrated and settings.VERBOSE:
+            print('Imported {count} rooms from {name}'.format(count=migrated, name=file_name))
+        return store
 
-    def __init__(self, preferences=None, areas=None, cookies=None):
+    @timed('load_rooms')
+    def load_rooms(self, state=True):
         """
-        Create a SearchEngine object.
+        Loads rooms from the store if it exists. In case of error will clean
+        the rooms variable.
 
-        preferences -- preferences to be merged with the default preferences
-        areas -- areas to search rooms in
-        cookies -- cookies to be used when making requests to the server
+        state -- also load the crawl state
         """
 
-        self.AREAS = areas or []
-        self.cookies = cookies or {}
+        try:
+            self.rooms = self.store.load()
+            if state:
+                self.state = self.store.load_state()
 
-        # merges the preferences from the settings file
-        if preferences:
-            for key in preferences:
-                self.preferences[key] = preferences[key]
+        # catch exception if the file does not exist or if json.loads fail
+        except (IOError, ValueError, sqlite3.Error) as e:
+            logging.warning(str(e), extra={'engine': self.__class__.__name__, 'function': 'load_rooms'})
+            # don't load any rooms
+            self.rooms = Rooms()
+            if state:
+                self.state = {}
 
-        # will hold all the rooms found in self engine
-        self.rooms = {}
+    def load_state(self):
+        """Loads only the crawl state from the store."""
 
-        # loads rooms from file
-        self.load_rooms()
+        try:
+            self.state = self.store.load_state()
+        except (IOError, ValueError, sqlite3.Error) as e:
+            logging.warning(str(e), extra={'engine': self.__class__.__name__, 'function': 'load_state'})
+            self.state = {}
 
-    def make_get_request(self, url=None, headers=None, cookies=None, proxies=None):
-        if settings.DEBUG:
-            print('Sleeping for {secs} seconds'.format(secs=settings.SLEEP))
-        sleep(settings.SLEEP)
-        return requests.get(url, cookies=self.cookies, headers=self.headers).text
+    def get_snapshot_name(self):
+        return self.file_name.replace('.json', '.snapshot')
 
-    def load_rooms(self):
+    def is_snapshot_fresh(self):
+        """Checks if the snapshot was written after the last change of the store."""
+
+        try:
+            return os.path.getmtime(self.get_snapshot_name()) >= self.store.modified()
+        except OSError:
+            return False
+
+    def open_snapshot(self):
         """
-        Loads rooms from file if it exists. In case of error will clean the
-        rooms variable.
+        Opens the snapshot of the rooms if settings.SNAPSHOT is set and the
+        snapshot is up to date, returns it or None.
         """
 
+        if not settings.SNAPSHOT or not self.is_snapshot_fresh():
+            return None
+
         try:
-            # try opening the files with the rooms and load it as a json file
-            with open(self.file_name, 'r') as f:
-                self.rooms = json.loads(f.read())
+            self.snapshot = Snapshot(self.get_snapshot_name())
+        except (IOError, OSError, ValueError, KeyError) as e:
+            logging.warning(str(e), extra={'engine': self.__class__.__name__, 'function': 'open_snapshot'})
+            self.snapshot = None
+        return self.snapshot
+
+    @timed('update_snapshot')
+    def update_snapshot(self):
+        """
+        Rewrites the snapshot if settings.SNAPSHOT is set and the store
+        changed since it was written. Unsaved rooms are saved first.
+        """
 
-        # catch exception if the file does not exist or if json.loads fail
-        except (IOError, ValueError) as e:
-            logging.warning(e.strerror, extra={'engine': self.__class__.__name__, 'function': 'load_rooms'})
-            # don't load any rooms
-            self.rooms = {}
+        if not settings.SNAPSHOT or self._rooms is None:
+            return
+
+        if self.rooms.dirty or self.rooms.deleted:
+            self.save_rooms()
+        if self.is_snapshot_fresh():
+            return
+
+        if self.snapshot is not None:
+            self.snapshot.close()
+            self.snapshot = None
+
+        try:
+            with self.lock:
+                Snapshot.write(self.get_snapshot_name(), self.rooms, self.get_fields_fingerprint)
+        except (IOError, OSError) as e:
+            logging.error(str(e), extra={'engine': self.__class__.__name__, 'function': 'update_snapshot'})
 
+    @timed('save_rooms')
     def save_rooms(self):
-        """Saves the found rooms in the defined file."""
+        """Saves the rooms changed since the last save in the store."""
 
-        # save the rooms found in the file
         try:
-            with open(self.file_name, 'w') as f:
-                f.write(json.dumps(self.rooms))
+            with self.lock:
+                # rooms never loaded did not change
+                if self._rooms is not None:
+                    self.store.save(self.rooms)
+                self.store.save_state(self.state)
 
         # catch exceptions in case it cannot create the file or something wrong
         # with json.dumps
-        except (IOError, ValueError) as e:
-            logging.error(e.strerror, extra={'engine': self.__class__.__name__, 'function': 'save_rooms'})
+        except (IOError, ValueError, sqlite3.Error) as e:
+            logging.error(str(e), extra={'engine': self.__class__.__name__, 'function': 'save_rooms'})
 
     def get_sorted(self):
         """Returns an array of rooms sorted by score."""
 
-        nrooms = {}
-        for room in self.rooms:
-            nrooms[int(room)] = self.rooms[room]
-        return [nrooms[room] for room in sorted(nrooms, key=lambda k: nrooms[k]['score'] if 'score' in nrooms[k] else 0, reverse=True)]
+        return self.top_rooms()
+
+    def top_rooms(self, k=-1, filters=None):
+        """
+        Returns the k best scored rooms matching the filters, best first.
+        Rooms are filtered before being ranked and only the best k are kept
+        in a heap, so the whole database is never sorted.
+
+        k -- number of rooms to return (-1 for all of them)
+        filters -- dictionary with any of the following keys:
+            when -- only rooms available from this datetime
+            areas -- only rooms found searching one of these areas
+            new -- only new rooms and the rooms in pref_ids
+            pref_ids -- ids of rooms shown even if they are not new
+        """
+
+        # the rooms were not needed so far, the snapshot is enough
+        if self._rooms is None and self.snapshot is not None:
+            return self.snapshot.top_rooms(k, filters)
+
+        if self.chunked:
+            return self.top_rooms_in_batches(k, filters)
+
+        filters = filters or {}
+        rooms = self.rooms.values()
+
+        # the indexes find the rooms of the areas available from when
+        if self.rooms.index is not None:
+            available = (to_epoch(filters['when']), None) if filters.get('when') else None
+            keys = self.rooms.index.query(available=available, areas=filters.get('areas'))
+            rooms = (self.rooms[key] for key in keys)
+            filters = dict(filters, when=None, areas=None)
+
+        if filters.get('when'):
+            when = to_epoch(filters['when'])
+            rooms = (room for room in rooms if room.timestamp >= when)
+
+        if filters.get('new'):
+            pref_ids = set(filters.get('pref_ids') or [])
+            rooms = (room for room in rooms if room['new'] or room['id'] in pref_ids)
+
+        if filters.get('areas') is not None:
+            areas = set(filters['areas'])
+            rooms = (room for room in rooms if not areas.isdisjoint(room.get_areas()))
+
+        score = lambda room: room['score'] if 'score' in room else 0
+        if k < 0:
+            return sorted(rooms, key=score, reverse=True)
+        return heapq.nlargest(k, rooms, key=score)
+
+    def top_rooms_in_batches(self, k=-1, filters=None):
+        """
+        Returns the same rooms as top_rooms reading the store in batches. The
+        best k rooms of each batch are merged with the best ones so far, only
+        k rooms are kept between batches (all the matching ones if k is -1).
+        """
+
+        score = lambda room: room['score'] if 'score' in room else 0
+        best = []
+        for batch in self.iter_batches():
+            if k < 0:
+                best.extend(self.top_rooms(k, filters))
+            else:
+                best = heapq.nlargest(k, best + self.top_rooms(k, filters), key=score)
+        return sorted(best, key=score, reverse=True)
+
+    def query(self, k=20, price=None, available=None, stations=None, areas=None, new=False):
+        """
+        Returns the k best scored rooms matching the conditions, best first,
+        looked up in the room indexes. Conditions left as None are ignored.
+
+        k -- number of rooms to return (-1 for all of them)
+        price -- (low, high) range of the monthly rent, high excluded
+        available -- (low, high) range of the availability datetimes, high excluded
+        stations -- stations the rooms may be near
+        areas -- areas the rooms may have been found in
+        new -- only new rooms
+        """
+
+        if available is not None:
+            available = tuple(to_epoch(when) if when is not None else None for when in available)
+
+        with self.metrics.timer('query'):
+            keys = self.rooms.get_index().query(price=price, available=available, stations=stations, areas=areas)
+            rooms = (self.rooms[key] for key in keys)
+            if new:
+                rooms = (room for room in rooms if room['new'])
+
+            score = lambda room: room['score'] if 'score' in room else 0
+            if k < 0:
+                return sorted(rooms, key=score, reverse=True)
+            return heapq.nlargest(k, rooms, key=score)
 
     def rate(self):
-        for room in self.rooms:
+        """
+        Re-rates the rooms rated with different settings or whose scored
+        fields changed since they were rated, the others keep their score.
+        """
+
+        if settings.UPDATE:
+            self.refresh(settings.REFRESH_BUDGET)
+
+        fingerprint = self.get_rating_fingerprint()
+
+        # nothing to rate, the rooms do not have to be loaded
+        if self._rooms is None and self.snapshot is not None and not self.snapshot.needs_rating(fingerprint):
+            self.metrics.count('ratings_skipped', self.snapshot.count)
+            if settings.VERBOSE:
+                print('Rated 0 rooms, skipped {skipped} unchanged rooms'.format(skipped=self.snapshot.count))
+            return
+
+        # the scores of each batch are saved with it
+        rated = skipped = 0
+        if self.chunked:
+            for batch in self.iter_batches():
+                keys = self.rate_changed(fingerprint)
+                rated, skipped = rated + len(keys), skipped + len(batch) - len(keys)
+        else:
+            keys = self.rate_changed(fingerprint)
+            rated, skipped = len(keys), len(self.rooms) - len(keys)
+
+        self.metrics.count('ratings_skipped', skipped)
+
+        if settings.VERBOSE:
+            print('Rated {rated} rooms, skipped {skipped} unchanged rooms'.format(rated=rated, skipped=skipped))
+
+        self.save_rooms()
+
+    def rate_changed(self, fingerprint=None):
+        """Rates the rooms that need it as new rooms, returns their keys."""
+
+        keys = [key for key in self.rooms if self.needs_rating(key, fingerprint)]
+        for key in keys:
+            self.rooms[key]['new'] = True
+            self.rooms.touch(key)
+
+        self.rate_rooms(keys)
+        return keys
+
+    def get_rating_fingerprint(self):
+        """Returns a hash of all the settings the scores depend on."""
+
+        inputs = [
+            self.preferences['max_rent'],
+            str(self.preferences['when']),
+            str(settings.MIN_AVAILABLE_TIME),
+            [area.lower() for area in self.AREAS],
+            [preference[0] for preference in settings.PREFERENCES],
+            self.SCORES,
+        ]
+        return hashlib.sha1(json.dumps(inputs).encode('utf-8')).hexdigest()[:16]
+
+    def get_fields_fingerprint(self, room):
+        """Returns a hash of the fields of a room the score depends on."""
+
+        fields = [getattr(room, field, None) for field in self.SCORED_FIELDS]
+        return hashlib.sha1(json.dumps(fields, default=list).encode('utf-8')).hexdigest()[:16]
+
+    def needs_rating(self, key, fingerprint=None):
+        """
+        Checks if a room has to be rated: it was never rated, it was rated
+        with other settings or its scored fields changed since.
+        """
+
+        room = self.rooms[key]
+        if 'score' not in room or room.get('rated_with') != (fingerprint or self.get_rating_fingerprint()):
+            return True
+        return room.get('rated_fields') != self.get_fields_fingerprint(room)
+
+    def stamp_rating(self, key, fingerprint=None):
+        """Records the settings and the fields a room was rated with."""
+
+        room = self.rooms[key]
+        room['rated_with'] = fingerprint or self.get_rating_fingerprint()
+        room['rated_fields'] = self.get_fields_fingerprint(room)
+
+    def get_new_rooms(self):
+        """Searches all the areas for new rooms."""
+        pass
+
+    def start_crawl(self):
+        """
+        Resets the crawl statistics and the adverts seen in the crawl. An
+        advert is only fetched and scored the first time a crawl lists it,
+        whatever the area or page it is listed in again.
+        """
+
+        self.crawl_stats = {'pages': 0, 'pages_saved': 0, 'pages_failed': 0, 'duplicates': 0, 'fetches_avoided': 0, 'details_skipped': 0}
+
+        # advert id -> other areas listing it before it was stored
+        self.seen = {}
+
+    def first_listing(self, room_id, area):
+        """
+        Records an advert listed in area, returns False if the crawl listed it
+        before in any area. Crawl processes share the adverts they listed in
+        self.claimed: an advert another process listed first, or one of the
+        main database (self.known), is left out and the area is kept in the
+        state for merge_shards.
+        """
+
+        if room_id in self.seen:
+            self.skip_duplicate(room_id, area)
+            return False
+        self.seen[room_id] = []
+
+        if room_id in self.known:
+            self.metrics.count('rooms_skipped')
+            self.state.setdefault('listed_in', {}).setdefault(room_id, []).append(area)
+            return False
+
+        if self.claimed is None or self.claimed.setdefault(room_id, area) == area:
+            return True
+
+        self.crawl_stats['duplicates'] += 1
+        self.metrics.count('duplicates_skipped')
+        if room_id not in self.rooms:
+            self.crawl_stats['fetches_avoided'] += 1
+            self.metrics.count('duplicate_fetches_avoided')
+        self.state.setdefault('listed_in', {}).setdefault(room_id, []).append(area)
+        return False
+
+    def skip_duplicate(self, room_id, area):
+        """Skips an advert listed again in the same crawl, recording the area it was listed in."""
+
+        self.crawl_stats['duplicates'] += 1
+        self.metrics.count('duplicates_skipped')
+        with self.lock:
+            if room_id in self.rooms:
+                self.add_area(room_id, area)
+                return
+
+            # still being fetched, not valid or failed, it would be fetched again
+            self.seen[room_id].append(area)
+            self.crawl_stats['fetches_avoided'] += 1
+            self.metrics.count('duplicate_fetches_avoided')
+
+    def add_area(self, room_id, area):
+        """Records another area a known room was found in."""
+
+        with self.lock:
+            if self.rooms[room_id].add_area(area):
+                self.rooms.touch(room_id)
+
+    def search_rooms_in(self, area):
+        """Searches one area for new rooms."""
+        pass
+
+    def watch(self, report, max_range=-1, pref_ids=[], when=False):
+        """
+        Keeps searching the areas, each one when the AreaScheduler says it is
+        due, until interrupted. The rooms stay in memory between searches and
+        report is only called when the best max_range rooms change.
+
+        report -- function writing the report
+        max_range -- number of rooms in the report (-1 for all)
+        pref_ids -- rooms always reported, even if they are not new
+        when -- only report rooms available from settings.WHEN
+        """
+
+        scheduler = AreaScheduler(self.AREAS, settings.WATCH_INTERVAL, self.state.setdefault('watch', {}))
+        filters = self.get_report_filters(pref_ids, when)
+
+        # the same rooms are reported over and over, keep them indexed
+        self.rooms.get_index()
+        top = None
+
+        try:
+            while True:
+                area, delay = scheduler.next()
+                if delay > 0:
+                    sleep(delay)
+
+                known = len(self.rooms)
+                self.start_crawl()
+                try:
+                    self.search_rooms_in(area)
+                except Exception as e:
+                    logging.error('Error searching {area}: {message}'.format(area=area, message=e), extra={'engine': self.__class__.__name__, 'function': 'watch'})
+                self.save_rooms()
+
+                new = len(self.rooms) - known
+                interval = scheduler.record(area, new)
+                self.metrics.count('watch_searches')
+                if settings.VERBOSE:
+                    print('Found {new} new rooms in {area}, searching it again in {interval:.0f} seconds'.format(new=new, area=area, interval=interval))
+
+                # ids, scores and status of the reported rooms
+                current = [(room['id'], room.get('score', 0), room['new']) for room in self.top_rooms(max_range, filters)]
+                if current != top:
+                    top = current
+                    self.metrics.count('watch_reports')
+                    report()
+                    if settings.VERBOSE:
+                        print('Best rooms changed, report written')
+                else:
+                    self.write_metrics(settings.METRICS, settings.PROMETHEUS)
+        except KeyboardInterrupt:
+            self.save_rooms()
+
+    def crawl_processes(self, processes):
+        """
+        Crawls the areas in worker processes. Each worker crawls one area at a
+        time into its own shard database, all of them sharing one request
+        budget (settings.REQUEST_BUDGET), one rate limiter and the adverts
+        listed so far, so an advert listed in several areas is fetched once.
+        The workers are given the ids of the known rooms once instead of
+        loading the database for every area. The shards are then merged,
+        keeping the most recently fetched copy of a room, and rated once.
+        """
+
+        start = time()
+        directory = tempfile.mkdtemp(prefix='shards-', dir=os.path.dirname(os.path.abspath(self.file_name)))
+        budget = multiprocessing.Value('i', settings.REQUEST_BUDGET) if settings.REQUEST_BUDGET > 0 else None
+        values = dict((key, value) for key, value in vars(settings).items() if key.isupper())
+
+        tasks = [(self.__class__, dict(self.preferences), area, self.state, os.path.join(directory, '{n}.json'.format(n=n))) for n, area in enumerate(self.AREAS)]
+
+        manager = multiprocessing.Manager()
+        try:
+            shared = {'budget': budget, 'claimed': manager.dict(), 'bucket': SharedRateLimiter.create_bucket(), 'known': frozenset(self.rooms)}
+            pool = multiprocessing.Pool(processes, initializer=init_crawl_worker, initargs=(values, shared))
             try:
-                self.rooms[room]['new'] = True
-                if settings.UPDATE:
-                    room = self.get_room_info(self.rooms[room]['id'], self.rooms[room]['search'])
-                self.rate_room(room)
-            except Exception as e:
-                if settings.DEBUG:
-                    print("Error rating room: {message}".format(message=e.message))
-                continue
+                shards = []
+                for area, shard, elapsed, requests_sent, metrics in pool.imap_unordered(crawl_shard, tasks):
+                    shards.append(shard)
+                    self.metrics.merge(metrics)
+                    if settings.VERBOSE:
+                        print('Crawled {area} in {elapsed:.2f} seconds ({requests} requests)'.format(area=area, elapsed=elapsed, requests=requests_sent))
+            finally:
+                pool.close()
+                pool.join()
+
+            merged = self.merge_shards(shards)
+        finally:
+            manager.shutdown()
+            shutil.rmtree(directory)
+
+        fingerprint = self.get_rating_fingerprint()
+        self.rate_rooms([key for key in self.rooms if self.needs_rating(key, fingerprint)])
         self.save_rooms()
 
+        if settings.VERBOSE:
+            print('Crawled {areas} areas with {processes} processes in {elapsed:.2f} seconds, merged {rooms} rooms'.format(areas=len(tasks), processes=processes, elapsed=time() - start, rooms=merged))
+
+    def merge_shards(self, shards):
+        """
+        Merges the rooms and crawl state of the shard databases, returns the
+        number of rooms merged. The areas an advert was listed in by the
+        processes that left it to another one, or to the main database, are
+        added to the room. Only the state a shard changed is merged.
+        """
+
+        merged, listed_in = set(), {}
+        original = json.loads(json.dumps(self.state))
+        for shard in shards:
+            store = SQLiteRoomStore(shard)
+            try:
+                rooms = store.load()
+                state = store.load_state()
+            except (IOError, ValueError, sqlite3.Error):
+                continue
+            finally:
+                store.close()
+
+            for key, room in rooms.items():
+                current = self.rooms.get(key)
+                if current is None or room.get('fetched', '') >= current.get('fetched', ''):
+                    if current is not None:
+                        for area in current.get_areas():
+                            room.add_area(area)
+                    self.rooms[key] = room
+                else:
+                    for area in room.get_areas():
+                        self.add_area(key, area)
+                merged.add(key)
+
+            for room_id, areas in state.pop('listed_in', {}).items():
+                listed_in.setdefault(room_id, []).extend(areas)
+            # every shard starts from the same state, only its changes are kept
+            for key, value in state.items():
+                if isinstance(value, dict):
+                    changed = dict((name, item) for name, item in value.items() if original.get(key, {}).get(name) != item)
+                    self.state.setdefault(key, {}).update(changed)
+
+        for room_id, areas in listed_in.items():
+            for area in areas:
+                if room_id in self.rooms and self.rooms[room_id].add_area(area):
+                    self.rooms.touch(room_id)
+                    merged.add(room_id)
+        return len(merged)
+
+    @timed('get_room_info')
     def get_room_info(self, room_id, search):
+        try:
+            room = self.fetch_room_info(room_id, search)
+        except Unreachable:
+            return None
+        if room is None:
+            return None
+
+        self.store_room(room_id, room)
+        return room
+
+    def store_room(self, room_id, room):
+        """
+        Stores a fetched room. The rating and areas of the room it replaces
+        are kept, it is only rated again if the scored fields changed. The
+        listing-only rooms of a hybrid crawl (with a bound) were rated on a
+        guessed availability, their rating is not kept.
+        """
+
+        previous = self.rooms.get(room_id)
+        if previous is not None and 'rated_with' in previous and 'bound' not in previous:
+            for field in ('score', 'new', 'rated_with', 'rated_fields'):
+                room[field] = previous[field]
+
+        # and so are the areas it was found in
+        if previous is not None:
+            for area in previous.get_areas():
+                room.add_area(area)
+        for area in self.seen.get(room_id, ()):
+            room.add_area(area)
+
+        self.rooms[room_id] = room
+
+    def fetch_room_info(self, room_id, search, revalidate=False):
+        """
+        Returns the details of a room without storing it, None if the server
+        failed or the advert is not valid. Raises NotFound if the advert was
+        removed and Unreachable if the server could not be asked.
+
+        revalidate -- asks the server even if the details are cached
+        """
         pass
 
-    def update(self):
-        for room in self.rooms:
-            try:
-                self.get_room_info(room, self.rooms[room]['search'])
-            except:
-                self.rooms[room]['new'] = False
+    def get_rooms_info(self, room_ids, search):
+        """
+        Gets the details of several rooms using settings.WORKERS threads.
+        Rooms are stored in the same order as room_ids, so the results are the
+        same as calling get_room_info for each room.
+        """
+
+        def fetch(room_id):
+            with self.metrics.timer('get_room_info'):
+                try:
+                    return self.fetch_room_info(room_id, search)
+                except (NotFound, Unreachable):
+                    return None
+
+        if settings.WORKERS <= 1 or len(room_ids) < 2:
+            rooms = [fetch(room_id) for room_id in room_ids]
+        else:
+            with ThreadPoolExecutor(max_workers=settings.WORKERS) as pool:
+                rooms = list(pool.map(fetch, room_ids))
+
+        for room_id, room in zip(room_ids, rooms):
+            if room is not None:
+                self.store_room(room_id, room)
+        return rooms
+
+    def plan_refresh(self, budget=0):
+        """
+        Returns the keys of the rooms worth fetching again, best first. Rooms
+        shown in the reports go before the others, then the higher their score
+        and the longer since they were fetched the sooner they are refreshed.
+
+        budget -- maximum number of rooms returned (0 for all of them)
+        """
+
+        now = to_epoch(datetime.now())
+        priority = lambda key: self.get_refresh_priority(key, now)
+
+        if budget > 0:
+            return heapq.nlargest(budget, self.rooms, key=priority)
+        return sorted(self.rooms, key=priority, reverse=True)
+
+    def get_refresh_priority(self, key, now):
+        """Returns the sort key of a room in plan_refresh, now in epoch seconds."""
+
+        room = self.rooms[key]
+        fetched = room.get('fetched')
+        age = now - to_epoch(fetched) if fetched else now
+        return (bool(room.get('new')), (1 + max(0, room.get('score', 0))) * max(0, age))
+
+    def refresh(self, budget=0):
+        """
+        Fetches again the rooms chosen by plan_refresh using settings.WORKERS
+        threads, asking the server even for the details in the response cache.
+        Rooms whose advert was removed, or that could not be fetched
+        retire_errors times in a row, are retired from the database.
+
+        budget -- maximum number of rooms fetched (0 for all of them)
+        """
+
+        if self.chunked:
+            updated, retired, total = self.refresh_in_batches(budget)
+        else:
+            updated, retired = self.refresh_rooms(self.plan_refresh(budget))
+            total = len(self.rooms) + retired
+
+        self.metrics.count('rooms_refreshed', updated)
+        self.metrics.count('rooms_retired', retired)
+        if settings.VERBOSE:
+            print('Refreshed {updated} of {rooms} rooms, retired {retired}'.format(updated=updated, rooms=total, retired=retired))
+        return updated, retired
+
+    def refresh_in_batches(self, budget=0):
+        """
+        Refreshes the rooms reading the store in batches. With a budget, a
+        first pass keeps the keys of the budget rooms plan_refresh would
+        choose, the second one fetches them batch by batch. Returns the rooms
+        updated, retired and read.
+
+        budget -- maximum number of rooms fetched (0 for all of them)
+        """
+
+        chosen = None
+        if budget > 0:
+            now, best = to_epoch(datetime.now()), []
+            for batch in self.iter_batches():
+                best = heapq.nlargest(budget, best + [(self.get_refresh_priority(key, now), key) for key in batch])
+            chosen = set(key for _, key in best)
+
+        updated = retired = total = 0
+        for batch in self.iter_batches():
+            total += len(batch)
+            keys = self.plan_refresh()
+            if chosen is not None:
+                keys = [key for key in keys if key in chosen]
+            batch_updated, batch_retired = self.refresh_rooms(keys)
+            updated, retired = updated + batch_updated, retired + batch_retired
+        return updated, retired, total
+
+    def refresh_rooms(self, keys):
+        """
+        Fetches again the rooms of the keys, returns the rooms updated and
+        retired. Only server failures and invalid adverts count as errors,
+        rooms are never retired without asking the server.
+        """
+
+        def fetch(key):
+            with self.metrics.timer('get_room_info'):
+                try:
+                    return self.fetch_room_info(key, self.rooms[key]['search'], revalidate=True), None
+                except (NotFound, Unreachable) as e:
+                    return None, e
+
+        if settings.WORKERS <= 1 or len(keys) < 2:
+            results = [fetch(key) for key in keys]
+        else:
+            with ThreadPoolExecutor(max_workers=settings.WORKERS) as pool:
+                results = list(pool.map(fetch, keys))
+
+        updated = retired = 0
+        for key, (room, error) in zip(keys, results):
+            if room is not None:
+                self.store_room(key, room)
+                updated += 1
+                continue
+
+            # nothing is known about the advert, replayed responses included
+            if isinstance(error, Unreachable) or settings.CACHE_ONLY:
+                self.metrics.count('updates_skipped')
                 continue
+
+            self.metrics.count('update_errors')
+            errors = self.rooms[key].get('errors', 0) + 1
+            if isinstance(error, NotFound) or errors >= self.retire_errors:
+                del self.rooms[key]
+                retired += 1
+                continue
+
+            self.rooms[key]['errors'] = errors
+            self.rooms.touch(key)
+        return updated, retired
+
+    def update(self):
+        """Refreshes the rooms within settings.REFRESH_BUDGET requests and saves them."""
+
+        self.refresh(settings.REFRESH_BUDGET)
         self.save_rooms()
 
-    def generate_report(self, fields=None, pref_ids=[], max_range=-1, when=False, areas=False):
-        name = str(self.__class__.__name__).split(' ')[0]
-        html = '<html><head><title>{name} Classified Ads</title><link rel="stylesheet" href="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.1/css/bootstrap.min.css"></head><body>'.format(name=name)
-        html += '<table class="table">'
-        html += '<thead><tr>'
-        for field in fields:
-            html += '<th>{field}</th>'.format(field=field.replace('_', ' ').capitalize())
-        html += '</tr></thead><tbody>'
-        for i, room in enumerate(self.get_sorted()):
-            if when:
-                try:
-                    available_time = datetime.strptime(room['timestamp'], "%Y-%m-%d %H:%M:%S")
-                    if available_time < WHEN:
-                        continue
-                except:
-                    available_time = datetime.strptime(room['timestamp'], "%Y-%m-%d %H:%M:%S.%f")
-                    if available_time < WHEN:
-                        continue
+    def get_room_url(self, room_id):
+        """Returns the url of a room in the web site."""
 
-            if (room['new'] or room['id'] in pref_ids) and room['search'] in self.AREAS:
-                htmlclass = 'success' if room['new'] else 'danger' if room['id'] in pref_ids else 'info'
-                html += '<tr class="{css}">'.format(css=htmlclass)
-                for field in fields:
-                    if field == 'id':
-                        url = '{location}/{endpoint}{id}'.format(location=self.location, endpoint=self.details_endpoint, id=room['id'])
-                        html += '<td><a target="_blank" href="{url}">{field}</td>'.format(url=url, field=room[field])
-                    elif field == 'images':
-                        pics = ['<a href="{url}"><img src="{src}" height="100" width="100"></a>'.format(url=img, src=img) for img in room['images']]
-                        images = ''
-                        for i in range(5):
-                            images += pics[i] if len(pics) > i else ''
-                        html += '<td>{images}</td>'.format(images=images)
-                    else:
-                        html += '<td>{value}</td>'.format(value=room[field])
-                html += '</tr>'
-                max_range -= 1
+        return '{location}/{endpoint}{id}'.format(location=self.location, endpoint=self.details_endpoint, id=room_id)
 
-            if max_range == 0:
-                break
+    def get_report_filters(self, pref_ids=[], when=False):
+        """Returns the top_rooms filters of the rooms in a report."""
+
+        return {'when': when and settings.WHEN, 'new': True, 'pref_ids': pref_ids, 'areas': self.AREAS}
+
+    def get_report_writer(self, fields, output_format='html', page_size=0):
+        """Returns the report writer of the output format."""
+
+        file_name = self.file_name.replace('.json', '')
+        if output_format == 'html' and page_size > 0:
+            return PaginatedHTMLReportWriter(self, file_name, fields, page_size)
+        return REPORT_WRITERS[output_format](self, file_name, fields)
+
+    @timed('generate_report')
+    def generate_report(self, fields=None, pref_ids=[], max_range=-1, when=False, areas=False, output_format='html', page_size=0):
+        """
+        Writes the best new rooms to a report named after the database file.
+
+        fields -- room fields in each row
+        pref_ids -- rooms always reported, even if they are not new
+        max_range -- maximum number of rooms in the report (-1 for all)
+        when -- only report rooms available from settings.WHEN
+        output_format -- html, csv or jsonl
+        page_size -- rooms in each page of an html report (0 for one page)
+        """
+
+        rooms = self.top_rooms(max_range, self.get_report_filters(pref_ids, when))
+        if self.images is not None and output_format == 'html' and 'images' in (fields or []):
+            self.prefetch_images(rooms, HTMLReportWriter.images_per_row)
+
+        writer = self.get_report_writer(fields, output_format, page_size)
+        writer.open()
+
+        try:
+            for room in rooms:
+                css = 'success' if room['new'] else 'danger' if room['id'] in pref_ids else 'info'
+                writer.write_row(room, css)
+        finally:
+            writer.close()
+
+    @timed('prefetch_images')
+    def prefetch_images(self, rooms, per_room=5):
+        """
+        Downloads the first images of the rooms that are not in the image
+        cache yet using settings.WORKERS threads, and caches their thumbnails.
+        Returns the number of images downloaded, none with settings.CACHE_ONLY.
+
+        rooms -- rooms in the report
+        per_room -- images shown for each room
+        """
+
+        urls, seen = [], set()
+        for room in rooms:
+            for url in room.get('images', [])[:per_room]:
+                if url not in seen and self.images.get(url) is None:
+                    urls.append(url)
+                seen.add(url)
+
+        # no requests at all, the report links the images not cached
+        if settings.CACHE_ONLY:
+            if settings.VERBOSE:
+                print('Skipped {count} images not in the image cache'.format(count=len(urls)))
+            return 0
+
+        def fetch(url):
+            self.get_limiter(url).wait()
+            self.metrics.count('image_requests')
+            try:
+                response = self.session.get(url, timeout=settings.TIMEOUT)
+                if response.status_code != 200:
+                    raise IOError('{url} answered {status}'.format(url=url, status=response.status_code))
+                self.images.put(url, response.content)
+            except (requests.RequestException, IOError, OSError) as e:
+                self.metrics.count('image_errors')
+                if settings.DEBUG:
+                    print('Error getting image {url}: {message}'.format(url=url, message=e))
+                return False
+            return True
 
-        html += '<tbody></table><script src="https://maxcdn.bootstrapcdn.com/bootstrap/3.3.1/js/bootstrap.min.js"></script></body></html>'
+        if settings.WORKERS <= 1 or len(urls) < 2:
+            fetched = sum(fetch(url) for url in urls)
+        else:
+            with ThreadPoolExecutor(max_workers=settings.WORKERS) as pool:
+                fetched = sum(pool.map(fetch, urls))
 
-        with open(self.file_name.replace('.json', '.html'), 'w') as f:
-            f.write(html.encode('utf-8'))
+        if settings.VERBOSE:
+            print('Downloaded {fetched} of {count} new images'.format(fetched=fetched, count=len(urls)))
+        return fetched
 
     def get_score(self, scores=None, key=None):
         if not scores or not key:
@@ -173,11 +2639,12 @@ class SearchEngine(object):
                     print("    {key}: {score}".format(key=key, score=scores[i]))
                 return scores[i]
 
+    @timed('rate_room')
     def rate_room(self, key=None):
-        if not key or key not in self.rooms:
+        if not key or key not in self.rooms or not self.scoring:
             return
 
-        SCORES = [0.25, 0.20, 0.20, 0.15, 0.10, 0.05, 0.05]
+        SCORES = self.SCORES
 
         """Score variables:
         price + deposit - 0.10
@@ -195,7 +2662,7 @@ class SearchEngine(object):
 
         areas = [area.lower() for area in self.AREAS]
         # check station, give better score if first stations
-        area_score = (len(areas) - areas.index(room['station'].lower()))*(100/len(areas)) if room['station'].lower() in areas else 0
+        area_score = (len(areas) - areas.index(room.station.lower()))*(100/len(areas)) if room.station.lower() in areas else 0
 
         if settings.DEBUG:
             print("AREA SCORE: {score}".format(score=area_score))
@@ -203,7 +2670,7 @@ class SearchEngine(object):
         score = area_score * self.get_score(SCORES, 'areas')
 
         # lower price -> better score
-        price = min(room['prices'])
+        price = min(room.prices)
         MAX_RENT_PM = self.preferences['max_rent']
         difference = abs(int(price) - MAX_RENT_PM)
         price_score = max(0, 50 - (difference)/10) if price >= MAX_RENT_PM else min(100, 50 + (difference)/10)
@@ -215,7 +2682,7 @@ class SearchEngine(object):
 
         #score += 100 if price < MAX_RENT_PM - 150 else 80 if price < MAX_RENT_PM - 100 else 50 if price < MAX_RENT_PM - 50 else 20 if price < MAX_RENT_PM else 0
 
-        deposit = min(room['deposits']) if len(room['deposits']) > 0 else 0
+        deposit = min(room.deposits) if len(room.deposits) > 0 else 0
         difference = abs(int(deposit) - MAX_RENT_PM)
         deposit_score = max(0, 50 - (difference)/10) if deposit >= MAX_RENT_PM else min(50, 50 + (difference)/10)
         #score += 20 if deposit != -1 and deposit <= price else 0
@@ -226,9 +2693,9 @@ class SearchEngine(object):
         score += deposit_score * self.get_score(SCORES, 'price') / 4
 
         # bills includes - better score - 0.05
-        score += (self.get_score(SCORES, 'price') * 100) if room['bills'] else 0
+        score += (self.get_score(SCORES, 'price') * 100) if room.bills else 0
 
-        rooms_score = max(0, 100 - (int(room['rooms']) - 1)*15)
+        rooms_score = max(0, 100 - (int(room.rooms) - 1)*15)
 
         if settings.DEBUG:
             print("ROOMS SCORE: {score}".format(score=rooms_score))
@@ -236,9 +2703,9 @@ class SearchEngine(object):
         score += rooms_score * self.get_score(SCORES, 'rooms')
 
         # less housemates - better score
-        if room['housemates'] != -1:
-            housemates_score = max(0, 100 - (int(room['housemates']) - 1)*10)/2
-            housemates_score += int(room['females'])/int(room['housemates'])*100/2
+        if room.housemates != -1:
+            housemates_score = max(0, 100 - (int(room.housemates) - 1)*10)/2
+            housemates_score += int(room.females)/int(room.housemates)*100/2
             #score += 50 if room['housemates'] < 0 else 40 if room['housemates'] < 2 else 30 if room['housemates'] < 4 else 0
 
             if settings.DEBUG:
@@ -249,43 +2716,189 @@ class SearchEngine(object):
         # more images - better score
         # no images -> -100
         #score += 7*len(room['images']) if len(room['images']) > 0 else - 100
-        image_score = min(100, 25*len(room['images']))
+        image_score = min(100, 25*len(room.images))
 
         if settings.DEBUG:
             print("IMAGE SCORE: {score}".format(score=image_score))
 
-        score += image_score * self.get_score(SCORES, 'images')
+        score += image_score * self.get_score(SCORES, 'images')
+
+        # if phone - better score
+        #score += 100 if room['phone'] else 0
+
+        # the closer (or now) the room is available to desired - better score
+        available_time = room.timestamp
+
+        difference = abs(to_epoch(self.preferences['when']) - available_time)
+        #score += 100 if difference > 0 else 80 if difference > -2880 else 50 if difference > -7200 else 0
+        available_score = max(0, 100 - (difference/60/60/24))
+
+        if settings.DEBUG:
+            print("AVAILABLE SCORE: {score}".format(score=available_score))
+
+        score += available_score * self.get_score(SCORES, 'when')
+
+        if settings.DEBUG:
+            print("FINAL SCORE: {score}".format(score=score))
+
+        if to_epoch(settings.MIN_AVAILABLE_TIME) > available_time:
+            self.rooms[key]['new'] = False
+            score = 0
+
+        self.rooms[key]['score'] = score
+        self.stamp_rating(key)
+        self.rooms.touch(key)
+
+    def get_scoring_columns(self, keys):
+        """
+        Extracts the fields used by rate_room into one column per field.
+        Rooms that rate_room could not score are left out.
+        """
+
+        areas = [area.lower() for area in self.AREAS]
+        ranks = {}
+        for i, area in enumerate(areas):
+            ranks.setdefault(area, len(areas) - i)
+
+        columns = {'keys': []}
+        for name in self.SCORING_COLUMNS:
+            columns[name] = array('d')
+
+        for key in keys:
+            room = self.rooms.get(key)
+            try:
+                has_housemates = room.housemates != -1
+                housemates = int(room.housemates) if has_housemates else 1
+                females = int(room.females) / housemates if has_housemates else 0
+                row = (
+                    ranks.get(room.station.lower(), 0),
+                    min(room.prices),
+                    min(room.deposits) if len(room.deposits) > 0 else 0,
+                    1 if room.bills else 0,
+                    int(room.rooms),
+                    1 if has_housemates else 0,
+                    housemates,
+                    females,
+                    len(room.images),
+                    room.timestamp,
+                )
+            except (KeyError, TypeError, ValueError, AttributeError, ZeroDivisionError):
+                continue
+
+            columns['keys'].append(key)
+            for name, value in zip(self.SCORING_COLUMNS, row):
+                columns[name].append(value)
+
+        return columns
+
+    def score_columns(self, columns):
+        """
+        Computes the rate_room score of every row of the scoring columns at
+        once. Rooms available before settings.MIN_AVAILABLE_TIME score 0.
+        """
+
+        weights = dict((key, self.get_score(self.SCORES, key) or 0) for key in ('areas', 'price', 'rooms', 'housemates', 'images', 'when'))
+        area_step = 100.0 / len(self.AREAS) if self.AREAS else 0
+        max_rent = self.preferences['max_rent']
+        when = (self.preferences['when'] - EPOCH).total_seconds()
+        min_available = (settings.MIN_AVAILABLE_TIME - EPOCH).total_seconds()
+
+        if numpy is None:
+            scores = array('d')
+            for rank, price, deposit, bills, rooms, has_housemates, housemates, females, images, available in zip(*[columns[name] for name in self.SCORING_COLUMNS]):
+                if available < min_available:
+                    scores.append(0)
+                    continue
 
-        # if phone - better score
-        #score += 100 if room['phone'] else 0
+                difference = abs(price - max_rent)
+                price_score = max(0, 50 - difference / 10) if price >= max_rent else min(100, 50 + difference / 10)
+                difference = abs(deposit - max_rent)
+                deposit_score = max(0, 50 - difference / 10) if deposit >= max_rent else 50
+
+                score = rank * area_step * weights['areas']
+                score += price_score * weights['price'] * 3 / 4
+                score += deposit_score * weights['price'] / 4
+                score += bills * weights['price'] * 100
+                score += max(0, 100 - (rooms - 1) * 15) * weights['rooms']
+                if has_housemates:
+                    score += (max(0, 100 - (housemates - 1) * 10) / 2 + females * 100 / 2) * weights['housemates']
+                score += min(100, 25 * images) * weights['images']
+                score += max(0, 100 - abs(when - available) / 60 / 60 / 24) * weights['when']
+                scores.append(score)
+            return scores
+
+        rank, price, deposit, bills, rooms, has_housemates, housemates, females, images, available = [numpy.frombuffer(columns[name], dtype=numpy.float64) for name in self.SCORING_COLUMNS]
+
+        difference = numpy.abs(price - max_rent)
+        price_score = numpy.where(price >= max_rent, numpy.maximum(0, 50 - difference / 10), numpy.minimum(100, 50 + difference / 10))
+        difference = numpy.abs(deposit - max_rent)
+        deposit_score = numpy.where(deposit >= max_rent, numpy.maximum(0, 50 - difference / 10), 50)
+
+        scores = rank * area_step * weights['areas']
+        scores += price_score * weights['price'] * 3 / 4
+        scores += deposit_score * weights['price'] / 4
+        scores += bills * weights['price'] * 100
+        scores += numpy.maximum(0, 100 - (rooms - 1) * 15) * weights['rooms']
+        scores += has_housemates * (numpy.maximum(0, 100 - (housemates - 1) * 10) / 2 + females * 100 / 2) * weights['housemates']
+        scores += numpy.minimum(100, 25 * images) * weights['images']
+        scores += numpy.maximum(0, 100 - numpy.abs(when - available) / 60 / 60 / 24) * weights['when']
+        return numpy.where(available < min_available, 0, scores)
+
+    def get_score_bounds(self, keys, unknown):
+        """
+        Returns the highest score each room could get once all its fields are
+        known, giving the unknown fields their best values.
 
-        # the closer (or now) the room is available to desired - better score
-        try:
-            available_time = datetime.strptime(room['timestamp'], "%Y-%m-%d %H:%M:%S")
-        except:
-            available_time = datetime.strptime(room['timestamp'], "%Y-%m-%d %H:%M:%S.%f")
+        keys -- rooms to bound
+        unknown -- SCORED_FIELDS the rooms do not know yet
+        """
 
-        difference = abs((self.preferences['when'] - available_time).total_seconds())
-        #score += 100 if difference > 0 else 80 if difference > -2880 else 50 if difference > -7200 else 0
-        available_score = max(0, 100 - (difference/60/60/24))
+        best = {
+            'station': {'rank': len(self.AREAS)},
+            'prices': {'price': 0},
+            'deposits': {'deposit': 0},
+            'bills': {'bills': 1},
+            'rooms': {'rooms': 1},
+            'housemates': {'has_housemates': 1, 'housemates': 1, 'females': 1},
+            'females': {'females': 1},
+            'images': {'images': 4},
+            'timestamp': {'available': to_epoch(self.preferences['when'])},
+        }
 
-        if settings.DEBUG:
-            print("AVAILABLE SCORE: {score}".format(score=available_score))
+        columns = self.get_scoring_columns(keys)
+        count = len(columns['keys'])
+        for field in unknown:
+            for name, value in best[field].items():
+                columns[name] = array('d', [value]) * count
+        return dict(zip(columns['keys'], self.score_columns(columns)))
 
-        score += available_score * self.get_score(SCORES, 'when')
+    @timed('rate_rooms')
+    def rate_rooms(self, keys=None):
+        """
+        Rates many rooms at once, giving the same scores as rate_room.
 
-        if settings.DEBUG:
-            print("FINAL SCORE: {score}".format(score=score))
+        keys -- rooms to rate (default: all the rooms)
+        """
 
-        if (settings.MIN_AVAILABLE_TIME - available_time).total_seconds() > 0:
-            self.rooms[key]['new'] = False
-            score = 0
+        columns = self.get_scoring_columns(list(self.rooms) if keys is None else keys)
+        min_available = (settings.MIN_AVAILABLE_TIME - EPOCH).total_seconds()
+        fingerprint = self.get_rating_fingerprint()
 
-        self.rooms[key]['score'] = score
+        for key, score, available in zip(columns['keys'], self.score_columns(columns), columns['available']):
+            room = self.rooms[key]
+            if available < min_available:
+                room.new = False
+            room.score = float(score)
+            self.stamp_rating(key, fingerprint)
+            self.rooms.touch(key)
 
 class SpareRoom(SearchEngine):
+    name = 'spareroom'
     headers = {'User-Agent': 'SpareRoomUK 3.1'}
 
+    # scored fields the search results do not give, only the details
+    LISTING_UNKNOWN = ('deposits', 'housemates', 'females', 'images', 'timestamp')
+
     api_location = 'http://iphoneapp.spareroom.co.uk'
     api_search_endpoint = 'flatshares'
     api_details_endpoint = 'flatshares'
@@ -294,77 +2907,333 @@ class SpareRoom(SearchEngine):
     details_endpoint = 'flatshare/flatshare_detail.pl?flatshare_id='
     file_name = 'spareroom.json'
 
+    # search pages change with every new advert, details rarely change
+    search_cache_ttl = 15 * 60
+    details_cache_ttl = 24 * 60 * 60
+
+    # incremental crawls sort the results newest first and stop on the first
+    # page with this ratio of known adverts (or with the last newest advert)
+    newest_first = {'sort_by': 'days_since_placed'}
+    known_page_ratio = 0.8
+
+    # queue size between the pipeline stages and rooms saved at once
+    pipeline_queue_size = 100
+    persist_batch_size = 200
+
     preferences = {}
 
+    def get_cache_ttl(self, url):
+        if urlparse(url).path.startswith('/{endpoint}/'.format(endpoint=self.api_details_endpoint)):
+            return self.details_cache_ttl
+
+        # watched areas are searched again for the adverts listed since,
+        # sooner than a cached results page gets stale
+        if settings.WATCH:
+            return 0
+        return self.search_cache_ttl
+
     def get_new_rooms(self):
+        self.start_crawl()
+
+        if settings.HYBRID:
+            self.crawl_hybrid()
+        elif settings.PROCESSES > 1 and len(self.AREAS) > 1:
+            self.crawl_processes(settings.PROCESSES)
+        elif settings.PIPELINE:
+            self.crawl_pipeline()
+        else:
+            for area in self.AREAS:
+                self.search_rooms_in(area)
+                self.save_rooms()
+
+        if settings.VERBOSE and settings.INCREMENTAL:
+            print('Incremental crawl: fetched {pages} result pages, saved {pages_saved} page requests, {pages_failed} pages failed'.format(**self.crawl_stats))
+        if settings.VERBOSE:
+            print('Skipped {duplicates} adverts listed more than once, avoided {fetches_avoided} duplicate detail requests'.format(**self.crawl_stats))
+        if settings.VERBOSE and settings.HYBRID:
+            print('Hybrid crawl: skipped the details of {details_skipped} adverts that could not make the report'.format(**self.crawl_stats))
+
+    def search_rooms_in(self, area):
+        for results in self.iter_results_pages(area):
+            self.parse_results_page(results, area)
+
+    def crawl_hybrid(self):
+        """
+        Crawls all the areas reading only the listings, like settings.FAST,
+        then fetches the details of the adverts best first while they could
+        still make the report: an advert whose score, with the best values
+        for the fields missing from its listing, is not above the
+        settings.MAX_RESULTS best full scores is left as listed.
+        """
+
+        listings = {}
         for area in self.AREAS:
-            self.search_rooms_in(area)
+            for results in self.iter_results_pages(area):
+                for listing in results['results']:
+                    room_id = listing['advert_id']
+                    if not self.first_listing(room_id, area):
+                        continue
+
+                    if room_id in self.rooms:
+                        self.add_area(room_id, area)
+                        if 'bound' not in self.rooms[room_id]:
+                            self.metrics.count('rooms_skipped')
+                            if self.needs_rating(room_id):
+                                self.rate_room(room_id)
+                            continue
+                    else:
+                        self.get_short_room_info(room_id, area, listing)
+                        if room_id not in self.rooms:
+                            continue
+                    listings[room_id] = listing
             self.save_rooms()
 
-    def search_rooms_in(self, area):
+        keys = list(listings)
+        self.rate_rooms(keys)
+        bounds = self.get_score_bounds([key for key in keys if 'rooms_in_property' in listings[key]], self.LISTING_UNKNOWN)
+        bounds.update(self.get_score_bounds([key for key in keys if 'rooms_in_property' not in listings[key]], self.LISTING_UNKNOWN + ('rooms',)))
+        for key, bound in bounds.items():
+            self.rooms[key]['bound'] = float(bound)
+
+        # the scores to beat, the k best full scores of the rooms the report
+        # would show in a min-heap
+        k = settings.MAX_RESULTS if settings.MAX_RESULTS > 0 else len(self.rooms)
+        best = heapq.nlargest(k, (room.score for room in self.top_rooms(-1, self.get_report_filters()) if 'bound' not in room and 'score' in room))
+        heapq.heapify(best)
+
+        candidates = sorted(bounds, key=bounds.get, reverse=True)
+        batch = max(1, settings.WORKERS)
+        while candidates:
+            threshold = best[0] if len(best) >= k else None
+            if threshold is not None and bounds[candidates[0]] <= threshold:
+                break
+
+            room_ids, candidates = candidates[:batch], candidates[batch:]
+            by_search = {}
+            for room_id in room_ids:
+                by_search.setdefault(self.rooms[room_id]['search'], []).append(room_id)
+            for search, ids in by_search.items():
+                self.get_rooms_info(ids, search)
+
+            for room_id in room_ids:
+                room = self.rooms[room_id]
+                if 'bound' in room:
+                    continue
+                self.rate_room(room_id)
+                if room['new']:
+                    if len(best) < k:
+                        heapq.heappush(best, room['score'])
+                    else:
+                        heapq.heappushpop(best, room['score'])
+            self.save_rooms()
+
+        self.crawl_stats['details_skipped'] += len(candidates)
+        self.metrics.count('details_skipped', len(candidates))
+
+    def iter_results_pages(self, area):
+        """
+        Yields the decoded results pages of an area, up to settings.MAX_PAGES.
+        In an incremental crawl it stops after the first page of known adverts.
+        The high-water mark of the area only moves once every page before it
+        was read, after a failed page the next crawl searches down to the old
+        mark again.
+        """
+
         if settings.VERBOSE:
             print('Searching for {area} flats in SpareRoom'.format(area=area))
 
-        self.preferences['page'] = 1
         self.preferences['where'] = area.lower()
-        params = '&'.join(['{key}={value}'.format(key=key, value=self.preferences[key]) for key in self.preferences])
-        url = '{location}/{endpoint}?{params}'.format(location=self.api_location, endpoint=self.api_search_endpoint, params=params)
+        if settings.INCREMENTAL:
+            self.preferences.update(self.newest_first)
+
+        marks = self.state.setdefault('high_water_marks', {})
+        mark = marks.get(area) if settings.INCREMENTAL else None
 
         try:
-            results = json.loads(self.make_get_request(url=url, cookies=self.cookies, headers=self.headers))
+            results = self.get_results_page(1)
             if settings.DEBUG:
                 print(results)
 
+            known = mark is not None and self.is_known_page(results, mark)
+        except Exception as e:
             if settings.VERBOSE:
-                print('Parsing page {page}/{total} flats in {area}'.format(page=results['page'], total=results['pages'], area=area))
-
-            for room in results['results']:
-                room_id = room['advert_id']
+                print(traceback.format_exc())
+            logging.error('Error parsing {area} first page: {message}'.format(area=area, message=e), extra={'engine': self.__class__.__name__, 'function': 'search_rooms_in'})
+            return
 
-                if room_id in self.rooms:
-                    self.rate_room(room_id)
-                    continue
+        # the first advert of the first page is the newest one of the area
+        newest = results['results'][0]['advert_id'] if settings.INCREMENTAL and results['results'] else None
 
-                if settings.FAST:
-                    self.get_short_room_info(room_id, area, room)
-                else:
-                    self.get_room_info(room_id, area)
+        yield results
 
-                self.rate_room(room_id)
-        except Exception as e:
-            if settings.VERBOSE:
-                print(traceback.format_exc())
-                print('Error parsing first page: {message}'.format(message=e.message))
-                exit(0)
-            return None
+        total = results['pages']
+        last = min(int(total), settings.MAX_PAGES)
+        fetched, failed = 1, 0
+        for page in range(1, last):
+            if known:
+                break
 
-        for page in range(1, min(int(results['pages']), settings.MAX_PAGES)):
-            self.preferences['page'] = page + 1
-            params = '&'.join(['{key}={value}'.format(key=key, value=self.preferences[key]) for key in self.preferences])
-            url = '{location}/{endpoint}?{params}'.format(location=self.api_location, endpoint=self.api_search_endpoint, params=params)
             try:
-                results = json.loads(self.make_get_request(url=url, cookies=self.cookies, headers=self.headers))
+                results = self.get_results_page(page + 1)
+                fetched += 1
             except Exception as e:
+                failed += 1
                 if settings.VERBOSE:
-                    print('Error Getting {page}/{total}: {message}'.format(page=page, total=results['pages'], message=e.message))
+                    print('Error Getting {page}/{total}: {message}'.format(page=page + 1, total=total, message=e))
+                continue
+
+            known = mark is not None and self.is_known_page(results, mark)
+            yield results
+
+        self.crawl_stats['pages'] += fetched
+        self.crawl_stats['pages_failed'] += failed
+        self.crawl_stats['pages_saved'] += last - fetched - failed
+        if newest is not None and not failed:
+            marks[area] = {'advert_id': newest, 'crawled': str(datetime.now())}
+        elif failed and mark is not None:
+            marks[area] = dict(mark, partial=True)
+        if known and settings.VERBOSE:
+            print('Reached known {area} adverts, skipped {pages} pages'.format(area=area, pages=last - fetched - failed))
+
+    def crawl_pipeline(self):
+        """
+        Crawls all the areas as a pipeline, so the next results page is
+        downloaded while the rooms of the previous one are fetched and scored:
+
+        listing pages -> detail fetcher -> parser -> scorer -> persister
+        """
+
+        def listings():
+            for area in self.AREAS:
+                for results in self.iter_results_pages(area):
+                    for listing in results['results']:
+                        room_id = listing['advert_id']
+                        if not self.first_listing(room_id, area):
+                            continue
+
+                        # known rooms skip fetching and parsing
+                        if room_id in self.rooms:
+                            self.metrics.count('rooms_skipped')
+                            self.add_area(room_id, area)
+                        yield (room_id, area, None if room_id in self.rooms else listing, None)
+
+        def fetch(item):
+            room_id, area, listing, _ = item
+            if listing is None or settings.FAST:
+                return item
 
             if settings.VERBOSE:
-                print('Parsing page {page}/{total} flats in {area}'.format(page=results['page'], total=results['pages'], area=area))
+                print('Getting {id} flat details'.format(id=room_id))
+            return (room_id, area, listing, self.make_get_request(url=self.get_details_url(room_id), cookies=self.cookies, headers=self.headers))
+
+        def parse(item):
+            room_id, area, listing, text = item
+            if listing is None:
+                return room_id
+
+            if settings.FAST:
+                with self.lock:
+                    self.get_short_room_info(room_id, area, listing)
+                return room_id
+
+            room = self.parse_room_info(room_id, area, text)
+            if room is None:
+                return None
+
+            with self.lock:
+                self.store_room(room_id, room)
+            return room_id
+
+        def score(room_id):
+            with self.lock:
+                if room_id not in self.rooms or not self.needs_rating(room_id):
+                    return None
+                self.rate_room(room_id)
+            return room_id
 
-            for room in results['results']:
-                room_id = room['advert_id']
+        batch = []
+        def persist(room_id):
+            batch.append(room_id)
+            if len(batch) >= self.persist_batch_size:
+                flush()
 
-                if room_id in self.rooms:
-                    self.rate_room(room_id)
-                    continue
+        def flush():
+            del batch[:]
+            self.save_rooms()
 
-                if settings.FAST:
-                    self.get_short_room_info(room_id, area, room)
-                else:
-                    self.get_room_info(room_id, area)
+        pipeline = Pipeline([
+            Stage('fetch', fetch, workers=max(1, settings.WORKERS), size=self.pipeline_queue_size),
+            Stage('parse', parse, size=self.pipeline_queue_size),
+            Stage('score', score, size=self.pipeline_queue_size),
+            Stage('persist', persist, size=self.pipeline_queue_size, flush=flush),
+        ])
+        pipeline.run(listings())
+
+        if settings.VERBOSE:
+            print('Pipeline finished in {elapsed:.2f} seconds'.format(elapsed=pipeline.elapsed))
+            for stage in pipeline.stats():
+                print('  {stage}: {processed} items, {per_second:.1f}/s, busy {busy:.2f}s, max queue {max_depth}'.format(**stage))
+
+        return pipeline
+
+    def is_known_page(self, results, mark):
+        """
+        Checks if an incremental crawl can stop after a results page: it lists
+        the newest advert of the previous crawl or is mostly known adverts.
+        If the previous crawl failed pages, only its newest advert stops it.
+        """
+
+        room_ids = [room['advert_id'] for room in results['results']]
+        if not room_ids or mark['advert_id'] in room_ids:
+            return True
+        if mark.get('partial'):
+            return False
+
+        known = len([room_id for room_id in room_ids if room_id in self.rooms or room_id in self.known])
+        return known >= len(room_ids) * self.known_page_ratio
+
+    def get_results_page(self, page):
+        """Returns the decoded results page for the current search."""
+
+        self.preferences['page'] = page
+        params = '&'.join(['{key}={value}'.format(key=key, value=self.preferences[key]) for key in self.preferences])
+        url = '{location}/{endpoint}?{params}'.format(location=self.api_location, endpoint=self.api_search_endpoint, params=params)
+        text = self.make_get_request(url=url, cookies=self.cookies, headers=self.headers)
+        with self.metrics.timer('json_decode'):
+            return json.loads(text)
+
+    def parse_results_page(self, results, area):
+        """Stores and rates the rooms listed in a results page."""
+
+        if settings.VERBOSE:
+            print('Parsing page {page}/{total} flats in {area}'.format(page=results['page'], total=results['pages'], area=area))
+
+        room_ids = []
+        for room in results['results']:
+            room_id = room['advert_id']
+
+            if not self.first_listing(room_id, area):
+                continue
 
+            if room_id in self.rooms:
+                self.metrics.count('rooms_skipped')
+                self.add_area(room_id, area)
+                if self.needs_rating(room_id):
+                    self.rate_room(room_id)
+                continue
+
+            if settings.FAST:
+                self.get_short_room_info(room_id, area, room)
                 self.rate_room(room_id)
+            else:
+                room_ids.append(room_id)
+
+        # details are fetched concurrently and rated in the listing order
+        self.get_rooms_info(room_ids, area)
+        for room_id in room_ids:
+            self.rate_room(room_id)
 
+    @timed('get_short_room_info')
     def get_short_room_info(self, room_id, search, room_details):
         if settings.VERBOSE:
             print('Parsing {id} flat short details'.format(id=room_id))
@@ -380,15 +3249,15 @@ class SpareRoom(SearchEngine):
 
         images = [room_details['main_image_square_url']] if 'main_image_square_url' in room_details else []
 
-        deposits = prices = []
+        prices, deposits = array('i'), array('i')
         if 'min_rent' in room_details:
             price = int(room_details['min_rent'].split('.', 1)[0])
-            price = price if 'per' in room_details and room_details['per'] == 'pcm' else price * 52 / 12
+            price = price if 'per' in room_details and room_details['per'] == 'pcm' else price * 52 // 12
             prices.append(price)
 
         if 'max_rent' in room_details:
             price = int(room_details['max_rent'].split('.', 1)[0])
-            price = price if 'per' in room_details and room_details['per'] == 'pcm' else price * 52 / 12
+            price = price if 'per' in room_details and room_details['per'] == 'pcm' else price * 52 // 12
             prices.append(price)
 
         phone = False
@@ -397,34 +3266,58 @@ class SpareRoom(SearchEngine):
 
         housemates = males = females = 100
 
-        self.rooms[room_id] = {
-            'id': room_id,
-            'search': search,
-            'images': images,
-            'station': station,
-            'prices': prices,
-            'available': available,
-            'timestamp': str(available_timestamp),
-            'deposits': deposits,
-            'bills': bills,
-            'rooms': rooms_no,
-            'housemates': housemates,
-            'females': females,
-            'males': males,
-            'phone': phone,
-            'new': True,
-        }
-
-    def get_room_info(self, room_id, search):
+        self.store_room(room_id, Room(
+            id=room_id,
+            search=search,
+            images=images,
+            station=station,
+            prices=prices,
+            available=available,
+            timestamp=available_timestamp,
+            deposits=deposits,
+            bills=bills,
+            rooms=rooms_no,
+            housemates=housemates,
+            females=females,
+            males=males,
+            phone=phone,
+            new=True,
+            fetched=str(datetime.now()),
+        ))
+
+    def fetch_room_info(self, room_id, search, revalidate=False):
         if settings.VERBOSE:
             print('Getting {id} flat details'.format(id=room_id))
 
-        url = '{location}/{endpoint}/{id}?format=json'.format(location=self.api_location, endpoint=self.api_details_endpoint, id=room_id)
         try:
-            room = json.loads(self.make_get_request(url=url, cookies=self.cookies, headers=self.headers))
+            text = self.make_get_request(url=self.get_details_url(room_id), cookies=self.cookies, headers=self.headers, revalidate=revalidate)
+        except (NotFound, Unreachable):
+            self.metrics.count('fetch_errors')
+            raise
+        except:
+            self.metrics.count('fetch_errors')
+            return None
+
+        return self.parse_room_info(room_id, search, text)
+
+    def get_details_url(self, room_id):
+        return '{location}/{endpoint}/{id}?format=json'.format(location=self.api_location, endpoint=self.api_details_endpoint, id=room_id)
+
+    def parse_room_info(self, room_id, search, text):
+        """Returns the room described by a details response, None if it is not valid."""
+
+        try:
+            with self.metrics.timer('json_decode'):
+                room = json.loads(text)
             if settings.DEBUG:
                 pprint(room)
         except:
+            self.metrics.count('parse_errors')
+            return None
+
+        # error responses of the server
+        if not isinstance(room, dict) or 'advert_summary' not in room:
+            self.metrics.count('parse_errors')
             return None
 
         if 'days_of_wk_available' in room['advert_summary'] and room['advert_summary']['days_of_wk_available'] != '7 days a week':
@@ -441,7 +3334,7 @@ class SpareRoom(SearchEngine):
         males = room['advert_summary']['number_of_males'] if 'number_of_males' in room['advert_summary'] else 0
 
         try:
-            available_timestamp = datetime.now() if available == 'Now' else datetime.strptime(available, "%d %b %Y")
+            available_timestamp = datetime.now() if available == 'Now' else parse_available(available)
         except:
             available_timestamp = datetime.now()
 
@@ -451,39 +3344,298 @@ class SpareRoom(SearchEngine):
         #if 'rooms' not in room['advert_summary']:
             #return None
 
-        prices = deposits = []
+        prices, deposits = array('i'), array('i')
         if 'rooms' in room['advert_summary']:
             for r in room['advert_summary']['rooms']:
                 if 'security_deposit' in r and r['security_deposit']:
                     deposits.append(int(r['security_deposit'].split('.', 1)[0]))
                 if 'room_price' in r and r['room_price']:
                     price = int(r['room_price'].split('.', 1)[0])
-                    price = price if r['room_per'] == 'pcm' else price * 52 / 12
+                    price = price if r['room_per'] == 'pcm' else price * 52 // 12
                     prices.append(price)
         else:
-            prices.append(room['advert_summary']['min_rent'] if 'min_rent' in room['advert_summary'] else room['advert_summary']['max_rent'] if 'max_rent' in room['advert_summary'] else None)
+            rent = room['advert_summary']['min_rent'] if 'min_rent' in room['advert_summary'] else room['advert_summary']['max_rent'] if 'max_rent' in room['advert_summary'] else None
+            prices = to_amounts([rent])
 
         new = True
 
-        self.rooms[room_id] = {
-            'id': room_id,
-            'search': search,
-            'images': images,
-            'station': station,
-            'prices': prices,
-            'available': available,
-            'timestamp': str(available_timestamp),
-            'deposits': deposits,
-            'bills': bills,
-            'rooms': rooms_no,
-            'housemates': housemates,
-            'females': females,
-            'males': males,
-            'phone': phone,
-            'new': new,
-        }
+        return Room(
+            id=room_id,
+            search=search,
+            images=images,
+            station=station,
+            prices=prices,
+            available=available,
+            timestamp=available_timestamp,
+            deposits=deposits,
+            bills=bills,
+            rooms=rooms_no,
+            housemates=housemates,
+            females=females,
+            males=males,
+            phone=phone,
+            new=new,
+            fetched=str(datetime.now()),
+        )
+
+class FixtureRooms(SearchEngine):
+    """
+    Rooms of a local fixture server (fakeapi.py), whose search results are
+    stored rooms already, so no details are fetched. Used to run several
+    engines together without the network.
+    """
+
+    name = 'fixtures'
+    file_name = 'fixtures.json'
+    preferences = {}
+
+    api_location = 'http://127.0.0.1:8000'
+
+    def get_new_rooms(self):
+        self.start_crawl()
+        for area in self.AREAS:
+            self.search_rooms_in(area)
+            self.save_rooms()
+
+    def search_rooms_in(self, area):
+        if settings.VERBOSE:
+            print('Searching for {area} rooms in the fixtures'.format(area=area))
+
+        page = pages = 1
+        while page <= min(pages, settings.MAX_PAGES):
+            url = '{location}/rooms?area={area}&page={page}&per_page={per_page}'.format(location=self.api_location, area=area.lower(), page=page, per_page=settings.MAX_ROOMS)
+            try:
+                text = self.make_get_request(url=url, cookies=self.cookies, headers=self.headers)
+                with self.metrics.timer('json_decode'):
+                    results = json.loads(text)
+            except Exception as e:
+                logging.error('Error getting {area} page {page}: {message}'.format(area=area, page=page, message=e), extra={'engine': self.__class__.__name__, 'function': 'search_rooms_in'})
+                return
+
+            self.crawl_stats['pages'] += 1
+            pages = results['pages']
+            for room in results['rooms']:
+                room_id = room['id']
+                if not self.first_listing(room_id, area):
+                    continue
+
+                if room_id in self.rooms:
+                    self.metrics.count('rooms_skipped')
+                    self.add_area(room_id, area)
+                else:
+                    self.store_room(room_id, self.to_room(room, area))
+                if self.needs_rating(room_id):
+                    self.rate_room(room_id)
+            page += 1
+
+    def fetch_room_info(self, room_id, search, revalidate=False):
+        try:
+            text = self.make_get_request(url='{location}/rooms/{id}'.format(location=self.api_location, id=room_id), cookies=self.cookies, headers=self.headers, revalidate=revalidate)
+        except (NotFound, Unreachable):
+            self.metrics.count('fetch_errors')
+            raise
+        except:
+            self.metrics.count('fetch_errors')
+            return None
+
+        try:
+            with self.metrics.timer('json_decode'):
+                return self.to_room(json.loads(text), search)
+        except (ValueError, KeyError):
+            self.metrics.count('parse_errors')
+            return None
+
+    def get_room_url(self, room_id):
+        return '{location}/rooms/{id}'.format(location=self.api_location, id=room_id)
+
+    def to_room(self, room, search):
+        """Returns a room of the fixture server as stored by the engine."""
+
+        return Room.cast(dict(room, search=search, new=True, fetched=str(datetime.now())))
+
+class Federation(SearchEngine):
+    """
+    Runs several SearchEngines at the same time, one thread each with its
+    own session and rate limits, and keeps all the rooms they find in one
+    database scored and reported together. Each engine still keeps its own
+    database, the federated one keys the rooms by engine (spareroom:123).
+    """
+
+    name = 'federation'
+    file_name = 'rooms.json'
+    preferences = {}
+
+    def __init__(self, engines, preferences=None, areas=None, file_name=None):
+        """
+        Create a Federation object.
+
+        engines -- SearchEngines run together, with different names
+        preferences -- preferences the federated rooms are scored with
+        areas -- areas the federated rooms are scored with
+        file_name -- file to store the federated rooms in
+        """
+
+        self.engines = engines
+        self.engines_by_name = dict((engine.name, engine) for engine in engines)
+        super(Federation, self).__init__(preferences, areas, file_name=file_name)
+
+    def run_engines(self, function):
+        """Calls function with every engine in its own thread, logging the engines that fail."""
+
+        def call(engine):
+            try:
+                with self.metrics.timer('engine_' + engine.name):
+                    return function(engine)
+            except Exception as e:
+                logging.error(str(e), extra={'engine': engine.__class__.__name__, 'function': 'run_engines'})
+                return None
+
+        with ThreadPoolExecutor(max_workers=max(1, len(self.engines))) as pool:
+            return list(pool.map(call, self.engines))
+
+    def merge_engines(self):
+        """
+        Copies the rooms new or changed in the engines to the federated
+        database, deletes the ones the engines retired, rates the ones scored
+        with other settings and saves them. Returns the number of rooms copied.
+        """
+
+        copied = 0
+        keys = set()
+        for engine in self.engines:
+            for room_id, room in engine.rooms.items():
+                key = '{name}:{id}'.format(name=engine.name, id=room_id)
+                keys.add(key)
+
+                current = self.rooms.get(key)
+                if current is not None and self.get_version(current) == self.get_version(room):
+                    continue
+
+                room = room.copy()
+                room['id'] = key
+                room['source'] = engine.name
+                self.rooms[key] = room
+                copied += 1
+
+        for key in [key for key in self.rooms if key not in keys and key.split(':', 1)[0] in self.engines_by_name]:
+            del self.rooms[key]
+
+        for key in self.crawl_stats:
+            self.crawl_stats[key] = sum(engine.crawl_stats.get(key, 0) for engine in self.engines)
+
+        fingerprint = self.get_rating_fingerprint()
+        self.rate_rooms([key for key in self.rooms.dirty if self.needs_rating(key, fingerprint)])
+        self.save_rooms()
+
+        if settings.VERBOSE:
+            print('Federated {copied} rooms of {engines}'.format(copied=copied, engines=', '.join(engine.name for engine in self.engines)))
+        return copied
+
+    @staticmethod
+    def get_version(room):
+        """Returns what changes in a room when its engine stores it again, rates it or finds it in another area."""
+
+        return (room.get('fetched'), room.get('score'), room.get('new'), room.get_areas())
+
+    def get_new_rooms(self):
+        self.start_crawl()
+        self.run_engines(lambda engine: engine.get_new_rooms())
+        self.merge_engines()
+
+    def search_rooms_in(self, area):
+        def search(engine):
+            engine.start_crawl()
+            engine.search_rooms_in(area)
+            engine.save_rooms()
+
+        self.run_engines(search)
+        self.merge_engines()
+
+    def refresh(self, budget=0):
+        """Refreshes the rooms of every engine, each one within budget rooms."""
+
+        def refresh(engine):
+            updated = engine.refresh(budget)
+            engine.save_rooms()
+            return updated
+
+        results = [result for result in self.run_engines(refresh) if result is not None]
+        self.merge_engines()
+        return sum(updated for updated, _ in results), sum(retired for _, retired in results)
+
+    def get_room_url(self, room_id):
+        name, _, room_id = room_id.partition(':')
+        return self.engines_by_name[name].get_room_url(room_id)
 
-        return self.rooms[room_id]
+    def connection_stats(self):
+        stats = [super(Federation, self).connection_stats()] + [engine.connection_stats() for engine in self.engines]
+        return dict((key, sum(stat[key] for stat in stats)) for key in ('requests', 'opened', 'reused'))
+
+    def write_metrics(self, json_file=None, prometheus_file=None):
+        """Writes the metrics of the federation added to the ones of its engines, each engine also writes its own."""
+
+        for engine in self.engines:
+            engine.write_metrics()
+
+        metrics = self.metrics
+        self.metrics = Metrics()
+        self.metrics.started = metrics.started
+        for summary in [metrics.summary()] + [engine.metrics.summary() for engine in self.engines]:
+            self.metrics.merge(summary)
+        try:
+            super(Federation, self).write_metrics(json_file, prometheus_file)
+        finally:
+            self.metrics = metrics
+
+# engines that can be searched, by name
+ENGINES = {
+    'spareroom': SpareRoom,
+    'fixtures': FixtureRooms,
+}
+
+# request budget, adverts listed so far, rate limiter bucket and known rooms
+# shared by the crawl worker processes
+crawl_shared = {}
+
+def init_crawl_worker(values, shared):
+    """
+    Sets up a crawl worker process with the settings of its parent and what
+    it shares with the other workers (see crawl_shared).
+    """
+
+    for key, value in values.items():
+        setattr(settings, key, value)
+    settings.PROCESSES = 1
+    settings.SNAPSHOT = False
+
+    # the rooms of a worker are only its shard, a SQLite database kept in memory
+    settings.STORAGE = 'sqlite'
+    settings.CHUNK_SIZE = 0
+
+    crawl_shared.update(shared)
+
+def crawl_shard(task):
+    """
+    Crawls one area in a worker process into the shard database. The rooms
+    already in the main database are not fetched again, only the areas they
+    were listed in are kept for the merge.
+    """
+
+    engine_class, preferences, area, state, file_name = task
+    start = time()
+
+    engine = engine_class(preferences, [area], file_name=file_name)
+    engine.state = state
+    engine.scoring = False
+    engine.budget = crawl_shared['budget']
+    engine.claimed = crawl_shared['claimed']
+    engine.bucket = crawl_shared['bucket']
+    engine.known = crawl_shared['known']
+
+    engine.get_new_rooms()
+    engine.store.close()
+
+    return area, engine.store.file_name, time() - start, engine.connection_stats()['requests'], engine.metrics.summary()
 
 def main():
     print('Room Finder v{version} (c) Ruben de Campos'.format(version=VERSION))
@@ -505,6 +3657,110 @@ def main():
     all score from 0 to 100
     """
 
+    # python rooms.py query ... asks the database instead of searching
+    if sys.argv[1:2] == ['query']:
+        return run_query(parse_query_arguments(sys.argv[2:]))
+
+    args = parse_arguments()
+    configure(args)
+
+    if not settings.PROFILE:
+        return run(args)
+
+    profile = cProfile.Profile()
+    try:
+        profile.runcall(run, args)
+    finally:
+        profile.dump_stats(settings.PROFILE)
+        if settings.VERBOSE:
+            print('Profile saved to {name}'.format(name=settings.PROFILE))
+
+def create_engine():
+    """Returns the engine searching settings.ENGINES, a Federation of them if there are several."""
+
+    engines = [ENGINES[name](get_spareroom_preferences(), settings.AREAS) for name in settings.ENGINES]
+    if len(engines) == 1:
+        return engines[0]
+    return Federation(engines, get_spareroom_preferences(), settings.AREAS)
+
+def run(args):
+    """Crawls or re-rates the rooms, then writes the report and the metrics."""
+
+    engine = create_engine()
+
+    def report():
+        engine.update_snapshot()
+        engine.generate_report(fields=settings.FIELDS, max_range=settings.MAX_RESULTS, output_format=settings.REPORT_FORMAT, page_size=settings.REPORT_PAGE_SIZE)
+        engine.write_metrics(settings.METRICS, settings.PROMETHEUS)
+
+    if settings.WATCH:
+        return engine.watch(report, max_range=settings.MAX_RESULTS)
+
+    if args.rate:
+        engine.rate()
+    else:
+        engine.get_new_rooms()
+
+    if settings.VERBOSE:
+        print('Requests: {requests}, connections opened: {opened}, reused: {reused}'.format(**engine.connection_stats()))
+        if engine.cache:
+            print('Cache hits: {hits}, misses: {misses}, revalidated: {revalidated}'.format(hits=engine.cache.hits, misses=engine.cache.misses, revalidated=engine.cache.revalidated))
+
+    report()
+
+    if settings.VERBOSE:
+        timers = engine.metrics.summary()['timers']
+        for name in sorted(timers, key=lambda name: -timers[name]['seconds']):
+            print('  {name}: {calls} calls, {seconds:.2f}s, max {max:.3f}s'.format(name=name, **timers[name]))
+
+def run_query(args):
+    """Prints the best rooms of the database matching the query arguments."""
+
+    # the search settings are not used, only the database ones
+    today = datetime.now().strftime('%Y-%m-%d')
+    configure(parse_arguments(['--areas'] + (args.areas or ['london']) + ['--date', today, '--min-date', today, '--no-cache', '--storage', args.storage] + (['--verbose'] if args.verbose else [])))
+
+    spareroom = SpareRoom(get_spareroom_preferences(), args.areas)
+    price = (args.rent[0], args.rent[1] + 1) if args.rent else None
+    available = None
+    if args.available_from or args.available_before:
+        available = tuple(datetime.strptime(date, "%Y-%m-%d") if date else None for date in (args.available_from, args.available_before))
+
+    spareroom.rooms.get_index()
+    start = time()
+    rooms = spareroom.query(args.top, price=price, available=available, stations=args.stations, areas=args.areas, new=args.new)
+    elapsed = time() - start
+
+    for room in rooms:
+        if args.format == 'jsonl':
+            print(json.dumps(dict(room.to_dict(), url=spareroom.get_room_url(room['id']))))
+        else:
+            print('{score:6.2f}  {id}  {price:>5}  {available:<11}  {station:<20}  {url}'.format(score=room.get('score', 0), id=room['id'], price=min(room.prices) if len(room.prices) else '', available=room['available'], station=room['station'], url=spareroom.get_room_url(room['id'])))
+
+    if settings.VERBOSE:
+        print('{count} rooms in {ms:.1f}ms, {total} rooms indexed'.format(count=len(rooms), ms=elapsed * 1000, total=len(spareroom.rooms)))
+    spareroom.store.close()
+
+def parse_query_arguments(argv=None):
+    """Parses the arguments of the query command."""
+
+    parser = argparse.ArgumentParser(prog='rooms.py query', description='Best rooms of the database matching all the conditions given')
+    parser.add_argument('-t', '--rent',                help='Monthly rent range, both included (e.g. 800 1000)',  required=False,                      default=None,     type=int, nargs=2)
+    parser.add_argument('-i', '--available-from',      help='Available from this date (Format: YYYY-MM-DD)',      required=False,                      default=None,     type=str)
+    parser.add_argument('-w', '--available-before',    help='Available before this date (Format: YYYY-MM-DD)',    required=False,                      default=None,     type=str)
+    parser.add_argument('-S', '--stations',            help='Stations the rooms are near',                        required=False,                      default=None,     type=str, nargs='+')
+    parser.add_argument('-a', '--areas',               help='Areas the rooms were found in',                      required=False,                      default=None,     type=str, nargs='+')
+    parser.add_argument('-N', '--new',                 help='Only new rooms',                                     required=False, action='store_true', default=False)
+    parser.add_argument('-o', '--top',                 help='Number of rooms, best score first (default: 20)',    required=False,                      default=20,       type=int)
+    parser.add_argument('--storage',                   help='Room database backend (default: sqlite)',            required=False,                      default='sqlite', choices=['sqlite', 'json'])
+    parser.add_argument('--format',                    help='Output format (default: text)',                      required=False,                      default='text',   choices=['text', 'jsonl'])
+    parser.add_argument('-v', '--verbose',             help='Prints the query time',                              required=False, action='store_true', default=False)
+
+    return parser.parse_args(argv)
+
+def parse_arguments(argv=None):
+    """Parses the command line arguments (default: sys.argv)."""
+
     parser = argparse.ArgumentParser()
     parser.add_argument('-n', '--preferences', help='Preferences seperated by , (price,bills,areas,rooms,housemates,images,when)',                          default="a,r,h,w,p,b,i",    type=str)
     parser.add_argument('-a', '--areas',       help='Prefered areas to search for',                                    required=True,                                         type=str, nargs='+')
@@ -519,16 +3775,49 @@ def main():
     parser.add_argument('-y', '--room-type',   help='Room types to search for (default: double)',                      required=False,                      default='double', choices=['single', 'double'])
     parser.add_argument('-r', '--rate',        help='Re-rates the rooms in the database',                              required=False, action='store_true', default=False)
     parser.add_argument('-u', '--update',      help='Updates room information when rating the room (use with --rate)', required=False, action='store_true', default=False)
+    parser.add_argument('--refresh-budget',    help='Rooms updated by --update, most valuable first, 0 for all',       required=False,                      default=0,        type=int)
+    parser.add_argument('-W', '--workers',     help='Number of threads fetching room details (default: 1)',            required=False,                      default=1,        type=int)
+    parser.add_argument('-R', '--request-rate', help='Maximum requests per second to each host (default: 1/sleep)',    required=False,                      default=None,     type=float)
+    parser.add_argument('-T', '--timeout',     help='Seconds to wait for a server response (default: 30)',             required=False,                      default=30,       type=float)
+    parser.add_argument('-e', '--retries',     help='Retries on connection errors and 5xx/429 (default: 3)',           required=False,                      default=3,        type=int)
+    parser.add_argument('--cache-dir',         help='Directory of the response cache (default: .cache)',               required=False,                      default='.cache', type=str)
+    parser.add_argument('--cache-size',        help='Maximum size of the response cache in MB (default: 100)',         required=False,                      default=100,      type=int)
+    parser.add_argument('--no-cache',          help='Does not cache responses',                                        required=False, action='store_true', default=False)
+    parser.add_argument('--cache-only',        help='Replays cached responses only, without network access',           required=False, action='store_true', default=False)
+    parser.add_argument('--storage',           help='Room database backend (default: sqlite)',                         required=False,                      default='sqlite', choices=['sqlite', 'json'])
+    parser.add_argument('--format',            help='Report format (default: html)',                                   required=False,                      default='html',   choices=sorted(REPORT_WRITERS))
+    parser.add_argument('--page-size',         help='Rooms per html report page, 0 for one page (default: 0)',         required=False,                      default=0,        type=int)
+    parser.add_argument('--thumbnails',        help='Shows local thumbnails of the room images in html reports',       required=False, action='store_true', default=False)
+    parser.add_argument('--image-dir',         help='Directory of the thumbnails (default: .images)',                  required=False,                      default='.images', type=str)
+    parser.add_argument('--image-cache-size',  help='Maximum size of the thumbnails in MB (default: 200)',             required=False,                      default=200,      type=int)
+    parser.add_argument('--snapshot',          help='Keeps a binary snapshot of the rooms to rate and report faster',  required=False, action='store_true', default=False)
+    parser.add_argument('--chunk-size',        help='Rooms rated and reported at a time (sqlite), 0 for all at once',  required=False,                      default=0,        type=int)
+    parser.add_argument('--incremental',       help='Stops searching an area once the results are known adverts',      required=False, action='store_true', default=False)
+    parser.add_argument('--pipeline',          help='Downloads, scores and saves rooms concurrently in stages',        required=False, action='store_true', default=False)
+    parser.add_argument('--processes',         help='Number of processes crawling areas in parallel (default: 1)',     required=False,                      default=1,        type=int)
+    parser.add_argument('--request-budget',    help='Maximum requests of all the crawling processes, 0 for no limit',  required=False,                      default=0,        type=int)
+    parser.add_argument('--watch',             help='Keeps running, searching busy areas more often than quiet ones',  required=False, action='store_true', default=False)
+    parser.add_argument('--watch-interval',    help='Seconds between searches of a watched area (default: 900)',       required=False,                      default=900,      type=int)
+    parser.add_argument('--engines',           help='Sites searched at the same time (default: spareroom)',            required=False,                      default=['spareroom'], choices=sorted(ENGINES), nargs='+')
+    parser.add_argument('--engine-rate',       help='Requests per second of an engine (e.g. spareroom=0.5)',           required=False,                      default=[],       type=str, nargs='+')
+    parser.add_argument('--metrics',           help='Json file of the run metrics (default: <database>.metrics.json)', required=False,                      default=None,     type=str)
+    parser.add_argument('--prometheus',        help='Prometheus text file of the run metrics, e.g. for node exporter', required=False,                      default=None,     type=str)
+    parser.add_argument('--profile',           help='Runs under cProfile and saves the stats to this file',            required=False,                      default=None,     type=str)
     parser.add_argument('-f', '--fast',        help='Gets only information from the list only (worst ratings)',        required=False, action='store_true', default=False)
+    parser.add_argument('--hybrid',            help='Gets room details only if the room could make the report',        required=False, action='store_true', default=False)
     parser.add_argument('-d', '--debug',       help='Prints debug messages',                                           required=False, action='store_true', default=False)
     parser.add_argument('-v', '--verbose',     help='Prints verbose messages',                                         required=False, action='store_true', default=False)
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
+
+def configure(args):
+    """Fills the settings from the parsed command line arguments."""
 
     # boolean settings
     settings.VERBOSE = args.verbose
     settings.DEBUG   = args.debug
     settings.FAST    = args.fast
+    settings.HYBRID  = args.hybrid and not args.fast
     settings.UPDATE  = args.update
 
     settings.PREFERENCES = args.preferences.split(',')
@@ -539,6 +3828,48 @@ def main():
     settings.MAX_ROOMS   = args.max_rooms
     settings.SLEEP       = args.sleep
 
+    settings.WORKERS      = args.workers
+    settings.REQUEST_RATE = args.request_rate if args.request_rate is not None else 1.0 / args.sleep if args.sleep > 0 else 0
+    settings.TIMEOUT      = args.timeout
+    settings.RETRIES      = args.retries
+
+    settings.CACHE      = not args.no_cache
+    settings.CACHE_DIR  = args.cache_dir
+    settings.CACHE_SIZE = args.cache_size * 1024 * 1024
+    settings.CACHE_ONLY = args.cache_only and settings.CACHE
+
+    settings.THUMBNAILS       = args.thumbnails
+    settings.IMAGE_DIR        = args.image_dir
+    settings.IMAGE_CACHE_SIZE = args.image_cache_size * 1024 * 1024
+
+    settings.STORAGE  = args.storage
+
+    # only sqlite saves a batch of rooms without rewriting the others, the
+    # snapshot is written from all the rooms at once
+    settings.CHUNK_SIZE = args.chunk_size if args.storage == 'sqlite' else 0
+    settings.SNAPSHOT   = args.snapshot and not settings.CHUNK_SIZE
+
+    # watch mode searches the areas over and over, only the new adverts matter
+    settings.WATCH          = args.watch
+    settings.WATCH_INTERVAL = args.watch_interval
+    settings.INCREMENTAL    = args.incremental or args.watch
+    settings.PIPELINE       = args.pipeline
+
+    settings.PROCESSES      = args.processes
+    settings.REQUEST_BUDGET = args.request_budget
+    settings.REFRESH_BUDGET = args.refresh_budget
+
+    # several engines are searched as a Federation, each with its own rate
+    settings.ENGINES      = list(dict.fromkeys(args.engines))
+    settings.ENGINE_RATES = dict((rate.split('=', 1)[0], float(rate.split('=', 1)[1])) for rate in args.engine_rate)
+
+    settings.REPORT_FORMAT    = args.format
+    settings.REPORT_PAGE_SIZE = args.page_size
+
+    settings.METRICS    = args.metrics
+    settings.PROMETHEUS = args.prometheus
+    settings.PROFILE    = args.profile
+
     settings.MAX_RENT_PM        = args.rent
     settings.WHEN               = datetime.strptime(args.date, "%Y-%m-%d")
     settings.MIN_AVAILABLE_TIME = datetime.strptime(args.min_date, "%Y-%m-%d")
@@ -551,7 +3882,10 @@ def main():
     if args.update and not args.rate:
         settings.UPDATE = False
 
-    spareroom_preferences = {
+def get_spareroom_preferences():
+    """Returns the SpareRoom search preferences built from the settings."""
+
+    return {
         'format': 'json',
         'max_rent': settings.MAX_RENT_PM,
         'per': 'pcm',
@@ -563,14 +3897,5 @@ def main():
         'when': settings.WHEN,
     }
 
-    spareroom = SpareRoom(spareroom_preferences, settings.AREAS)
-
-    if args.rate:
-        spareroom.rate()
-    else:
-        spareroom.get_new_rooms()
-
-    spareroom.generate_report(fields=settings.FIELDS, max_range=settings.MAX_RESULTS)
-
 if __name__ == "__main__":
     main()
@@ -0,0 +1,682 @@
+"""
+Tests of the RoomFinder engines against fakeapi.py, the local fake SpareRoom
+API, so they never touch SpareRoom.
+
+python -m pytest test_rooms.py
+"""
+from datetime import datetime, timedelta
+import csv
+import io
+import json
+import os
+import random
+import shutil
+from time import time
+try:
+    from urllib.parse import urlparse, parse_qs
+except ImportError:
+    from urlparse import urlparse, parse_qs
+
+import pytest
+
+import rooms
+from rooms import settings
+from fakeapi import FakeSpareRoom, START, generate_advert
+from benchmark import generate_rooms
+
+# adverts available from a date later than today, like a real search
+LATER = datetime.now().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=180)
+
+def configure(*argv, **options):
+    """
+    Fills rooms.settings as the command line would, for an offline run
+    without the response cache unless cache is given.
+    """
+
+    date, min_date = options.get('date', START + timedelta(days=45)), options.get('min_date', START + timedelta(days=30))
+    defaults = ['--areas', 'Brixton', 'Clapham', '--date', date.strftime('%Y-%m-%d'), '--min-date', min_date.strftime('%Y-%m-%d'), '--rent', '900', '--sleep', '0', '--max-rooms', '50', '--max-pages', '10']
+    rooms.configure(rooms.parse_arguments(defaults + ([] if options.get('cache') else ['--no-cache']) + list(argv)))
+
+def make_engine(directory, api=None):
+    """Creates a SpareRoom engine storing its rooms in directory, asking api."""
+
+    if not os.path.isdir(str(directory)):
+        os.makedirs(str(directory))
+    engine = rooms.SpareRoom(rooms.get_spareroom_preferences(), settings.AREAS, file_name=os.path.join(str(directory), 'spareroom.json'))
+    if api is not None:
+        engine.api_location = api.url
+    return engine
+
+def crawl(directory, api):
+    """Crawls the fake API, returns the engine and the requests it made."""
+
+    engine = make_engine(directory, api)
+    requests = api.requests
+    engine.get_new_rooms()
+    return engine, api.requests - requests
+
+def stored(engine):
+    """
+    Returns the rooms of an engine as dictionaries, without the fetch times
+    nor the posting times, the fake API dates adverts from the time asked.
+    """
+
+    return dict((key, dict(room.to_dict(), fetched=None, timestamp=None, rated_fields=None)) for key, room in engine.rooms.items())
+
+def post_adverts(api, area, count):
+    """Lists count new adverts first in an area of the fake API."""
+
+    rnd, first = random.Random(count), 3000000 + len(api.adverts)
+    adverts = [generate_advert(first + n, area, rnd) for n in range(count)]
+    for advert in adverts:
+        api.adverts[advert['advert_id']] = advert
+    api.areas[area.lower()][:0] = adverts
+
+def fail_once(api, monkeypatch, area, page):
+    """Makes the fake API answer the next request of a results page with a 503."""
+
+    respond, pending = api.respond, [True]
+    def failing(path):
+        query = parse_qs(urlparse(path).query)
+        if pending and query.get('where') == [area.lower()] and query.get('page') == [str(page)]:
+            pending.pop()
+            return 503, {'error': 'Service unavailable'}
+        return respond(path)
+    monkeypatch.setattr(api, 'respond', failing)
+
+@pytest.fixture
+def api():
+    api = FakeSpareRoom(300, areas=['Brixton', 'Clapham'], overlap=0.2)
+    api.start()
+    yield api
+    api.stop()
+
+@pytest.fixture
+def later_api():
+    api = FakeSpareRoom(300, areas=['Brixton', 'Clapham'], start=LATER)
+    api.start()
+    yield api
+    api.stop()
+
+def test_concurrent_and_pipeline_crawls_store_the_serial_rooms(api, tmp_path):
+    configure('--workers', '1')
+    serial, _ = crawl(tmp_path / 'serial', api)
+    expected = stored(serial)
+    assert expected
+
+    for mode, argv in (('concurrent', ['--workers', '8']), ('pipeline', ['--workers', '8', '--pipeline'])):
+        configure(*argv)
+        engine, _ = crawl(tmp_path / mode, api)
+        assert stored(engine) == expected, mode
+
+def test_adverts_listed_in_several_areas_are_fetched_once(api, tmp_path):
+    configure('--workers', '8')
+    engine, requests = crawl(tmp_path, api)
+
+    pages = sum((len(adverts) + 49) // 50 for adverts in api.areas.values())
+    assert requests == pages + len(set(advert['advert_id'] for adverts in api.areas.values() for advert in adverts))
+    assert engine.crawl_stats['duplicates'] > 0
+
+def test_rate_rooms_gives_the_rate_room_scores(tmp_path):
+    configure()
+    engine = make_engine(tmp_path)
+    engine.rooms = generate_rooms(2000)
+
+    for key in engine.rooms:
+        engine.rate_room(key)
+    expected = dict((key, (room.score, room.new)) for key, room in engine.rooms.items())
+
+    for room in engine.rooms.values():
+        room.new = True
+    engine.rate_rooms()
+    for key, room in engine.rooms.items():
+        assert room.score == pytest.approx(expected[key][0], abs=1e-9)
+        assert room.new == expected[key][1]
+
+@pytest.mark.parametrize('dates', ['2017', 'later'])
+def test_hybrid_crawl_reports_the_full_crawl_rooms(api, later_api, tmp_path, dates):
+    if dates == 'later':
+        api, argv = later_api, {'date': LATER + timedelta(days=30), 'min_date': LATER}
+    else:
+        argv = {}
+
+    reported = {}
+    requests = {}
+    for mode in ('full', 'hybrid'):
+        configure('--workers', '8', '--max-results', '20', *(['--hybrid'] if mode == 'hybrid' else []), **argv)
+        engine, requests[mode] = crawl(tmp_path / mode, api)
+        reported[mode] = [room['id'] for room in engine.top_rooms(20, engine.get_report_filters())]
+
+    assert len(reported['full']) == 20
+    assert reported['hybrid'] == reported['full']
+    assert requests['hybrid'] < requests['full']
+
+def test_crawl_processes_fetch_shared_adverts_once(api, tmp_path, monkeypatch):
+    # the worker processes create their own engines
+    monkeypatch.setattr(rooms.SpareRoom, 'api_location', api.url)
+    configure('--workers', '1')
+    serial, _ = crawl(tmp_path / 'serial', api)
+
+    configure('--workers', '4', '--processes', '2')
+    engine, requests = crawl(tmp_path / 'processes', api)
+
+    pages = sum((len(adverts) + 49) // 50 for adverts in api.areas.values())
+    assert requests == pages + len(set(advert['advert_id'] for adverts in api.areas.values() for advert in adverts))
+    # the area an advert is stored from depends on the process listing it first
+    unordered = lambda rooms: dict((key, dict(room, search=None, areas=sorted(room.get('areas', [])))) for key, room in stored(rooms).items())
+    assert unordered(engine) == unordered(serial)
+
+def test_server_errors_only_lose_the_failed_requests(tmp_path):
+    api = FakeSpareRoom(300, areas=['Brixton', 'Clapham'], error_rate=0.3)
+    api.start()
+    try:
+        configure('--workers', '1', '--retries', '0')
+        engine, _ = crawl(tmp_path, api)
+    finally:
+        api.stop()
+
+    assert engine.rooms
+    assert engine.metrics.counters['request_errors'] == api.errors
+
+def test_incremental_crawl_searches_failed_pages_again(api, tmp_path, monkeypatch):
+    configure('--workers', '8', '--retries', '0', '--incremental')
+    crawl(tmp_path / 'incremental', api)
+
+    post_adverts(api, 'Brixton', 60)
+    fail_once(api, monkeypatch, 'Brixton', 2)
+    engine, _ = crawl(tmp_path / 'incremental', api)
+    assert engine.crawl_stats['pages_failed'] == 1
+    assert engine.crawl_stats['pages_saved'] > 0
+
+    engine, _ = crawl(tmp_path / 'incremental', api)
+    configure('--workers', '8')
+    full, _ = crawl(tmp_path / 'full', api)
+    assert set(engine.rooms) == set(full.rooms)
+
+@pytest.mark.parametrize('chunk_size', ['0', '100'])
+def test_crawl_processes_skip_the_known_adverts(api, tmp_path, monkeypatch, chunk_size):
+    monkeypatch.setattr(rooms.SpareRoom, 'api_location', api.url)
+    configure('--workers', '4', '--processes', '2', '--chunk-size', chunk_size)
+    engine, _ = crawl(tmp_path, api)
+
+    # only the adverts left out of the database are fetched again
+    _, requests = crawl(tmp_path, api)
+    pages = sum((len(adverts) + 49) // 50 for adverts in api.areas.values())
+    assert requests == pages + len(set(api.adverts) - set(engine.rooms))
+
+def test_crawl_processes_share_the_request_rate(tmp_path, monkeypatch):
+    api = FakeSpareRoom(60, areas=['Brixton', 'Clapham'])
+    api.start()
+    try:
+        monkeypatch.setattr(rooms.SpareRoom, 'api_location', api.url)
+        configure('--workers', '4', '--processes', '2', '--request-rate', '40')
+        start = time()
+        _, requests = crawl(tmp_path, api)
+        elapsed = time() - start
+    finally:
+        api.stop()
+
+    assert elapsed >= (requests - 1) / 40.0
+
+def test_crawl_processes_keep_the_high_water_mark_of_every_area(api, tmp_path, monkeypatch):
+    monkeypatch.setattr(rooms.SpareRoom, 'api_location', api.url)
+    configure('--workers', '4', '--processes', '2', '--incremental')
+    crawl(tmp_path, api)
+
+    post_adverts(api, 'Brixton', 10)
+    post_adverts(api, 'Clapham', 20)
+    engine, _ = crawl(tmp_path, api)
+    marks = engine.state['high_water_marks']
+    assert marks['Brixton']['advert_id'] == api.areas['brixton'][0]['advert_id']
+    assert marks['Clapham']['advert_id'] == api.areas['clapham'][0]['advert_id']
+
+def test_sqlite_store_writes_only_the_changed_rooms(tmp_path):
+    configure()
+    engine = make_engine(tmp_path)
+    engine.rooms = generate_rooms(200)
+    engine.rooms.dirty.update(engine.rooms)
+    engine.save_rooms()
+
+    keys = sorted(engine.rooms)
+    engine.rooms[keys[0]] = dict(engine.rooms[keys[0]].to_dict(), station='Brixton')
+    del engine.rooms[keys[1]]
+    changes = engine.store.db.total_changes
+    engine.store.save(engine.rooms)
+    assert engine.store.db.total_changes - changes == 2
+
+    expected = stored(engine)
+    assert stored(make_engine(tmp_path)) == expected
+    assert expected[keys[0]]['station'] == 'Brixton' and keys[1] not in expected
+
+def test_sqlite_store_imports_the_json_database_once(tmp_path):
+    configure()
+    rooms.JSONRoomStore(str(tmp_path / 'spareroom.json')).save(generate_rooms(50))
+    engine = make_engine(tmp_path)
+    assert len(engine.rooms) == 50
+
+    for key in list(engine.rooms):
+        del engine.rooms[key]
+    engine.save_rooms()
+    assert len(make_engine(tmp_path).rooms) == 0
+
+def test_corrupt_json_database_starts_empty_and_imports_later(tmp_path):
+    configure()
+    name = str(tmp_path / 'spareroom.json')
+    with open(name, 'w') as f:
+        f.write('{"1000000": {"id": "10')
+    engine = make_engine(tmp_path)
+    assert len(engine.rooms) == 0
+    engine.store.close()
+
+    json_rooms = generate_rooms(50)
+    json_rooms.dirty.update(json_rooms)
+    rooms.JSONRoomStore(name).save(json_rooms)
+    assert len(make_engine(tmp_path).rooms) == 50
+
+def test_cache_only_reports_download_no_images(api, tmp_path):
+    images = [{'images': ['{url}/images/{n}/0.jpg'.format(url=api.url, n=n)]} for n in range(5)]
+    argv = ['--thumbnails', '--cache-dir', str(tmp_path / 'cache'), '--image-dir', str(tmp_path / 'images')]
+
+    configure('--cache-only', *argv, cache=True)
+    requests = api.requests
+    assert make_engine(tmp_path, api).prefetch_images(images) == 0
+    assert api.requests == requests
+
+    configure(*argv, cache=True)
+    assert make_engine(tmp_path, api).prefetch_images(images) == 5
+
+def test_response_cache_answers_fresh_requests_and_revalidates_stale_ones(api, tmp_path, monkeypatch):
+    configure('--workers', '8', '--cache-dir', str(tmp_path / 'cache'), cache=True)
+    first, requests = crawl(tmp_path / 'first', api)
+    assert requests > 0
+
+    # a new database, every response is in the cache
+    cached, requests = crawl(tmp_path / 'cached', api)
+    assert requests == 0
+    assert stored(cached) == stored(first)
+
+    monkeypatch.setattr(rooms.SpareRoom, 'search_cache_ttl', 0)
+    monkeypatch.setattr(rooms.SpareRoom, 'details_cache_ttl', 0)
+    not_modified = api.not_modified
+    revalidated, requests = crawl(tmp_path / 'revalidated', api)
+    assert api.not_modified - not_modified == requests == revalidated.cache.revalidated
+    assert stored(revalidated) == stored(first)
+
+def test_cache_only_crawl_makes_no_requests(api, tmp_path):
+    configure('--workers', '8', '--cache-dir', str(tmp_path / 'cache'), cache=True)
+    first, _ = crawl(tmp_path / 'first', api)
+
+    configure('--workers', '8', '--cache-dir', str(tmp_path / 'cache'), '--cache-only', cache=True)
+    replayed, requests = crawl(tmp_path / 'replayed', api)
+    assert requests == 0
+    assert stored(replayed) == stored(first)
+
+    configure('--workers', '8', '--cache-dir', str(tmp_path / 'empty-cache'), '--cache-only', cache=True)
+    empty, requests = crawl(tmp_path / 'empty', api)
+    assert requests == 0 and len(empty.rooms) == 0
+
+def test_response_cache_evicts_the_least_recently_used_entries(tmp_path):
+    cache = rooms.ResponseCache(str(tmp_path), max_size=3000)
+    for url in ('a', 'b'):
+        cache.put(url, 'x' * 1000)
+        os.utime(cache.path(url), (1, 1))
+    assert cache.get('a') is not None
+
+    cache.put('c', 'x' * 1000)
+    assert cache.get('b') is None
+    assert cache.get('a') is not None and cache.get('c') is not None
+
+def rated_engine(directory, count=250):
+    """Creates an engine with count generated rooms, rated and saved."""
+
+    configure()
+    engine = make_engine(directory)
+    engine.rooms = generate_rooms(count)
+    engine.rate_rooms()
+    engine.rooms.dirty.update(engine.rooms)
+    engine.save_rooms()
+    return engine
+
+def test_reports_list_the_top_rooms_in_every_format(tmp_path):
+    engine = rated_engine(tmp_path)
+    expected = [room['id'] for room in engine.top_rooms(-1, engine.get_report_filters())]
+    assert expected
+
+    engine.generate_report(fields=settings.FIELDS, output_format='jsonl')
+    with io.open(str(tmp_path / 'spareroom.jsonl'), encoding='utf-8') as f:
+        assert [json.loads(line)['id'] for line in f] == expected
+
+    engine.generate_report(fields=settings.FIELDS, output_format='csv')
+    with io.open(str(tmp_path / 'spareroom.csv'), encoding='utf-8', newline='') as f:
+        assert [row['id'] for row in csv.DictReader(f)] == expected
+
+    engine.generate_report(fields=settings.FIELDS, output_format='html')
+    with io.open(str(tmp_path / 'spareroom.html'), encoding='utf-8') as f:
+        html = f.read()
+    assert html.count('<tr class=') == len(expected)
+    assert html.index('>{id}<'.format(id=expected[0])) < html.index('>{id}<'.format(id=expected[-1]))
+
+def test_paginated_html_report_links_pages_of_page_size_rooms(tmp_path):
+    engine = rated_engine(tmp_path)
+    expected = [room['id'] for room in engine.top_rooms(-1, engine.get_report_filters())]
+    page_size = 40
+    pages = (len(expected) + page_size - 1) // page_size
+    assert pages > 1
+
+    engine.generate_report(fields=settings.FIELDS, page_size=page_size)
+    with io.open(str(tmp_path / 'spareroom.html'), encoding='utf-8') as f:
+        index = f.read()
+    assert not os.path.exists(str(tmp_path / 'spareroom-{page}.html'.format(page=pages + 1)))
+
+    listed = []
+    for page in range(1, pages + 1):
+        assert 'href="spareroom-{page}.html"'.format(page=page) in index
+        with io.open(str(tmp_path / 'spareroom-{page}.html'.format(page=page)), encoding='utf-8') as f:
+            html = f.read()
+        rows = html.count('<tr class=')
+        assert rows == (page_size if page < pages else len(expected) - page_size * (pages - 1))
+        assert ('>Next<' in html) == (page < pages)
+        assert ('>Previous<' in html) == (page > 1)
+        listed.extend(room_id for room_id in expected if '>{id}<'.format(id=room_id) in html)
+    assert sorted(listed) == sorted(expected)
+
+def test_incremental_crawl_stops_at_the_high_water_mark(api, tmp_path):
+    configure('--workers', '8', '--incremental')
+    engine, _ = crawl(tmp_path, api)
+    marks = engine.state['high_water_marks']
+    assert marks['Brixton']['advert_id'] == api.areas['brixton'][0]['advert_id']
+
+    post_adverts(api, 'Brixton', 10)
+    new = [advert['advert_id'] for advert in api.areas['brixton'][:10]]
+    known = set(engine.rooms)
+    engine, requests = crawl(tmp_path, api)
+
+    # the first page of each area lists the mark, only its unknown adverts are fetched
+    listed = set(advert['advert_id'] for adverts in api.areas.values() for advert in adverts[:50])
+    assert requests == 2 + len(listed - known)
+    assert engine.crawl_stats['pages_saved'] > 0
+    assert set(new) - set(engine.rooms) == set(advert['advert_id'] for advert in api.areas['brixton'][:10] if advert['days_of_wk_available'] != '7 days a week')
+    assert engine.state['high_water_marks']['Brixton']['advert_id'] == new[0]
+
+def ranking(rooms):
+    """Returns the scores of rooms in order and their ids, equal rankings up to ties."""
+
+    return [room['score'] for room in rooms], set(room['id'] for room in rooms)
+
+def test_snapshot_reports_the_loaded_rooms_ranking(tmp_path):
+    engine = rated_engine(tmp_path, 1000)
+    configure('--snapshot')
+    engine.update_snapshot()
+
+    snapshot = make_engine(tmp_path)
+    assert snapshot.snapshot is not None and snapshot._rooms is None
+    for k, filters in ((-1, None), (-1, engine.get_report_filters()), (20, engine.get_report_filters(when=True)), (5, {'areas': ['Brixton']})):
+        assert ranking(snapshot.top_rooms(k, filters)) == ranking(engine.top_rooms(k, filters))
+    assert snapshot._rooms is None
+
+def test_snapshot_is_not_read_once_the_database_changed(tmp_path):
+    engine = rated_engine(tmp_path, 200)
+    configure('--snapshot')
+    engine.update_snapshot()
+
+    best = engine.top_rooms(1)[0]['id']
+    del engine.rooms[best]
+    engine.save_rooms()
+
+    stale = make_engine(tmp_path)
+    assert stale.snapshot is None
+    reported = [room['id'] for room in stale.top_rooms()]
+    assert len(reported) == 199 and best not in reported
+
+    stale.update_snapshot()
+    assert make_engine(tmp_path).snapshot is not None
+
+def test_area_scheduler_searches_busy_areas_more_often():
+    scheduler = rooms.AreaScheduler(['Brixton', 'Clapham', 'Balham'], interval=100)
+    assert scheduler.next()[1] == 0
+
+    for _ in range(10):
+        busy = scheduler.record('Brixton', 5)
+        quiet = scheduler.record('Clapham', 0)
+        flooded = scheduler.record('Balham', 1000)
+    assert flooded < busy < quiet
+    assert flooded == 100 * scheduler.min_ratio
+    assert quiet <= 100 * scheduler.max_ratio
+
+    # the recent averages kept in the state give the same intervals
+    restored = rooms.AreaScheduler(['Brixton', 'Clapham'], interval=100, state=scheduler.state)
+    assert restored.get_interval('Brixton') == scheduler.get_interval('Brixton')
+    assert restored.next()[0] in ('Brixton', 'Clapham')
+
+def test_watch_searches_again_the_areas_due_from_the_server(api, tmp_path, monkeypatch):
+    configure('--watch', '--watch-interval', '60', '--cache-dir', str(tmp_path / 'cache'), cache=True)
+    engine = make_engine(tmp_path, api)
+
+    sleeps, reports = [], []
+    def sleep(delay):
+        sleeps.append(delay)
+        if len(sleeps) > 1:
+            raise KeyboardInterrupt()
+    monkeypatch.setattr(rooms, 'sleep', sleep)
+
+    requests = api.requests
+    engine.watch(lambda: reports.append(len(engine.rooms)))
+
+    # both areas, then the first one due again: its first page is asked to
+    # the server and lists the newest advert it knows
+    assert engine.metrics.counters['watch_searches'] == 3
+    assert sorted(engine.state['watch']) == ['Brixton', 'Clapham']
+    assert reports and reports[0] > 0
+    pages = sum((len(adverts) + 49) // 50 for adverts in api.areas.values())
+    assert api.requests - requests == pages + len(api.adverts) + 1
+
+def fail_details(api, monkeypatch, room_ids):
+    """Makes the fake API answer the details requests of room_ids with a 503."""
+
+    respond = api.respond
+    def failing(path):
+        status, body = respond(path)
+        if urlparse(path).path.rsplit('/', 1)[-1] in room_ids:
+            return 503, {'error': 'Service unavailable'}
+        return status, body
+    monkeypatch.setattr(api, 'respond', failing)
+
+def test_refresh_plans_the_reported_and_valuable_rooms_first(tmp_path):
+    engine = rated_engine(tmp_path, 500)
+    now = datetime.now()
+    for n, key in enumerate(sorted(engine.rooms)):
+        engine.rooms[key]['fetched'] = str(now - timedelta(hours=n % 48))
+
+    planned = engine.plan_refresh(50)
+    order = engine.plan_refresh()
+    assert planned == order[:50]
+
+    reported = [key for key in order if engine.rooms[key]['new']]
+    assert order[:len(reported)] == reported
+    epoch = rooms.to_epoch(now)
+    priorities = [engine.get_refresh_priority(key, epoch) for key in order]
+    assert priorities == sorted(priorities, reverse=True)
+
+def test_refresh_retires_removed_and_failing_adverts_only(api, tmp_path, monkeypatch):
+    configure('--workers', '8', '--retries', '0')
+    engine, _ = crawl(tmp_path, api)
+    keys = sorted(engine.rooms)
+    removed, failing = keys[0], keys[1]
+    del api.adverts[removed]
+    fail_details(api, monkeypatch, [failing])
+
+    requests = api.requests
+    updated, retired = engine.refresh()
+    assert api.requests - requests == len(keys)
+    assert (updated, retired) == (len(keys) - 2, 1)
+    assert removed not in engine.rooms and engine.rooms[failing]['errors'] == 1
+
+    for _ in range(engine.retire_errors - 1):
+        engine.refresh()
+    assert failing not in engine.rooms
+    assert len(engine.rooms) == len(keys) - 2
+
+def test_refresh_never_retires_rooms_it_could_not_ask_for(api, tmp_path):
+    configure('--workers', '8', '--cache-dir', str(tmp_path / 'cache'), cache=True)
+    engine, _ = crawl(tmp_path, api)
+    keys = set(engine.rooms)
+
+    # the cached details are asked again to the server
+    requests = api.requests
+    assert engine.refresh() == (len(keys), 0)
+    assert api.requests - requests == len(keys)
+
+    configure('--workers', '8', '--cache-dir', str(tmp_path / 'cache'), '--cache-only', cache=True)
+    assert engine.refresh() == (0, 0)
+
+    # a new session, the keep-alive connections outlive the server
+    configure('--workers', '8', '--retries', '0')
+    api.stop()
+    engine = make_engine(tmp_path, api)
+    for _ in range(engine.retire_errors):
+        assert engine.refresh() == (0, 0)
+    assert set(engine.rooms) == keys
+
+def scan(engine, price=None, available=None, stations=None, areas=None):
+    """Returns the keys of the rooms matching the RoomIndex.query conditions, checking every room."""
+
+    def within(value, bounds):
+        return bounds is None or (value is not None and (bounds[0] is None or value >= bounds[0]) and (bounds[1] is None or value < bounds[1]))
+
+    keys = set()
+    for key, room in engine.rooms.items():
+        cheapest = min(room.prices) if len(room.prices) else None
+        if not within(cheapest, price) or not within(room.timestamp, available):
+            continue
+        if stations is not None and room.station.lower() not in set(name.lower() for name in stations):
+            continue
+        if areas is not None and set(name.lower() for name in areas).isdisjoint(area.lower() for area in room.get_areas()):
+            continue
+        keys.add(key)
+    return keys
+
+def test_room_index_finds_the_rooms_a_scan_finds(tmp_path):
+    engine = rated_engine(tmp_path, 2000)
+    index = engine.rooms.get_index()
+    rnd = random.Random(0)
+    low = rooms.to_epoch(START)
+    stations = ['Brixton', 'Balham', 'Putney', 'clapham', 'Nowhere']
+
+    def queries():
+        for _ in range(200):
+            price = rnd.randint(300, 1500)
+            when = low + rnd.randint(0, 90) * 86400
+            yield {
+                'price': rnd.choice([None, (price, price + rnd.randint(0, 400)), (None, price), (price, None)]),
+                'available': rnd.choice([None, (when, when + rnd.randint(0, 30) * 86400), (None, when)]),
+                'stations': rnd.choice([None, rnd.sample(stations, 2)]),
+                'areas': rnd.choice([None, ['Brixton'], ['clapham', 'Nowhere']]),
+            }
+
+    for conditions in queries():
+        assert set(index.query(**conditions)) == scan(engine, **conditions), conditions
+
+    # the index follows the rooms changed, added and deleted
+    keys = sorted(engine.rooms)
+    for key in keys[:100]:
+        del engine.rooms[key]
+    for key in keys[100:200]:
+        engine.rooms[key] = dict(engine.rooms[key].to_dict(), station=rnd.choice(stations), prices=[rnd.randint(300, 1500)])
+    for key, room in generate_rooms(100, seed=1).items():
+        engine.rooms['new-' + key] = room
+    for conditions in queries():
+        assert set(index.query(**conditions)) == scan(engine, **conditions), conditions
+
+    engine.rate_rooms()
+    found = engine.query(20, price=(800, 1001), stations=['Brixton', 'Balham'])
+    expected = sorted((engine.rooms[key] for key in scan(engine, price=(800, 1001), stations=['Brixton', 'Balham'])), key=lambda room: room['score'], reverse=True)
+    assert ranking(found) == ranking(expected[:20])
+
+@pytest.fixture
+def fixtures_api():
+    api = FakeSpareRoom(200, areas=['Brixton', 'Clapham'], seed=1)
+    api.start()
+    yield api
+    api.stop()
+
+def make_federation(directory, api, fixtures_api):
+    """Creates a Federation of a SpareRoom engine asking api and a FixtureRooms one asking fixtures_api."""
+
+    spareroom = make_engine(directory, api)
+    fixtures = rooms.FixtureRooms(rooms.get_spareroom_preferences(), settings.AREAS, file_name=os.path.join(str(directory), 'fixtures.json'))
+    fixtures.api_location = fixtures_api.url
+    return rooms.Federation([spareroom, fixtures], rooms.get_spareroom_preferences(), settings.AREAS, file_name=os.path.join(str(directory), 'rooms.json'))
+
+def test_federation_keeps_the_rooms_of_every_engine(api, fixtures_api, tmp_path):
+    configure('--workers', '8')
+    federation = make_federation(tmp_path, api, fixtures_api)
+    federation.get_new_rooms()
+
+    expected = set()
+    for engine in federation.engines:
+        assert engine.rooms
+        for room_id, room in engine.rooms.items():
+            key = '{name}:{id}'.format(name=engine.name, id=room_id)
+            expected.add(key)
+            federated = federation.rooms[key]
+            assert federated['source'] == engine.name
+            assert dict(federated.to_dict(), id=room_id, source=None) == dict(room.to_dict(), source=None)
+    assert set(federation.rooms) == expected
+
+    # nothing changed, nothing copied; then a room found in another area and a retired one
+    assert federation.merge_engines() == 0
+    spareroom = federation.engines_by_name['spareroom']
+    moved, retired = sorted(spareroom.rooms)[:2]
+    spareroom.add_area(moved, 'Balham')
+    del spareroom.rooms[retired]
+    assert federation.merge_engines() == 1
+    assert 'Balham' in federation.rooms['spareroom:' + moved].get_areas()
+    assert 'spareroom:' + retired not in federation.rooms
+
+    # the federated database is saved
+    assert set(make_federation(tmp_path, api, fixtures_api).rooms) == set(federation.rooms)
+
+def test_federation_keeps_searching_when_an_engine_fails(api, fixtures_api, tmp_path, monkeypatch):
+    configure('--workers', '8')
+    federation = make_federation(tmp_path, api, fixtures_api)
+    def fail():
+        raise IOError('site down')
+    monkeypatch.setattr(federation.engines_by_name['fixtures'], 'get_new_rooms', fail)
+    federation.get_new_rooms()
+
+    assert federation.rooms
+    assert set(key.split(':', 1)[0] for key in federation.rooms) == set(['spareroom'])
+
+def test_chunked_rate_and_report_match_the_loaded_rooms(tmp_path):
+    configure()
+    engine = make_engine(tmp_path / 'loaded')
+    engine.rooms = generate_rooms(1000)
+    engine.rooms.dirty.update(engine.rooms)
+    engine.save_rooms()
+    shutil.copytree(str(tmp_path / 'loaded'), str(tmp_path / 'chunked'))
+
+    engine = make_engine(tmp_path / 'loaded')
+    engine.rate()
+    expected = engine.top_rooms(-1, engine.get_report_filters())
+    engine.generate_report(fields=settings.FIELDS, output_format='jsonl')
+    assert expected
+
+    configure('--chunk-size', '100')
+    chunked = make_engine(tmp_path / 'chunked')
+    chunked.rate()
+    assert chunked.chunked
+    assert ranking(chunked.top_rooms(-1, chunked.get_report_filters())) == ranking(expected)
+    chunked.generate_report(fields=settings.FIELDS, output_format='jsonl')
+    assert chunked.chunked
+
+    # the scores were saved batch by batch
+    configure()
+    saved = make_engine(tmp_path / 'chunked').rooms
+    assert dict((key, room['score']) for key, room in saved.items()) == dict((key, room['score']) for key, room in engine.rooms.items())
+
+    reports = []
+    for name in ('loaded', 'chunked'):
+        with io.open(str(tmp_path / name / 'spareroom.jsonl'), encoding='utf-8') as f:
+            reports.append([json.loads(line) for line in f])
+    assert ranking(reports[1]) == ranking(reports[0])
+    assert sorted(reports[1], key=lambda room: room['id']) == sorted(reports[0], key=lambda room: room['id'])